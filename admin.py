@@ -0,0 +1,26 @@
+"""Operator (admin) access checks.
+
+Operators are the accounts whose email is listed in ADMIN_EMAILS
+(comma separated in the environment variable of the same name).
+"""
+from functools import wraps
+
+from flask import abort, current_app
+from flask_login import current_user
+
+
+def is_admin(user=None):
+    user = user if user is not None else current_user
+    if not user or not user.is_authenticated or not user.email:
+        return False
+    return user.email.lower() in current_app.config.get("ADMIN_EMAILS", ())
+
+
+def admin_required(view):
+    """Like login_required, but 404s for anyone who is not an operator."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not is_admin():
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapped
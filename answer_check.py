@@ -0,0 +1,314 @@
+"""Free-response grading: is a typed antiderivative equivalent to the key?
+
+Students write answers the way the seeded questions do, e.g.
+"(1/7)(x + 1)^7 + C", "-x cos x + sin x", "ln|sec x + tan x|",
+"2√(x-2)*(x²/5 - 2x/15 - 8/15)". Instead of symbolic simplification, both the
+answer and the key are parsed into small expression trees and evaluated with
+numpy at many random points in one batch. The answer is accepted when
+answer(x) - key(x) is the same constant at every point (antiderivatives only
+agree up to + C), within the Tolerance policy.
+
+Parsed keys are cached (parse_key() is lru_cached), so grading a submission
+costs one parse of the student's text plus two vectorised evaluations.
+Student text is never cached, and anything longer than MAX_LENGTH characters
+or nested deeper than MAX_DEPTH is refused with ParseError before it can
+exhaust the interpreter's stack.
+"""
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+
+class ParseError(ValueError):
+    pass
+
+
+MAX_LENGTH = 300  # characters, after normalise()
+MAX_DEPTH = 40  # brackets, bars, roots, function calls and prefix signs
+
+
+@dataclass(frozen=True)
+class Tolerance:
+    """Accept when every |d_i - median(d)| <= abs_tol + rel_tol * scale.
+
+    d is answer - key at the sample points and scale is max(|key|, 1) at the
+    same point. `samples` points are drawn uniformly from [low, high]; points
+    where either side is undefined are dropped, and at least `min_valid` must
+    remain for the answer to be judged.
+    """
+    rel_tol: float = 1e-6
+    abs_tol: float = 1e-8
+    samples: int = 64
+    min_valid: int = 16
+    low: float = 0.2
+    high: float = 3.0
+
+
+DEFAULT_TOLERANCE = Tolerance()
+
+FUNCTIONS = {
+    "sin": np.sin, "cos": np.cos, "tan": np.tan,
+    "sec": lambda v: 1 / np.cos(v), "csc": lambda v: 1 / np.sin(v), "cot": lambda v: 1 / np.tan(v),
+    "arcsin": np.arcsin, "arccos": np.arccos, "arctan": np.arctan,
+    "sinh": np.sinh, "cosh": np.cosh, "tanh": np.tanh,
+    "ln": np.log, "log": np.log, "exp": np.exp, "sqrt": np.sqrt, "abs": np.abs,
+}
+INVERSE = {"sin": "arcsin", "cos": "arccos", "tan": "arctan"}
+CONSTANTS = {"e": np.e, "pi": np.pi, "π": np.pi}
+SUPERSCRIPTS = str.maketrans("⁰¹²³⁴⁵⁶⁷⁸⁹⁻", "0123456789-")
+
+_TOKEN = re.compile(
+    r"\s*(?:"
+    r"(?P<num>\d+(?:\.\d*)?|\.\d+)"
+    r"|(?P<sup>[⁰¹²³⁴⁵⁶⁷⁸⁹⁻]+)"
+    r"|(?P<name>[A-Za-zπ]+)"
+    r"|(?P<op>\*\*|[-+*/^(){}\[\]|√·×−,])"
+    r")"
+)
+
+
+def _tokenize(text):
+    text = text.replace("−", "-").replace("·", "*").replace("×", "*")
+    tokens, pos = [], 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m or m.end() == pos:
+            raise ParseError(f"unexpected character {text[pos]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "op" and value == "**":
+            value = "^"
+        if kind == "name" and value not in FUNCTIONS and value not in CONSTANTS and value not in ("x", "C", "c"):
+            # "xsinx" / "ex": split unknown runs into single letters
+            if all(ch in "xCce" for ch in value):
+                tokens.extend(("name", ch) for ch in value)
+                continue
+            raise ParseError(f"unknown name {value!r}")
+        tokens.append((kind, value))
+    return tokens
+
+
+class _Parser:
+    """Recursive descent over the informal notation used in the question bank.
+
+    Trees are tuples: ("num", v), ("x",), ("neg", a), ("add"|"sub"|"mul"|"div"|"pow", a, b),
+    ("call", name, a).
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.i = 0
+        self.bars = 0  # open |...| groups
+        self.depth = 0
+
+    def nested(self, rule):
+        """Run a sub-rule one level deeper, refusing nesting beyond MAX_DEPTH."""
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise ParseError("answer is nested too deeply")
+        try:
+            return rule()
+        finally:
+            self.depth -= 1
+
+    def peek(self, offset=0):
+        j = self.i + offset
+        return self.tokens[j] if j < len(self.tokens) else (None, None)
+
+    def take(self):
+        tok = self.peek()
+        self.i += 1
+        return tok
+
+    def expect(self, value):
+        kind, v = self.take()
+        if v != value:
+            raise ParseError(f"expected {value!r}")
+
+    def parse(self):
+        tree = self.expr()
+        if self.peek()[0] is not None:
+            raise ParseError(f"unexpected {self.peek()[1]!r}")
+        return tree
+
+    def expr(self):
+        node = self.term()
+        while self.peek()[1] in ("+", "-"):
+            op = self.take()[1]
+            node = ("add" if op == "+" else "sub", node, self.term())
+        return node
+
+    def starts_factor(self):
+        kind, value = self.peek()
+        if kind in ("num", "name"):
+            return True
+        if value in ("(", "{", "[", "√"):
+            return True
+        # An opening bar only if we are not inside a bar group waiting to close it.
+        return value == "|" and self.bars == 0
+
+    def term(self):
+        node = self.unary()
+        while True:
+            value = self.peek()[1]
+            if value in ("*", "/"):
+                self.take()
+                rhs = self.unary()
+                node = ("mul" if value == "*" else "div", node, rhs)
+            elif self.starts_factor():
+                node = ("mul", node, self.power())
+            else:
+                return node
+
+    def unary(self):
+        if self.peek()[1] == "-":
+            self.take()
+            return ("neg", self.nested(self.unary))
+        if self.peek()[1] == "+":
+            self.take()
+            return self.nested(self.unary)
+        return self.power()
+
+    def exponent(self):
+        kind, value = self.peek()
+        if kind == "sup":
+            self.take()
+            return ("num", float(value.translate(SUPERSCRIPTS)))
+        if value == "^":
+            self.take()
+            return self.unary_exponent()
+        return None
+
+    def unary_exponent(self):
+        if self.peek()[1] == "-":
+            self.take()
+            return ("neg", self.nested(self.unary_exponent))
+        return self.nested(self.primary)
+
+    def power(self):
+        node = self.primary()
+        exp = self.exponent()
+        if exp is not None:
+            node = ("pow", node, exp)
+        return node
+
+    def function_argument(self):
+        """`sin 2x`, `ln x`, `sin(2x)`, `ln|x|`: a bracketed group or an implicit product."""
+        if self.peek()[1] in ("(", "{", "[", "|"):
+            return self.power()
+        node = self.power()
+        while self.peek()[0] in ("num",) or (self.peek()[0] == "name" and self.peek()[1] not in FUNCTIONS):
+            node = ("mul", node, self.power())
+        return node
+
+    def primary(self):
+        kind, value = self.take()
+        if kind == "num":
+            return ("num", float(value))
+        if kind == "name":
+            if value == "x":
+                return ("x",)
+            if value in ("C", "c"):
+                return ("num", 0.0)  # integration constant
+            if value in CONSTANTS:
+                return ("num", CONSTANTS[value])
+            name = value
+            # sin⁻¹ x, sin^-1 x -> arcsin; sin² x, sin^2 x -> (sin x)^2
+            fexp = self.exponent()
+            if fexp is not None and fexp in (("num", -1.0), ("neg", ("num", 1.0))) and name in INVERSE:
+                name, fexp = INVERSE[name], None
+            node = ("call", name, self.nested(self.function_argument))
+            return ("pow", node, fexp) if fexp is not None else node
+        if value in ("(", "{", "["):
+            close = {"(": ")", "{": "}", "[": "]"}[value]
+            node = self.nested(self.expr)
+            self.expect(close)
+            return node
+        if value == "|":
+            self.bars += 1
+            node = self.nested(self.expr)
+            self.bars -= 1
+            self.expect("|")
+            return ("call", "abs", node)
+        if value == "√":
+            return ("call", "sqrt", self.nested(self.power))
+        raise ParseError(f"unexpected {value!r}" if value else "unexpected end of answer")
+
+
+def _compile(tree):
+    """Turn a tree into a numpy function of x."""
+    kind = tree[0]
+    if kind == "num":
+        v = tree[1]
+        return lambda x: np.full_like(x, v)
+    if kind == "x":
+        return lambda x: x
+    if kind == "neg":
+        a = _compile(tree[1])
+        return lambda x: -a(x)
+    if kind == "call":
+        f, a = FUNCTIONS[tree[1]], _compile(tree[2])
+        return lambda x: f(a(x))
+    a, b = _compile(tree[1]), _compile(tree[2])
+    if kind == "add":
+        return lambda x: a(x) + b(x)
+    if kind == "sub":
+        return lambda x: a(x) - b(x)
+    if kind == "mul":
+        return lambda x: a(x) * b(x)
+    if kind == "div":
+        return lambda x: a(x) / b(x)
+    if kind == "pow":
+        return lambda x: np.power(a(x), b(x))
+    raise ParseError(kind)
+
+
+def normalise(text):
+    text = (text or "").strip()
+    # "... + C" is optional: antiderivatives are compared up to a constant anyway
+    return re.sub(r"[+-]\s*[Cc]\s*$", "", text).strip()
+
+
+def parse(text):
+    """Compile `text` into a vectorised function of x."""
+    text = normalise(text)
+    if not text:
+        raise ParseError("empty answer")
+    if len(text) > MAX_LENGTH:
+        raise ParseError("answer is too long")
+    try:
+        return _compile(_Parser(_tokenize(text)).parse())
+    except RecursionError:
+        # Long flat sums nest left-deep; the limits above should make this unreachable
+        raise ParseError("answer is nested too deeply") from None
+
+
+@lru_cache(maxsize=4096)
+def parse_key(text):
+    """parse() for answer keys, cached so each key parses once per worker."""
+    return parse(text)
+
+
+def equivalent(answer, key, tolerance=DEFAULT_TOLERANCE, seed=0):
+    """True if `answer` and `key` differ by a constant on the sample interval.
+
+    Raises ParseError if either cannot be parsed.
+    """
+    f_key = parse_key(key)
+    f_answer = parse(answer)
+
+    rng = np.random.default_rng(seed)
+    xs = rng.uniform(tolerance.low, tolerance.high, tolerance.samples)
+    with np.errstate(all="ignore"):
+        k = f_key(xs)
+        a = f_answer(xs)
+    valid = np.isfinite(k) & np.isfinite(a)
+    if valid.sum() < tolerance.min_valid:
+        return False
+    d = a[valid] - k[valid]
+    scale = np.maximum(np.abs(k[valid]), 1.0)
+    return bool(np.all(np.abs(d - np.median(d)) <= tolerance.abs_tol + tolerance.rel_tol * scale))
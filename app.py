@@ -1,19 +1,74 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, render_template, request, redirect, url_for, flash, session, make_response
+from flask import Response, stream_with_context
 from sqlalchemy.sql import func
+from sqlalchemy.exc import IntegrityError
 from flask_login import UserMixin, LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
-
-app = Flask(__name__)
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict, namedtuple
+from types import SimpleNamespace
+import fcntl
+import os
+import random
+import secrets
+import threading
+import time
+
+import click
+from markupsafe import Markup
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import answer_check
+import mathml
+import query_stats
+import question_templates
+import recurrence
+from profiler import Profiler
+from metrics import Metrics
+from video_thumbnails import VideoThumbnails
+from asset_pipeline import Assets
+from compression import Compression, stream_template
+from rate_limit import RateLimiter
+from jobs import JobQueue, PRIORITY_LOW
+from sharding import ShardedSQLAlchemy, DEFAULT_SHARD, current_shard
+from archive import Archive, vacuum
+from backup import Backups
+from tutor import Tutor, TutorBusy
+from shared_counter import SharedCounter
+
+# INSTANCE_PATH moves instance/ (databases, caches, shared counters) elsewhere, e.g. for tests
+app = Flask(__name__, instance_path=os.environ.get("INSTANCE_PATH"))
 app.config["SECRET_KEY"] = "testing234"
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///database.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Course content shared by every school; everything else, including caches
+# written while serving a school (rendered math, tutor answers), lives in the
+# school's shard so its writes never queue behind another school's
+app.config["CATALOG_TABLES"] = (
+    "course", "chapter", "part", "question", "lesson_note", "free_response_key",
+    "question_template", "part_slot",
+)
+# Operators who can reach the /admin pages
+app.config["ADMIN_EMAILS"] = [e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()]
+# Prometheus scrapes /metrics with "Authorization: Bearer <METRICS_TOKEN>"
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
 
-db = SQLAlchemy(app)
+db = ShardedSQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.login_view = "login"
 login_manager.init_app(app)
+query_stats.init_app(app)
+profiler = Profiler(app, db)
+metrics = Metrics(app, db)
+rate_limiter = RateLimiter(app, metrics)
+jobs = JobQueue(app, db, metrics)
+archive = Archive(app)
+archive.index("part_submission", "student_id")  # found by student, whatever their classroom was
+backups = Backups(app, db, metrics)
+tutor = Tutor(app, db, metrics)
+video_thumbnails = VideoThumbnails(app)
+assets = Assets(app)
+Compression(app)
 
 # ----------------- MODELS -----------------
 # --- Classroom Model ---
@@ -84,6 +139,21 @@ class Classroom(db.Model):
     )
 
     events = db.relationship("CalendarEvent", backref="classroom", lazy=True)
+
+# --- Classroom Join Code ---
+# Lives in the classroom's shard; the shard directory maps each code to its
+# school, so a code from any school resolves with one catalog lookup
+class ClassroomJoinCode(db.Model):
+    code = db.Column(db.String(16), primary_key=True)
+    shard = db.Column(db.String(50), nullable=False)
+    classroom_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(150), nullable=False)
+    name_key = db.Column(db.String(150), nullable=False, index=True)  # lowercased name, for prefix search
+
+    __table_args__ = (
+        db.UniqueConstraint("shard", "classroom_id", name="uq_join_code_classroom"),
+    )
+
 class PartCompletion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     part_id = db.Column(db.Integer, db.ForeignKey('part.id'), nullable=False)
@@ -134,6 +204,40 @@ class Question(db.Model):
     part = db.relationship("Part", backref="questions")
 
 
+# --- Free-response answer keys ---
+# A question with a key here is answered by typing an expression instead of
+# picking A-D; see grade_answer(). Tolerance fields left empty use
+# answer_check.DEFAULT_TOLERANCE.
+class FreeResponseKey(db.Model):
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), primary_key=True)
+    expression = db.Column(db.Text, nullable=False)
+    domain_low = db.Column(db.Float)
+    domain_high = db.Column(db.Float)
+    rel_tol = db.Column(db.Float)
+
+    question = db.relationship("Question", backref=db.backref("free_response", uselist=False))
+
+
+# --- Pre-rendered math, keyed by mathml.digest() of the source text ---
+class RenderedMath(db.Model):
+    digest = db.Column(db.String(40), primary_key=True)
+    html = db.Column(db.Text, nullable=False)
+
+
+# --- Parameterised question templates ---
+# Variants live in `pool` as packed records (see question_templates.py); each
+# student gets a stable variant, so no Question row is stored per variant.
+class QuestionTemplate(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    part_id = db.Column(db.Integer, db.ForeignKey("part.id"), nullable=False, index=True)
+    kind = db.Column(db.String(30), nullable=False)  # key of question_templates.KINDS
+    seed = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)  # bumped when the pool is regenerated
+    pool = db.deferred(db.Column(db.LargeBinary, nullable=False))
+
+    part = db.relationship("Part", backref="question_templates")
+
+
 class PartSubmission(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
@@ -150,6 +254,36 @@ class PartSubmission(db.Model):
     __table_args__ = (
         db.UniqueConstraint("student_id", "part_id"),
     )
+
+# --- Points ledger ---
+# Append-only record of every points change. User.points is a denormalised
+# total kept in step with atomic UPDATEs; `key` makes each award idempotent.
+class PointsEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(30), nullable=False)  # part_submission, opening_balance, compacted, ...
+    key = db.Column(db.String(80), unique=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+# --- Rolling points aggregates for windowed leaderboards ---
+# One row per student per UTC day they scored. A window ranking sums the
+# buckets of its last N days, an index range read; buckets older than
+# LEADERBOARD_RETENTION_DAYS are deleted.
+class PointsBucket(db.Model):
+    student_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    day = db.Column(db.Integer, primary_key=True)  # days since 1970-01-01 (UTC)
+    classroom_id = db.Column(db.Integer, db.ForeignKey("classroom.id"))
+    points = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index("ix_points_bucket_class_day", "classroom_id", "day", "student_id", "points"),
+        db.Index("ix_points_bucket_day", "day", "student_id", "points"),
+        {"sqlite_with_rowid": False},
+    )
+
+
 class StudentPartProgress(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -159,22 +293,84 @@ class StudentPartProgress(db.Model):
         db.UniqueConstraint('student_id', 'part_id'),
     )
 
-@app.route("/submit_part/<int:part_id>", methods=["POST"])
-@login_required
-def submit_part(part_id):
-    part = Part.query.get_or_404(part_id)
+
+# --- Progress store ---
+# Completed parts are bits: every part gets a fixed bit number within its
+# course (PartSlot), and a student's progress in a course is that bitset,
+# split into 63-bit words (SQLite integers are signed 64-bit). Marking a part
+# done is one upsert doing `bits = bits | mask`. Replaces PartCompletion,
+# SubmittedPart, part_submissions, StudentPartProgress and ChapterCompletion,
+# which are only read by migrate_progress().
+class PartSlot(db.Model):
+    part_id = db.Column(db.Integer, db.ForeignKey("part.id"), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey("course.id"), nullable=False)
+    bit = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint("course_id", "bit"),
+    )
+
+
+class CourseProgress(db.Model):
+    student_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey("course.id"), primary_key=True)
+    word = db.Column(db.Integer, primary_key=True, default=0)
+    bits = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        {"sqlite_with_rowid": False},
+    )
+
+# --- Practice review queue ---
+# One row per (student, question) being practised. The (student_id, due)
+# index is the student's priority queue: the next item is the lowest `due`,
+# found with one index seek instead of scanning their history.
+class ReviewItem(db.Model):
+    student_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), primary_key=True)
+    due = db.Column(db.Integer, nullable=False)  # minutes since epoch
+    interval = db.Column(db.SmallInteger, nullable=False, default=0)  # days
+    ease = db.Column(db.SmallInteger, nullable=False, default=250)  # ease factor x100
+    reps = db.Column(db.SmallInteger, nullable=False, default=0)
+    lapses = db.Column(db.SmallInteger, nullable=False, default=0)
+
+    question = db.relationship("Question")
+
+    __table_args__ = (
+        db.Index("ix_review_item_queue", "student_id", "due"),
+        {"sqlite_with_rowid": False},
+    )
+
+def record_part_submission(part, form):
+    """Grade and store the current student's answers to a part; the caller commits.
+
+    Returns (submission, created). A part is submitted once per student, so a
+    repeat (a double click, a retried or replayed offline submission) gets the
+    stored submission back instead of a new one.
+    """
+    existing = PartSubmission.query.filter_by(student_id=current_user.id, part_id=part.id).first()
+    if existing is None and part_completed(current_user.id, part):
+        # Done but not live: the submission may have been archived
+        existing = archived_submissions(current_user, [part.id]).get(part.id)
+    if existing:
+        return existing, False
 
     # Count correct answers
     correct = 0
-    total = len(part.questions)
+    total = len(part.questions) + len(part.question_templates)
 
+    keys = free_response_keys(q.id for q in part.questions)
+    results = {}
     for q in part.questions:
-        student_ans = request.form.get(f"q_{q.id}")
-        if student_ans == q.correct_answer:
+        student_ans = form.get(f"q_{q.id}")
+        results[q.id] = grade_answer(q, student_ans, keys.get(q.id))
+        if results[q.id]:
             correct += 1
 
-    # Add points to student
-    current_user.points += correct * 10
+    # Templated questions are graded against this student's variant in the pool
+    for t in part.question_templates:
+        if form.get(f"t_{t.id}") == student_variant_answer(t, current_user.id):
+            correct += 1
 
     # Record submission
     submission = PartSubmission(
@@ -184,17 +380,82 @@ def submit_part(part_id):
         total=total
     )
 
-    # Add part to student's submitted_parts (for progress tracking)
-    if part not in current_user.submitted_parts:
-        current_user.submitted_parts.append(part)
-
     db.session.add(submission)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # A concurrent request submitted the same part first
+        db.session.rollback()
+        return PartSubmission.query.filter_by(student_id=current_user.id, part_id=part.id).first(), False
+
+    # Progress and points are committed with the submission (the page promises
+    # them); only the practice review queue follows from the job queue
+    mark_part_done(current_user.id, part)
+    key = f"part:{part.id}:student:{current_user.id}"
+    award_points(current_user.id, correct * 10, "part_submission", key, current_user.classroom_id)
+    jobs.enqueue("practice-queue", {"student_id": current_user.id, "results": results}, dedup_key=f"practice:{key}")
+    return submission, True
+
+
+def part_form_error(form):
+    """Why these answers can never be accepted (a message), or None."""
+    if any(len(value) > answer_check.MAX_LENGTH for value in form.values()):
+        return f"Answers can be at most {answer_check.MAX_LENGTH} characters long."
+    return None
+
+
+@app.route("/submit_part/<int:part_id>", methods=["POST"])
+@login_required
+def submit_part(part_id):
+    part = Part.query.get_or_404(part_id)
+    error = part_form_error(request.form)
+    if error:
+        flash(error, "danger")
+        return redirect(url_for("chapter_page", chapter_id=part.chapter_id))
+
+    submission, created = record_part_submission(part, request.form)
+    if not created:
+        flash("You have already submitted this part.", "warning")
+        return redirect(url_for("chapter_page", chapter_id=part.chapter_id))
     db.session.commit()
 
+    correct, total = submission.correct, submission.total
     flash(f"Submitted! Score: {correct}/{total} (+{correct*10} points)", "success")
     return redirect(url_for("chapter_page", chapter_id=part.chapter_id))
 
 
+@app.route("/submit_part/<int:part_id>/sync", methods=["POST"])
+def submit_part_sync(part_id):
+    """Idempotent JSON twin of submit_part, for answers the service worker queued offline.
+
+    Sending the same part again returns the stored result with "duplicate",
+    so the client can retry until it gets an answer.
+    """
+    if not current_user.is_authenticated:
+        return {"error": "Please log in again."}, 401
+    # Answers queued on a shared device wait for the student who gave them
+    owner = request.form.get("offline_owner")
+    if owner and owner != offline_owner():
+        return {"error": "These answers belong to another student."}, 409
+    part = Part.query.get(part_id)
+    if part is None:
+        return {"error": "No such part."}, 404
+    # 4xx for answers that will never be accepted, so the client stops retrying
+    error = part_form_error(request.form)
+    if error:
+        return {"error": error}, 400
+
+    submission, created = record_part_submission(part, request.form)
+    db.session.commit()
+    return {
+        "part_id": part.id,
+        "chapter_id": part.chapter_id,
+        "correct": submission.correct,
+        "total": submission.total,
+        "points": submission.correct * 10,
+        "duplicate": not created,
+        "chapter_url": url_for("chapter_page", chapter_id=part.chapter_id),
+    }
 
 part_submissions = db.Table('part_submissions',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
@@ -212,6 +473,19 @@ class CalendarEvent(db.Model):
     classroom_id = db.Column(db.Integer, db.ForeignKey("classroom.id"))
     
 
+# --- Recurring calendar events ---
+# One row per series; occurrences are expanded per month from the rule
+# (see recurrence.py), never stored.
+class EventSeries(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    classroom_id = db.Column(db.Integer, db.ForeignKey("classroom.id"), nullable=False, index=True)
+    title = db.Column(db.String(100), nullable=False)
+    time = db.Column(db.String(10))
+    start = db.Column(db.Date, nullable=False)
+    rule = db.Column(db.String(200), nullable=False)  # e.g. "FREQ=WEEKLY;BYDAY=MO"
+    exdates = db.Column(db.Text, nullable=False, default="")  # skipped dates, comma-separated ISO
+
+
 
 # --- Chapter Model ---
 class Chapter(db.Model):
@@ -271,6 +545,90 @@ class ChapterCompletion(db.Model):
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+
+# ---------- CLASSROOM MEMBERSHIP ----------
+# Access checks ask classroom_membership() instead of scanning
+# current_user.classrooms, and class pickers use classroom_choices(). A
+# teacher's classrooms come from one query and are kept per worker, so most
+# requests run no query for them at all. Committing a change to
+# User.classrooms, Classroom.teachers, Classroom.name or User.classroom_id
+# bumps membership_generation, a counter shared by every worker on the
+# machine; an entry cached under an older generation is stale everywhere at
+# once. Code that writes teacher_class directly must bump it too.
+MEMBERSHIP_CACHE_SIZE = 10000
+
+ClassroomChoice = namedtuple("ClassroomChoice", "id name")
+
+membership_generation = SharedCounter(os.path.join(app.instance_path, "membership.gen"))
+_membership_cache = OrderedDict()
+_membership_lock = threading.Lock()
+
+
+def _teacher_classrooms(user):
+    """(ids, choices) of a teacher's classrooms, from the cache when it is current."""
+    key = (current_shard(), user.id)
+    # Read before the query: a change committed meanwhile leaves this entry stale
+    generation = membership_generation.value()
+    with _membership_lock:
+        entry = _membership_cache.get(key)
+        if entry is not None and entry[0] == generation:
+            _membership_cache.move_to_end(key)
+    if entry is not None and entry[0] == generation:
+        metrics.cache_hit("classroom_membership")
+        return entry[1], entry[2]
+
+    metrics.cache_miss("classroom_membership")
+    choices = tuple(ClassroomChoice(*row) for row in db.session.execute(
+        db.select(Classroom.id, Classroom.name)
+        .join(teacher_class, teacher_class.c.classroom_id == Classroom.id)
+        .where(teacher_class.c.teacher_id == user.id)
+    ))
+    ids = frozenset(c.id for c in choices)
+    with _membership_lock:
+        _membership_cache[key] = (generation, ids, choices)
+        while len(_membership_cache) > MEMBERSHIP_CACHE_SIZE:
+            _membership_cache.popitem(last=False)
+    return ids, choices
+
+
+def classroom_membership(user=None):
+    """Frozen set of the ids of the classrooms a user (default: the current one) belongs to."""
+    user = user or current_user
+    if user.role != "teacher":
+        # A student's one classroom is on the user row already
+        return frozenset([user.classroom_id]) if user.classroom_id else frozenset()
+    return _teacher_classrooms(user)[0]
+
+
+def classroom_choices(user=None):
+    """A teacher's classrooms as (id, name) pairs, for class pickers."""
+    return _teacher_classrooms(user or current_user)[1]
+
+
+def _membership_changed(*args):
+    # Published at commit: before that, other requests must keep seeing the old set
+    db.session.info["membership_changed"] = True
+
+
+db.event.listen(User.classrooms, "append", _membership_changed)
+db.event.listen(User.classrooms, "remove", _membership_changed)
+db.event.listen(User.classroom_id, "set", _membership_changed)
+db.event.listen(Classroom.teachers, "append", _membership_changed)
+db.event.listen(Classroom.teachers, "remove", _membership_changed)
+db.event.listen(Classroom.name, "set", _membership_changed)
+db.event.listen(Classroom, "after_delete", _membership_changed)
+
+
+@db.event.listens_for(db.Session, "after_commit")
+def _membership_committed(session):
+    if session.info.pop("membership_changed", False):
+        membership_generation.bump()
+
+
+@db.event.listens_for(db.Session, "after_rollback")
+def _membership_rolled_back(session):
+    session.info.pop("membership_changed", None)
+
 # ----------------- ROUTES -----------------
 @app.route("/")
 def index():
@@ -284,7 +642,7 @@ def index():
 # ---------- SIGNUP ----------
 @app.route("/signup", methods=["GET", "POST"])
 def signup():
-    classrooms = Classroom.query.all()  # for student dropdown
+    schools = db.shard_names()
 
     if request.method == "POST":
         role = request.form.get("role")
@@ -295,26 +653,34 @@ def signup():
             return redirect(url_for("signup"))
 
         password = generate_password_hash(password_raw, method="pbkdf2:sha256")
+        registered = None
 
         try:
             if role == "teacher":
                 email = request.form.get("email_or_id")
                 verification = request.form.get("teacher_verif")
                 class_names_raw = request.form.get("class_name")
+                shard = request.form.get("school", DEFAULT_SHARD)
 
                 if not email or not class_names_raw:
                     flash("Please fill in email and class names.", "danger")
                     return redirect(url_for("signup"))
 
+                if shard not in schools:
+                    flash("Selected school does not exist.", "danger")
+                    return redirect(url_for("signup"))
+
                 # Check teacher verification
                 if verification != "teacher":
                     flash("Invalid teacher verification password", "danger")
                     return redirect(url_for("signup"))
 
-                # Check if email already exists
-                if User.query.filter_by(email=email).first():
+                # Check if email already exists, in this school or any other
+                db.use_shard(shard)
+                if User.query.filter_by(email=email).first() or not db.register_login(login_key("teacher", email), shard):
                     flash("A user with this email already exists.", "danger")
                     return redirect(url_for("signup"))
+                registered = login_key("teacher", email)
 
                 # Create teacher
                 new_teacher = User(name=name, email=email, password=password, role="teacher")
@@ -334,27 +700,37 @@ def signup():
                     if classroom not in new_teacher.classrooms:
                         new_teacher.classrooms.append(classroom)
 
+                ensure_join_codes(new_teacher.classrooms, shard)
                 db.session.commit()
                 flash("Teacher account created and joined/created classes!", "success")
                 return redirect(url_for("login"))
 
             elif role == "student":
                 student_id = request.form.get("email_or_id")
-                classroom_id = request.form.get("classroom_id")
+                code = normalize_join_code(request.form.get("join_code", ""))
 
-                if not student_id or not classroom_id:
-                    flash("Please provide student ID and select a classroom.", "danger")
+                if not student_id or not code:
+                    flash("Please provide student ID and your class join code.", "danger")
                     return redirect(url_for("signup"))
 
-                # Check if student ID already exists
-                if User.query.filter_by(student_id=student_id).first():
-                    flash("A student with this ID already exists.", "danger")
+                # The code says which school and classroom the student joins
+                found = lookup_join_code(code)
+                if not found or found.shard not in schools:
+                    flash("Unknown join code. Ask your teacher for your class's code.", "danger")
                     return redirect(url_for("signup"))
+                shard = found.shard
+                db.use_shard(shard)
 
-                classroom = Classroom.query.get(classroom_id)
+                classroom = Classroom.query.get(found.classroom_id)
                 if not classroom:
-                    flash("Selected classroom does not exist.", "danger")
+                    flash("Unknown join code. Ask your teacher for your class's code.", "danger")
+                    return redirect(url_for("signup"))
+
+                # Check if student ID already exists, in this school or any other
+                if User.query.filter_by(student_id=student_id).first() or not db.register_login(login_key("student", student_id), shard):
+                    flash("A student with this ID already exists.", "danger")
                     return redirect(url_for("signup"))
+                registered = login_key("student", student_id)
 
                 new_student = User(
                     name=name,
@@ -374,19 +750,61 @@ def signup():
 
         except Exception as e:
             db.session.rollback()
+            if registered:
+                db.unregister_login(registered)
             flash("An unexpected error occurred: " + str(e), "danger")
             return redirect(url_for("signup"))
 
-    return render_template("signup.html", classrooms=classrooms)
+    return render_template("signup.html", schools=schools)
+
+
+@app.route("/classrooms/search")
+@login_required
+def classroom_search():
+    """Typeahead over the teacher's school's classroom names: a prefix range scan on the name index."""
+    if current_user.role != "teacher":
+        return {"error": "Only teachers can search classrooms."}, 403
+    prefix = request.args.get("q", "").strip().lower()
+    if len(prefix) < TYPEAHEAD_MIN_CHARS:
+        return []
+    rows = ClassroomJoinCode.query.filter(
+        ClassroomJoinCode.shard == current_shard(),
+        ClassroomJoinCode.name_key >= prefix,
+        ClassroomJoinCode.name_key < prefix + "\uffff",
+    ).order_by(ClassroomJoinCode.name_key).limit(TYPEAHEAD_LIMIT).all()
+    return [{"id": row.classroom_id, "name": row.name} for row in rows]
 
 
 @app.route('/leaderboard')
 @login_required
 def leaderboard():
-    students = User.query.filter_by(role="student").all()
+    window = request.args.get("window", "all")
+    if window not in LEADERBOARD_WINDOWS:
+        window = "all"
 
-    students = sorted(students, key=lambda s: s.points, reverse=True)
-    return render_template('leaderboard.html', students=students)
+    # Classrooms this user may rank: a student's own, a teacher's classes
+    if current_user.role == "student":
+        classrooms = [current_user.classroom] if current_user.classroom else []
+    else:
+        classrooms = list(classroom_choices())
+    classroom = None
+    scope = request.args.get("scope", "class" if classrooms else "all")
+    if scope == "class" and classrooms:
+        classroom_id = request.args.get("classroom_id", type=int)
+        classroom = next((c for c in classrooms if c.id == classroom_id), classrooms[0])
+    else:
+        scope = "all"
+
+    rows = leaderboard_rows(window, classroom.id) if classroom else global_leaderboard_rows(window)
+    return stream_template(
+        'leaderboard.html',
+        rows=rows,
+        window=window,
+        windows=LEADERBOARD_WINDOWS,
+        scope=scope,
+        classroom=classroom,
+        classrooms=classrooms
+    )
 
 
 @app.route("/profile")
@@ -401,14 +819,14 @@ def profile():
 @login_required
 def forum():
     if current_user.role == "teacher":
-        # Get all classes for this teacher
-        teacher_classes = current_user.classrooms
+        # All classes for this teacher, for the class picker
+        teacher_classes = classroom_choices()
         classroom_id = request.args.get("classroom_id", type=int)
 
         # Default to first classroom if none selected
         if classroom_id:
-            classroom = Classroom.query.get_or_404(classroom_id)
-            if classroom not in teacher_classes:
+            classroom = next((c for c in teacher_classes if c.id == classroom_id), None)
+            if classroom is None:
                 flash("You do not belong to this classroom.", "danger")
                 return redirect(url_for("forum"))
         elif teacher_classes:
@@ -419,7 +837,7 @@ def forum():
     else:
         # Students only have one classroom
         classroom = current_user.classroom
-        teacher_classes = []
+        teacher_classes = ()
 
     # Handle new post
     if request.method == "POST" and classroom:
@@ -428,13 +846,19 @@ def forum():
             post = ForumPost(content=content, classroom_id=classroom.id, author_id=current_user.id)
             db.session.add(post)
             db.session.commit()
+            prerender_math([content])
             flash("Post added!", "success")
         return redirect(url_for("forum", classroom_id=classroom.id if classroom else None))
 
     # Fetch posts for selected classroom
-    posts = ForumPost.query.filter_by(classroom_id=classroom.id).order_by(ForumPost.id.desc()).all() if classroom else []
-
-    return render_template(
+    # Authors and answers are loaded up front, so the streamed page runs no queries
+    posts = ForumPost.query.filter_by(classroom_id=classroom.id).options(
+        db.joinedload(ForumPost.author),
+        db.selectinload(ForumPost.answers).joinedload(ForumAnswer.author)
+    ).order_by(ForumPost.id.desc()).all() if classroom else []
+    prerender_math([p.content for p in posts] + [a.content for p in posts for a in p.answers])
+
+    return stream_template(
         "forum.html",
         teacher_classes=teacher_classes,
         current_class=classroom,
@@ -443,12 +867,41 @@ def forum():
 
 
 
+# Forum history of a closed classroom, read from the archive
+@app.route("/forum/archive")
+@login_required
+def forum_archive():
+    classroom_id = request.args.get("classroom_id", type=int)
+    if current_user.role == "teacher":
+        classroom = Classroom.query.get(classroom_id) if classroom_id in classroom_membership() else None
+    else:
+        classroom = current_user.classroom
+    if classroom is None:
+        flash("You do not belong to this classroom.", "danger")
+        return redirect(url_for("forum"))
+
+    posts = [SimpleNamespace(**row, answers=[]) for row in archive.rows("forum_post", classroom.id)]
+    by_id = {p.id: p for p in posts}
+    for row in archive.rows("forum_answer", classroom.id):
+        if row["post_id"] in by_id:
+            by_id[row["post_id"]].answers.append(SimpleNamespace(**row))
+    author_ids = {p.author_id for p in posts} | {a.author_id for p in posts for a in p.answers}
+    authors = {u.id: u for u in User.query.filter(User.id.in_(author_ids))}
+    posts.reverse()  # newest first, like the live forum
+    prerender_math([p.content for p in posts] + [a.content for p in posts for a in p.answers])
+
+    return render_template("forum_archive.html", classroom=classroom, posts=posts, authors=authors)
+
+
 # Reply to post
 @app.route("/forum/answer/<int:post_id>", methods=["POST"])
 @login_required
 def answer_post(post_id):
     post = ForumPost.query.get_or_404(post_id)
     classroom_id = post.classroom_id
+    if classroom_id not in classroom_membership():
+        flash("You do not belong to this classroom.", "danger")
+        return redirect(url_for("forum"))
 
     content = request.form.get("content")
     if content:
@@ -459,6 +912,7 @@ def answer_post(post_id):
         )
         db.session.add(answer)
         db.session.commit()
+        prerender_math([content])
 
     return redirect(url_for("forum", classroom_id=classroom_id))
 
@@ -471,7 +925,7 @@ def answer_post(post_id):
 def delete_post(post_id):
     post = ForumPost.query.get_or_404(post_id)
 
-    if current_user.role != "teacher":
+    if current_user.role != "teacher" or post.classroom_id not in classroom_membership():
         flash("Only teachers can delete posts.", "danger")
         return redirect(url_for("forum"))
 
@@ -503,6 +957,9 @@ def login():
         email_or_id = request.form["email_or_id"]
         password = request.form["password"]
 
+        # Find the user's school before touching its database
+        shard = db.lookup_login(login_key(role, email_or_id))
+        db.use_shard(shard)
         if role == "teacher":
             user = User.query.filter_by(email=email_or_id, role="teacher").first()
         else:
@@ -513,6 +970,8 @@ def login():
             return redirect(url_for("login"))
 
         login_user(user)
+        session["shard"] = shard
+        rate_limiter.remember_classroom(user.classroom_id)
         return redirect(url_for("index"))
 
     return render_template("login.html")
@@ -523,6 +982,7 @@ def login():
 @login_required
 def logout():
     logout_user()
+    session.pop("shard", None)
     return redirect(url_for("index"))
 
 @app.route("/student_dashboard")
@@ -546,45 +1006,22 @@ def student_dashboard():
     # 📚 Courses assigned to classroom
     courses = classroom.courses
 
-    # ✅ Parts completed by this student
-    completed_part_ids = {
-        sp.part_id
-        for sp in SubmittedPart.query.filter_by(
-            student_id=current_user.id
-        ).all()
-    }
+    # ✅ Chapter completion from the progress bitsets: no per-chapter queries
+    layouts = course_layouts(c.id for c in courses)
+    progress = student_progress([current_user.id], layouts)
 
     student_course_data = []
 
     for course in courses:
-
-        # 📖 Chapters for this course
-        chapters = Chapter.query.filter_by(
-            course_id=course.id
-        ).order_by(Chapter.order).all()
+        bitset = progress.get((current_user.id, course.id), 0)
 
         chapter_data = []
 
-        for chapter in chapters:
-
-            # 🧩 Parts inside this chapter
-            parts = Part.query.filter_by(
-                chapter_id=chapter.id
-            ).all()
-
-            total_parts = len(parts)
-            completed_parts = sum(
-                1 for p in parts if p.id in completed_part_ids
-            )
-
-            chapter_completed = (
-                total_parts > 0 and completed_parts == total_parts
-            )
-
+        for chapter in layouts[course.id]["chapters"]:
             chapter_data.append({
-                "id": chapter.id,
-                "title": chapter.title,
-                "completed": chapter_completed
+                "id": chapter["id"],
+                "title": chapter["title"],
+                "completed": chapter["parts"] > 0 and bitset & chapter["mask"] == chapter["mask"]
             })
 
         student_course_data.append({
@@ -600,40 +1037,52 @@ def student_dashboard():
 
 
 
-#from openai import OpenAI
+# ---------- CHAPTER TUTOR ----------
+TUTOR_PROMPT = (
+    'You are a patient math tutor helping a student with the chapter "{title}". '
+    "Explain the ideas, give hints and work through similar examples, "
+    "but do not simply give the answers to the chapter's exercises."
+)
 
-#@app.route('/chatgpt_chapter/<int:chapter_id>', methods=['GET', 'POST'])
-#@login_required
-#def chatgpt_chapter(chapter_id):
-    #chapter = Chapter.query.get_or_404(chapter_id)
-    #answer = None
 
-    #if request.method == "POST":
-        #question = request.form.get("question")
+def tutor_prompt(chapter):
+    prompt = TUTOR_PROMPT.format(title=chapter.title)
+    if chapter.parts:
+        prompt += " The chapter's parts are: " + ", ".join(p.title for p in chapter.parts) + "."
+    return prompt
 
-        #if question:
-            #response = client.chat.completions.create(
-                #model="gpt-4.1-mini",
-                #messages=[
-                    #{
-                        #"role": "system",
-                        #"content": (
-                            #"You are a tutor. Do NOT give any answers "
-                            #"before the student asks a question."
-                        #)
-                    #},
-                    #{"role": "user", "content": question}
-                #]
-            #)
 
-        #answer = response.choices[0].message.content
+@app.route("/chatgpt_chapter/<int:chapter_id>", methods=["GET", "POST"])
+@login_required
+def chatgpt_chapter(chapter_id):
+    chapter = Chapter.query.get_or_404(chapter_id)
+    question = request.form.get("question", "").strip()
+    answer = None
+    # The page's script asks for a stream and shows the answer as it arrives
+    streaming = bool(request.form.get("stream"))
 
-    #return render_template(
-        #"chatgpt_chapter.html",
-        #chapter=chapter,
-        #answer=answer
-    #)
+    if request.method == "POST" and question:
+        try:
+            pieces = tutor.ask(chapter.id, question, tutor_prompt(chapter), offline_owner())
+        except TutorBusy as busy:
+            if streaming:
+                return Response(str(busy), status=503, mimetype="text/plain",
+                                headers={"Retry-After": str(busy.retry_after)})
+            flash(str(busy), "warning")
+            return render_template("chatgpt_chapter.html", chapter=chapter, answer=None, question=question)
+
+        # No pooled connection is needed while the model talks
+        db.session.close()
+        if streaming:
+            return Response(stream_with_context(pieces), mimetype="text/plain")
+        answer = "".join(pieces)
 
+    return render_template(
+        "chatgpt_chapter.html",
+        chapter=chapter,
+        answer=answer,
+        question=question
+    )
 
 
 # ---------- MARK CHAPTER COMPLETE ----------
@@ -642,23 +1091,14 @@ def student_dashboard():
 def mark_part_complete(part_id):
     part = Part.query.get_or_404(part_id)
 
-    # Check if completion already exists
-    existing = PartCompletion.query.filter_by(
-        user_id=current_user.id,
-        part_id=part.id
-    ).first()
-
-    if not existing:
-        completion = PartCompletion(
-            user_id=current_user.id,
-            part_id=part.id
-        )
-        db.session.add(completion)
-
-        # Also add to submitted_parts for progress bar
-        if part not in current_user.submitted_parts:
-            current_user.submitted_parts.append(part)
+    slot = db.session.get(PartSlot, part.id)
+    done = slot is not None and part_done(
+        student_progress([current_user.id], [slot.course_id]).get((current_user.id, slot.course_id), 0),
+        slot.bit
+    )
 
+    if not done:
+        mark_part_done(current_user.id, part)
         db.session.commit()
         flash(f"Part '{part.title}' marked complete!", "success")
     else:
@@ -675,39 +1115,64 @@ def teacher_dashboard():
         flash("Unauthorized access", "danger")
         return redirect(url_for("index"))
 
-    # Classrooms owned by this teacher
-    classrooms = current_user.classrooms  
+    # Classrooms owned by this teacher, with their courses and students loaded up front
+    classrooms = Classroom.query.filter(Classroom.id.in_(classroom_membership())).options(
+        db.selectinload(Classroom.courses),
+        db.selectinload(Classroom.students),
+    ).order_by(Classroom.id).all()
 
     # List of available courses to publish
     courses = Course.query.all()
 
     if request.method == "POST":
-        classroom_id = request.form.get("classroom_id")
-        course_id = request.form.get("course_id")
+        # Bulk publish: one course set applied to many classrooms at once
+        mode = request.form.get("mode", "add")
+        classroom_ids = {int(cid) for cid in request.form.getlist("classroom_ids") if cid.isdigit()}
+        course_ids = {int(cid) for cid in request.form.getlist("course_ids") if cid.isdigit()}
 
-        classroom = Classroom.query.get(classroom_id)
-        course = Course.query.get(course_id)
-
-        # Validate
-        if not classroom or classroom.teacher_id != current_user.id:
+        # Validate: only this teacher's classrooms, only existing courses
+        if not classroom_ids or not classroom_ids <= classroom_membership():
             flash("Invalid classroom selection", "danger")
             return redirect(url_for("teacher_dashboard"))
 
-        if not course:
+        if mode not in PUBLISH_MODES or not course_ids <= {c.id for c in courses} or (not course_ids and mode != "replace"):
             flash("Invalid course selection", "danger")
             return redirect(url_for("teacher_dashboard"))
 
-        # Publish the course to that classroom
-        classroom.course_id = course.id
+        added, removed = publish_courses(classroom_ids, course_ids, mode)
         db.session.commit()
 
-        flash(f"Course '{course.name}' published to {classroom.name}!", "success")
+        flash(
+            f"Courses published to {len(classroom_ids)} classroom(s): "
+            f"{len(added)} assignment(s) added, {len(removed)} removed.",
+            "success"
+        )
         return redirect(url_for("teacher_dashboard"))
 
+    # Progress of every student: popcount of their bits over the classroom's courses
+    layouts = course_layouts({c.id for classroom in classrooms for c in classroom.courses})
+    students = [s for classroom in classrooms for s in classroom.students]
+    bitsets = student_progress([s.id for s in students], layouts)
+    progress = {}
+    for classroom in classrooms:
+        course_ids = [c.id for c in classroom.courses]
+        total = sum(layouts[cid]["all"].bit_count() for cid in course_ids)
+        for student in classroom.students:
+            done = sum(
+                (bitsets.get((student.id, cid), 0) & layouts[cid]["all"]).bit_count() for cid in course_ids
+            )
+            progress[(classroom.id, student.id)] = round(done / total * 100) if total else 0
+
+    # Join codes students sign up with (created with the classroom, or by the startup backfill)
+    join_codes = classroom_join_codes([c.id for c in classrooms])
+
     return render_template(
         "teacher_dashboard.html",
         classrooms=classrooms,
-        courses=courses
+        courses=courses,
+        progress=progress,
+        join_codes=join_codes,
+        format_join_code=format_join_code
     )
 
 @app.route("/chapter/<int:chapter_id>")
@@ -721,32 +1186,127 @@ def chapter_page(chapter_id):
     
     student = current_user
 
-    # All parts in this chapter
-    parts = chapter.parts
+    # All parts in this chapter, with their questions and notes in one query each
+    parts = Part.query.filter_by(chapter_id=chapter.id).options(
+        db.selectinload(Part.questions),
+        db.selectinload(Part.lesson_notes),
+    ).all()
 
-    # Parts already completed by this student
-    completed_part_ids = [p.id for p in student.submitted_parts if p.chapter_id == chapter_id]
+    # Parts already completed by this student, from the course bitset
+    layout = course_layouts([chapter.course_id]).get(chapter.course_id, {"parts": {}})
+    bitset = student_progress([student.id], [chapter.course_id]).get((student.id, chapter.course_id), 0)
+    completed_part_ids = [
+        p.id for p in parts if p.id in layout["parts"] and part_done(bitset, layout["parts"][p.id])
+    ]
 
-    
     submissions = {
         s.part_id: s
-        for s in PartSubmission.query.filter_by(student_id=current_user.id).all()
+        for s in PartSubmission.query.filter(
+            PartSubmission.student_id == current_user.id,
+            PartSubmission.part_id.in_([p.id for p in parts])
+        )
     }
+    # Completed parts without a live submission may have one in the archive
+    missing = [pid for pid in completed_part_ids if pid not in submissions]
+    if missing:
+        submissions.update(archived_submissions(current_user, missing))
+
+    # This student's variants of any templated questions
+    variants = {}
+    templates = QuestionTemplate.query.filter(
+        QuestionTemplate.part_id.in_([p.id for p in parts])
+    ).all()
+    for t in templates:
+        variants.setdefault(t.part_id, []).append(student_variant(t, current_user.id))
+
+    # Answer keys of free-response questions, in one query
+    keys = free_response_keys(q.id for part in parts for q in part.questions)
+    for part in parts:
+        for q in part.questions:
+            q.answer_key = keys.get(q.id)
+
+    math_texts = list(question_math_texts(q for part in parts for q in part.questions))
+    for part_variants in variants.values():
+        for v in part_variants:
+            math_texts.append(v["question_text"])
+            math_texts.extend(v["options"])
+    prerender_math(math_texts)
 
     # Inject runtime flags into parts
-    for part in chapter.parts:
+    for part in parts:
         submission = submissions.get(part.id)
+        part.variants = variants.get(part.id, [])
 
         part.submitted = submission is not None
         part.correct = submission.correct if submission else 0
         part.total = submission.total if submission else 0
-        part.completed = part.submitted  # teaching parts can also mark completion
+        part.completed = part.id in completed_part_ids  # teaching parts can also mark completion
 
-    return render_template(
+    # A page showing flash messages must not be replayed from the offline cache
+    flashed = bool(session.get("_flashes"))
+    response = stream_template(
         "chapter_page.html",
         chapter=chapter,parts=parts,
         completed_part_ids=completed_part_ids
     )
+    if flashed:
+        response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+# ---------- OFFLINE MODE ----------
+# The service worker (templates/sw.js) keeps the student's chapter pages, lesson
+# note PDFs and video thumbnails, and queues answers given offline for
+# submit_part_sync.
+OFFLINE_MAX_CHAPTERS = 50
+
+
+@app.template_global()
+def offline_owner():
+    """Who queued answers belong to; user ids are only unique within a school."""
+    return f"{current_shard()}:{current_user.id}"
+
+
+@app.route("/sw.js")
+def service_worker():
+    # Served from the root so its scope covers every page; its bytes (and so its
+    # version) change whenever an asset bundle does
+    response = make_response(render_template("sw.js"))
+    response.mimetype = "application/javascript"
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.route("/offline/manifest")
+@login_required
+def offline_manifest():
+    """URLs the service worker should hold for this student to work offline."""
+    if current_user.role != "student" or not current_user.classroom_id:
+        return {"pages": [], "files": []}
+
+    chapter_ids = [
+        cid for cid, in db.session.query(Chapter.id)
+        .join(classroom_course, classroom_course.c.course_id == Chapter.course_id)
+        .filter(classroom_course.c.classroom_id == current_user.classroom_id)
+        .order_by(Chapter.course_id, Chapter.order)
+        .limit(OFFLINE_MAX_CHAPTERS)
+    ]
+    parts = db.session.query(Part.id, Part.lesson_video, Part.answer_video).filter(
+        Part.chapter_id.in_(chapter_ids)
+    ).all()
+    notes = db.session.query(LessonNote.pdf_url).filter(
+        LessonNote.part_id.in_([p.id for p in parts])
+    ).all()
+
+    files = {url_for("static", filename=note.pdf_url) for note in notes}
+    for part in parts:
+        for video_id in (part.lesson_video, part.answer_video):
+            if video_id:
+                files.add(url_for("video_thumbnail", video_id=video_id))
+    return {
+        "pages": [url_for("chapter_page", chapter_id=cid) for cid in chapter_ids],
+        "files": sorted(files),
+    }
 
 # ---------- CREATE CLASSROOM ----------
 @app.route("/create_classroom", methods=["GET", "POST"])
@@ -770,12 +1330,11 @@ def create_classroom():
 @app.route("/assign_course/<int:classroom_id>", methods=["GET", "POST"])
 @login_required
 def assign_course(classroom_id):
-    classroom = Classroom.query.get_or_404(classroom_id)
-
     # Security check: only teachers assigned to this classroom
-    if current_user.role != "teacher" or classroom not in current_user.classrooms:
+    if current_user.role != "teacher" or classroom_id not in classroom_membership():
         flash("Unauthorized", "danger")
         return redirect(url_for("teacher_dashboard"))
+    classroom = Classroom.query.get_or_404(classroom_id)
 
     # Only show courses created by this teacher
     courses = Course.query.all()
@@ -783,17 +1342,11 @@ def assign_course(classroom_id):
     
     if request.method == "POST":
         # Get multiple selected course IDs from form
-        selected_course_ids = request.form.getlist("course_ids")
-
-        # Clear previous course assignments
-        classroom.courses = []
-
-        # Assign selected courses to the classroom
-        for cid in selected_course_ids:
-            course = Course.query.get(int(cid))
-            if course:
-                classroom.courses.append(course)
+        selected = {int(cid) for cid in request.form.getlist("course_ids") if cid.isdigit()}
+        selected &= {course.id for course in courses}
 
+        # Replace the classroom's course set, touching only changed rows
+        publish_courses([classroom.id], selected, "replace")
         db.session.commit()
         flash(f"Courses updated for {classroom.name}!", "success")
         return redirect(url_for("teacher_dashboard"))
@@ -805,6 +1358,51 @@ def assign_course(classroom_id):
     )
 
 
+# ---------- COURSE PUBLISHING ----------
+# "add": give every classroom these courses; "remove": take them away;
+# "replace": every classroom ends up with exactly these courses
+PUBLISH_MODES = ("add", "remove", "replace")
+
+
+def publish_courses(classroom_ids, course_ids, mode="add"):
+    """Apply a course set to many classrooms with one diff on classroom_course.
+
+    Reads the current assignments of all the classrooms in one query, then
+    inserts the missing pairs and deletes the unwanted ones in one statement
+    each; unchanged pairs are not touched. Newly published courses get their
+    caches warmed by the job queue. The caller commits.
+    Returns (added, removed) as sets of (classroom_id, course_id).
+    """
+    classroom_ids, course_ids = set(classroom_ids), set(course_ids)
+    cc = classroom_course.c
+    current = set(db.session.execute(
+        db.select(cc.classroom_id, cc.course_id).where(cc.classroom_id.in_(classroom_ids))
+    ).all())
+    wanted = {(cid, course_id) for cid in classroom_ids for course_id in course_ids}
+
+    if mode == "add":
+        added, removed = wanted - current, set()
+    elif mode == "remove":
+        added, removed = set(), current & wanted
+    else:
+        added, removed = wanted - current, current - wanted
+
+    if removed:
+        db.session.execute(
+            db.delete(classroom_course).where(db.tuple_(cc.classroom_id, cc.course_id).in_(removed))
+        )
+    if added:
+        db.session.execute(
+            classroom_course.insert(),
+            [{"classroom_id": cid, "course_id": course_id} for cid, course_id in sorted(added)]
+        )
+    for course_id in {course_id for _, course_id in added}:
+        jobs.enqueue("prepare-course", {"course_id": course_id}, dedup_key=f"prepare-course:{course_id}")
+    # Loaded Classroom.courses collections are stale now
+    db.session.expire_all()
+    return added, removed
+
+
 # ---------- CALENDAR ----------
 
 
@@ -825,12 +1423,12 @@ def calendar():
     # Classroom selection
     # ------------------------------
     if is_teacher:
-        classrooms = current_user.classrooms
+        classrooms = classroom_choices()
         classroom_id = request.args.get("classroom_id", type=int)
 
         if classroom_id:
-            classroom = Classroom.query.get_or_404(classroom_id)
-            if classroom not in classrooms:
+            classroom = next((c for c in classrooms if c.id == classroom_id), None)
+            if classroom is None:
                 flash("You do not belong to this classroom.", "danger")
                 return redirect(url_for("calendar"))
         else:
@@ -856,13 +1454,24 @@ def calendar():
             year = request.args.get("year", datetime.today().year, type=int)
             date = datetime(year, month, day).date()
 
-            event = CalendarEvent(
-                title=title,
-                date=date,
-                time=time,
-                classroom_id=classroom.id
-            )
-            db.session.add(event)
+            rule = series_rule(date, request.form.get("repeat", ""), request.form.get("until"), request.form.get("rule"))
+            if rule:
+                # A recurring event is one row, however many times it repeats
+                db.session.add(EventSeries(
+                    title=title,
+                    start=date,
+                    time=time,
+                    rule=rule,
+                    classroom_id=classroom.id
+                ))
+            else:
+                event = CalendarEvent(
+                    title=title,
+                    date=date,
+                    time=time,
+                    classroom_id=classroom.id
+                )
+                db.session.add(event)
             db.session.commit()
 
             return redirect(url_for("calendar", classroom_id=classroom.id, month=month, year=year))
@@ -876,8 +1485,15 @@ def calendar():
     month = request.args.get("month", today.month, type=int)
     year = request.args.get("year", today.year, type=int)
 
-    # Fetch all events for this classroom
-    all_events = CalendarEvent.query.filter_by(classroom_id=classroom.id).all()
+    # This month's events, occurrences of recurring ones and archived ones
+    first_day = datetime(year, month, 1).date()
+    last_day = datetime(year, month, monthrange(year, month)[1]).date()
+    all_events = CalendarEvent.query.filter(
+        CalendarEvent.classroom_id == classroom.id,
+        CalendarEvent.date.between(first_day, last_day)
+    ).all()
+    all_events += series_occurrences(classroom.id, year, month)
+    all_events += archived_events(classroom.id, first_day, last_day)
 
     events = {}
     for ev in all_events:
@@ -927,7 +1543,7 @@ def delete_event(event_id, year, month):
     event = CalendarEvent.query.get_or_404(event_id)
 
     # 🔒 Security + correctness
-    if event.classroom not in current_user.classrooms:
+    if event.classroom_id not in classroom_membership():
         flash("Unauthorized", "danger")
         return redirect(url_for("calendar"))
 
@@ -944,6 +1560,109 @@ def delete_event(event_id, year, month):
     ))
 
 
+@app.route("/skip_occurrence/<int:series_id>/<int:year>/<int:month>/<int:day>", methods=["POST"])
+@login_required
+def skip_occurrence(series_id, year, month, day):
+    series = db.get_or_404(EventSeries, series_id)
+    if current_user.role != "teacher" or series.classroom_id not in classroom_membership():
+        flash("Unauthorized", "danger")
+        return redirect(url_for("calendar"))
+
+    skipped = datetime(year, month, day).date().isoformat()
+    exdates = set(filter(None, series.exdates.split(",")))
+    exdates.add(skipped)
+    series.exdates = ",".join(sorted(exdates))
+    db.session.commit()
+
+    flash("Occurrence removed from the series.", "success")
+    return redirect(url_for("calendar", classroom_id=series.classroom_id, year=year, month=month))
+
+
+@app.route("/delete_series/<int:series_id>/<int:year>/<int:month>", methods=["POST"])
+@login_required
+def delete_series(series_id, year, month):
+    series = db.get_or_404(EventSeries, series_id)
+    if current_user.role != "teacher" or series.classroom_id not in classroom_membership():
+        flash("Unauthorized", "danger")
+        return redirect(url_for("calendar"))
+
+    db.session.delete(series)
+    db.session.commit()
+
+    flash("Recurring event deleted!", "success")
+    return redirect(url_for("calendar", classroom_id=series.classroom_id, year=year, month=month))
+
+
+# ---------- RECURRING EVENTS ----------
+# repeat choice in the add-event form -> rule for a series starting on `start`
+REPEAT_RULES = {
+    "daily": lambda start: "FREQ=DAILY",
+    "weekdays": lambda start: "FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR",
+    "weekly": lambda start: f"FREQ=WEEKLY;BYDAY={recurrence.WEEKDAYS[start.weekday()]}",
+    "fortnightly": lambda start: f"FREQ=WEEKLY;INTERVAL=2;BYDAY={recurrence.WEEKDAYS[start.weekday()]}",
+    "monthly": lambda start: f"FREQ=MONTHLY;BYMONTHDAY={start.day}",
+}
+OCCURRENCE_CACHE_SIZE = 5000
+
+# Worker-local LRU of expanded months; the key holds the whole series
+# definition, so an edited series simply misses.
+_occurrence_cache = OrderedDict()
+_occurrence_cache_lock = threading.Lock()
+
+
+def series_rule(start, repeat, until=None, custom=None):
+    """RRULE text for the add-event form, or None for a one-off event.
+
+    Raises recurrence.RuleError for a rule that cannot be used.
+    """
+    if repeat == "custom":
+        rule = (custom or "").strip()
+    elif repeat in REPEAT_RULES:
+        rule = REPEAT_RULES[repeat](start)
+        if until:
+            rule += ";UNTIL=" + datetime.strptime(until, "%Y-%m-%d").strftime("%Y%m%d")
+    else:
+        return None
+    recurrence.parse(rule)
+    return rule
+
+
+def month_occurrences(series, year, month):
+    """Dates of a series in one month, from the cache when possible."""
+    key = (series.id, series.start, series.rule, series.exdates, year, month)
+    with _occurrence_cache_lock:
+        days = _occurrence_cache.get(key)
+        if days is not None:
+            _occurrence_cache.move_to_end(key)
+    if days is not None:
+        metrics.cache_hit("calendar_occurrences")
+        return days
+
+    metrics.cache_miss("calendar_occurrences")
+    exdates = {date.fromisoformat(d) for d in series.exdates.split(",") if d}
+    first_day = date(year, month, 1)
+    last_day = date(year, month, monthrange(year, month)[1])
+    days = list(recurrence.occurrences(series.rule, series.start, first_day, last_day, exdates))
+    with _occurrence_cache_lock:
+        _occurrence_cache[key] = days
+        while len(_occurrence_cache) > OCCURRENCE_CACHE_SIZE:
+            _occurrence_cache.popitem(last=False)
+    return days
+
+
+def series_occurrences(classroom_id, year, month):
+    """Event-like objects for every occurrence of the classroom's series in a month."""
+    series_list = EventSeries.query.filter(
+        EventSeries.classroom_id == classroom_id,
+        EventSeries.start <= date(year, month, monthrange(year, month)[1])
+    ).all()
+    return [
+        SimpleNamespace(id=None, series_id=series.id, title=series.title, time=series.time, date=day)
+        for series in series_list
+        for day in month_occurrences(series, year, month)
+    ]
+
+
 @app.route("/part/<int:part_id>", methods=["GET", "POST"])
 @login_required
 def part_page(part_id):
@@ -963,9 +1682,9 @@ def part_page(part_id):
         questions = part.questions
         correct = 0
 
+        keys = free_response_keys(q.id for q in questions)
         for q in questions:
-            ans = request.form.get(f"q_{q.id}", "").strip().lower()
-            if ans == q.correct_answer.lower():
+            if grade_answer(q, request.form.get(f"q_{q.id}", ""), keys.get(q.id)):
                 correct += 1
 
         submission = PartSubmission(
@@ -976,6 +1695,7 @@ def part_page(part_id):
         )
 
         db.session.add(submission)
+        mark_part_done(current_user.id, part)
         db.session.commit()
 
         flash("Answers submitted successfully!", "success")
@@ -1014,12 +1734,1051 @@ def part_answers(part_id):
 
 
 
+# ---------- PROGRESS ----------
+PROGRESS_WORD_BITS = 63
+
+
+def assign_part_slots():
+    """Give every part without a PartSlot the next free bit of its course. The caller commits.
+
+    Parts are added by the seeds, and startup runs this before its commit, so
+    the fallbacks in course_layouts() and mark_part_done() rarely have work.
+    """
+    missing = (
+        db.session.query(Part.id, Chapter.course_id)
+        .join(Chapter, Part.chapter_id == Chapter.id)
+        .outerjoin(PartSlot, PartSlot.part_id == Part.id)
+        .filter(PartSlot.part_id.is_(None), Chapter.course_id.isnot(None))
+        .order_by(Chapter.course_id, Chapter.order, Part.id)
+        .all()
+    )
+    if not missing:
+        return
+    next_bit = dict(
+        db.session.query(PartSlot.course_id, func.max(PartSlot.bit) + 1).group_by(PartSlot.course_id).all()
+    )
+    for part_id, course_id in missing:
+        bit = next_bit.get(course_id, 0)
+        next_bit[course_id] = bit + 1
+        db.session.add(PartSlot(part_id=part_id, course_id=course_id, bit=bit))
+    db.session.flush()
+
+
+def course_layouts(course_ids):
+    """Chapters and part bits of each course, from one query.
+
+    Returns {course id: {"parts": {part id: bit}, "all": mask,
+    "chapters": [{"id", "title", "mask", "parts"}] in chapter order}}.
+    """
+    course_ids = list(course_ids)
+    if not course_ids:
+        return {}
+    rows = (
+        db.session.query(Chapter.course_id, Chapter.id, Chapter.title, Part.id, PartSlot.bit)
+        .outerjoin(Part, Part.chapter_id == Chapter.id)
+        .outerjoin(PartSlot, PartSlot.part_id == Part.id)
+        .filter(Chapter.course_id.in_(course_ids))
+        .order_by(Chapter.course_id, Chapter.order, Chapter.id)
+        .all()
+    )
+    if any(part_id is not None and bit is None for _, _, _, part_id, bit in rows):
+        assign_part_slots()
+        return course_layouts(course_ids)
+
+    layouts = {cid: {"parts": {}, "all": 0, "chapters": []} for cid in course_ids}
+    chapters = {}
+    for course_id, chapter_id, title, part_id, bit in rows:
+        layout = layouts[course_id]
+        chapter = chapters.get(chapter_id)
+        if chapter is None:
+            chapter = chapters[chapter_id] = {"id": chapter_id, "title": title, "mask": 0, "parts": 0}
+            layout["chapters"].append(chapter)
+        if part_id is not None:
+            layout["parts"][part_id] = bit
+            layout["all"] |= 1 << bit
+            chapter["mask"] |= 1 << bit
+            chapter["parts"] += 1
+    return layouts
+
+
+def student_progress(student_ids, course_ids):
+    """{(student id, course id): completed-parts bitset} from one query."""
+    student_ids, course_ids = list(student_ids), list(course_ids)
+    if not student_ids or not course_ids:
+        return {}
+    progress = {}
+    for student_id, course_id, word, bits in db.session.query(
+        CourseProgress.student_id, CourseProgress.course_id, CourseProgress.word, CourseProgress.bits
+    ).filter(CourseProgress.student_id.in_(student_ids), CourseProgress.course_id.in_(course_ids)):
+        key = (student_id, course_id)
+        progress[key] = progress.get(key, 0) | (bits << (word * PROGRESS_WORD_BITS))
+    return progress
+
+
+def _progress_rows(student_id, course_id, bitset):
+    word = 0
+    while bitset:
+        chunk = bitset & ((1 << PROGRESS_WORD_BITS) - 1)
+        if chunk:
+            yield {"student_id": student_id, "course_id": course_id, "word": word, "bits": chunk}
+        bitset >>= PROGRESS_WORD_BITS
+        word += 1
+
+
+def add_progress(rows):
+    """OR bitsets into the store: rows are (student id, course id, bitset)."""
+    values = [r for student_id, course_id, bitset in rows for r in _progress_rows(student_id, course_id, bitset)]
+    if not values:
+        return
+    stmt = sqlite_insert(CourseProgress)
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["student_id", "course_id", "word"],
+            set_={"bits": CourseProgress.bits.op("|")(stmt.excluded.bits)},
+        ),
+        values,
+    )
+
+
+def part_completed(student_id, part):
+    """Whether the student's progress bitset has this part, from one primary key lookup."""
+    slot = db.session.get(PartSlot, part.id)
+    if slot is None:
+        return False
+    word, bit = divmod(slot.bit, PROGRESS_WORD_BITS)
+    progress = db.session.get(CourseProgress, (student_id, slot.course_id, word))
+    return progress is not None and part_done(progress.bits, bit)
+
+
+def mark_part_done(student_id, part):
+    slot = db.session.get(PartSlot, part.id)
+    if slot is None:
+        assign_part_slots()
+        slot = db.session.get(PartSlot, part.id)
+    if slot is None:
+        return  # the part's chapter belongs to no course: there is no progress to keep
+    add_progress([(student_id, slot.course_id, 1 << slot.bit)])
+
+
+def part_done(bitset, bit):
+    return bitset >> bit & 1 == 1
+
+
+def migrate_progress():
+    """Fold the old progress tables into CourseProgress. Safe to run again."""
+    assign_part_slots()
+    slots = {part_id: (course_id, bit) for part_id, course_id, bit in db.session.query(
+        PartSlot.part_id, PartSlot.course_id, PartSlot.bit
+    )}
+    done = set()
+    done.update(db.session.query(PartSubmission.student_id, PartSubmission.part_id))
+    done.update(db.session.query(PartCompletion.user_id, PartCompletion.part_id))
+    done.update(db.session.query(SubmittedPart.student_id, SubmittedPart.part_id))
+    done.update(db.session.query(StudentPartProgress.student_id, StudentPartProgress.part_id))
+    done.update(db.session.execute(db.select(part_submissions.c.user_id, part_submissions.c.part_id)).all())
+    done.update(
+        db.session.query(ChapterCompletion.student_id, Part.id)
+        .join(Part, Part.chapter_id == ChapterCompletion.chapter_id)
+        .filter(ChapterCompletion.completed.is_(True))
+    )
+
+    bitsets = {}
+    for student_id, part_id in done:
+        if student_id is None or part_id not in slots:
+            continue
+        course_id, bit = slots[part_id]
+        bitsets[(student_id, course_id)] = bitsets.get((student_id, course_id), 0) | (1 << bit)
+    add_progress((sid, cid, bitset) for (sid, cid), bitset in bitsets.items())
+    db.session.commit()
+    return len(bitsets)
+
+
+@app.cli.command("migrate-progress")
+def migrate_progress_command():
+    """Copy progress from the old per-part tables into the bitset store."""
+    click.echo(f"Migrated progress for {migrate_progress()} student/course pairs.")
+
+
+# ---------- POINTS LEDGER ----------
+def award_points(student_id, delta, reason, key, classroom_id=None):
+    """Append a ledger entry and add `delta` to User.points in the same transaction.
+
+    `key` identifies the event (e.g. one part submission): if an entry with
+    that key already exists nothing happens and False is returned. The total
+    is bumped with `points = points + delta` in SQL, so concurrent awards
+    cannot overwrite each other, and so is today's leaderboard bucket.
+    The caller commits.
+    """
+    inserted = db.session.execute(
+        sqlite_insert(PointsEntry)
+        .values(student_id=student_id, delta=delta, reason=reason, key=key, created_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=["key"])
+    ).rowcount
+    if not inserted:
+        return False
+    db.session.execute(
+        db.update(User)
+        .where(User.id == student_id)
+        .values(points=func.coalesce(User.points, 0) + delta)
+    )
+    add_to_points_bucket(student_id, classroom_id, delta)
+    return True
+
+
+def backfill_points_ledger():
+    """Give every student with points an opening balance entry (runs once)."""
+    if PointsEntry.query.first():
+        return
+    db.session.execute(db.text(
+        "INSERT INTO points_entry (student_id, delta, reason, key, created_at) "
+        "SELECT id, points, 'opening_balance', 'opening:' || id, :now "
+        "FROM user WHERE points IS NOT NULL AND points != 0"
+    ), {"now": datetime.utcnow()})
+    db.session.commit()
+
+
+def compact_points_ledger(before):
+    """Fold each student's entries created before `before` into one row.
+
+    Totals are unchanged. The idempotency keys of folded entries are dropped,
+    so only compact past the point where a retried request could still arrive
+    (part submissions are also protected by PartSubmission's unique key).
+    Returns the number of rows removed.
+    """
+    with db.engine.begin() as conn:
+        max_id = conn.execute(db.text(
+            "SELECT MAX(id) FROM points_entry WHERE created_at < :before"
+        ), {"before": before}).scalar()
+        if max_id is None:
+            return 0
+        params = {"before": before, "max_id": max_id}
+        students = (
+            "SELECT student_id FROM points_entry WHERE created_at < :before AND id <= :max_id "
+            "GROUP BY student_id HAVING COUNT(*) > 1"
+        )
+        conn.execute(db.text(
+            "INSERT INTO points_entry (student_id, delta, reason, key, created_at) "
+            "SELECT student_id, SUM(delta), 'compacted', 'compacted:' || student_id || ':' || MAX(id), MAX(created_at) "
+            "FROM points_entry WHERE created_at < :before AND id <= :max_id "
+            f"AND student_id IN ({students}) GROUP BY student_id"
+        ), params)
+        return conn.execute(db.text(
+            "DELETE FROM points_entry WHERE created_at < :before AND id <= :max_id "
+            f"AND student_id IN ({students})"
+        ), params).rowcount
+
+
+def points_mismatches():
+    """(user id, stored points, ledger total) for every user whose total is off."""
+    return db.session.execute(db.text(
+        "SELECT u.id, COALESCE(u.points, 0), COALESCE(l.total, 0) FROM user u "
+        "LEFT JOIN (SELECT student_id, SUM(delta) AS total FROM points_entry GROUP BY student_id) l "
+        "ON l.student_id = u.id "
+        "WHERE COALESCE(u.points, 0) != COALESCE(l.total, 0)"
+    )).all()
+
+
+def rebuild_points():
+    """Set every User.points to its ledger total in one statement."""
+    result = db.session.execute(db.text(
+        "UPDATE user SET points = COALESCE("
+        "(SELECT SUM(delta) FROM points_entry WHERE points_entry.student_id = user.id), 0)"
+    ))
+    db.session.commit()
+    return result.rowcount
+
+
+# ---------- LEADERBOARDS ----------
+# window name -> (label, days); None means all time (User.points)
+LEADERBOARD_WINDOWS = OrderedDict([
+    ("day", ("Today", 1)),
+    ("week", ("This week", 7)),
+    ("term", ("This term", 120)),
+    ("all", ("All time", None)),
+])
+LEADERBOARD_RETENTION_DAYS = max(days for _, days in LEADERBOARD_WINDOWS.values() if days)
+LEADERBOARD_SIZE = 50
+
+
+def today_bucket():
+    return (datetime.utcnow() - datetime(1970, 1, 1)).days
+
+
+def add_to_points_bucket(student_id, classroom_id, delta):
+    stmt = sqlite_insert(PointsBucket).values(
+        student_id=student_id, day=today_bucket(), classroom_id=classroom_id, points=delta
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=["student_id", "day"],
+        set_={"points": PointsBucket.points + stmt.excluded.points, "classroom_id": stmt.excluded.classroom_id},
+    ))
+
+
+def backfill_points_buckets():
+    """Build buckets for the retention window from past submissions (runs once)."""
+    if PointsBucket.query.first():
+        return
+    db.session.execute(db.text(
+        "INSERT INTO points_bucket (student_id, day, classroom_id, points) "
+        "SELECT s.student_id, CAST(julianday(s.submitted_at) - 2440587.5 AS INTEGER) AS day, "
+        "u.classroom_id, SUM(s.correct) * 10 "
+        "FROM part_submission s JOIN user u ON u.id = s.student_id "
+        "WHERE s.submitted_at IS NOT NULL AND day > :oldest "
+        "GROUP BY s.student_id, day"
+    ), {"oldest": today_bucket() - LEADERBOARD_RETENTION_DAYS})
+    db.session.commit()
+
+
+def expire_points_buckets():
+    result = db.session.execute(
+        db.delete(PointsBucket).where(PointsBucket.day <= today_bucket() - LEADERBOARD_RETENTION_DAYS)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def leaderboard_rows(window, classroom_id=None):
+    """[(student, points)] best first for a window, optionally one classroom."""
+    days = LEADERBOARD_WINDOWS[window][1]
+    if days is None:
+        query = User.query.filter_by(role="student")
+        if classroom_id is not None:
+            query = query.filter_by(classroom_id=classroom_id)
+        students = query.order_by(User.points.desc()).limit(LEADERBOARD_SIZE).all()
+        return [(s, s.points or 0) for s in students]
+
+    total = func.sum(PointsBucket.points).label("total")
+    query = db.session.query(PointsBucket.student_id, total).filter(
+        PointsBucket.day > today_bucket() - days
+    )
+    if classroom_id is not None:
+        query = query.filter(PointsBucket.classroom_id == classroom_id)
+    ranked = query.group_by(PointsBucket.student_id).order_by(total.desc()).limit(LEADERBOARD_SIZE).all()
+    students = {u.id: u for u in User.query.filter(User.id.in_([sid for sid, _ in ranked]))}
+    return [(students[sid], points) for sid, points in ranked if sid in students]
+
+
+# Everyone-scope boards, merged from every school, per worker: {window: (expires, rows)}
+GLOBAL_LEADERBOARD_SECONDS = 30
+_global_leaderboards = {}
+RankedStudent = namedtuple("RankedStudent", "id name school")
+
+
+def global_leaderboard_rows(window):
+    """leaderboard_rows() across all schools: each school's top list, merged.
+
+    Recomputed at most every GLOBAL_LEADERBOARD_SECONDS, since it reads every shard.
+    """
+    cached = _global_leaderboards.get(window)
+    if cached and cached[0] > time.monotonic():
+        metrics.cache_hit("global_leaderboard")
+        return cached[1]
+    metrics.cache_miss("global_leaderboard")
+    rows = []
+    for school in db.shard_names():
+        with db.shard_context(school):
+            rows += [
+                (RankedStudent(student.id, student.name, school), points)
+                for student, points in leaderboard_rows(window)
+            ]
+    rows.sort(key=lambda row: row[1], reverse=True)
+    rows = rows[:LEADERBOARD_SIZE]
+    _global_leaderboards[window] = (time.monotonic() + GLOBAL_LEADERBOARD_SECONDS, rows)
+    return rows
+
+
+@app.cli.command("expire-leaderboard-buckets")
+def expire_leaderboard_buckets_command():
+    """Delete leaderboard buckets older than the longest window (run daily from cron)."""
+    click.echo(f"Removed {expire_points_buckets()} buckets.")
+
+
+@app.cli.command("compact-points")
+@click.option("--days", default=90, show_default=True, help="Compact entries older than this many days.")
+def compact_points_command(days):
+    """Fold old ledger entries into one row per student (run from cron)."""
+    removed = compact_points_ledger(datetime.utcnow() - timedelta(days=days))
+    click.echo(f"Compacted {removed} ledger entries.")
+
+
+@app.cli.command("check-points")
+@click.option("--fix", is_flag=True, help="Rebuild User.points from the ledger.")
+def check_points_command(fix):
+    """Compare User.points with the ledger and optionally rebuild it."""
+    mismatches = points_mismatches()
+    for user_id, stored, ledger in mismatches[:50]:
+        click.echo(f"user {user_id}: points={stored} ledger={ledger}")
+    click.echo(f"{len(mismatches)} mismatched users.")
+    if fix and mismatches:
+        rebuild_points()
+        click.echo("Rebuilt points from the ledger.")
+
+
+# ---------- PRACTICE (SPACED REPETITION) ----------
+MIN_EASE = 130
+MAX_EASE = 300
+RELEARN_MINUTES = 10
+
+
+def now_minutes():
+    return int(time.time() // 60)
+
+
+def enqueue_for_practice(student_id, results):
+    """Add answered questions to the student's review queue.
+
+    `results` maps question id -> answered correctly. Missed questions are due
+    straight away, correct ones come back for review in a few days. Questions
+    already in the queue keep their schedule.
+    """
+    if not results:
+        return
+    existing = {
+        qid for (qid,) in db.session.query(ReviewItem.question_id).filter(
+            ReviewItem.student_id == student_id,
+            ReviewItem.question_id.in_(list(results))
+        )
+    }
+    now = now_minutes()
+    for qid, was_correct in results.items():
+        if qid in existing:
+            continue
+        db.session.add(ReviewItem(
+            student_id=student_id,
+            question_id=qid,
+            due=now + (3 * 24 * 60 if was_correct else 0),
+            interval=3 if was_correct else 0,
+            ease=250,
+            reps=1 if was_correct else 0,
+            lapses=0 if was_correct else 1
+        ))
+
+
+def backfill_practice_queue(student_id):
+    """Seed the queue from parts submitted before practice mode existed (runs once)."""
+    part_ids = [
+        pid for (pid,) in db.session.query(PartSubmission.part_id).filter_by(student_id=student_id)
+    ]
+    if not part_ids:
+        return
+    question_ids = [
+        qid for (qid,) in db.session.query(Question.id).filter(Question.part_id.in_(part_ids))
+    ]
+    enqueue_for_practice(student_id, {qid: False for qid in question_ids})
+    db.session.commit()
+
+
+def next_review(student_id):
+    """Lowest-due item in the student's queue: a single seek on ix_review_item_queue."""
+    return ReviewItem.query.filter_by(student_id=student_id).order_by(ReviewItem.due).first()
+
+
+def schedule_review(item, was_correct):
+    """SM-2 style update of one queue entry after an answer."""
+    if was_correct:
+        item.reps += 1
+        if item.reps == 1:
+            item.interval = 1
+        elif item.reps == 2:
+            item.interval = 3
+        else:
+            item.interval = min(int(round(item.interval * item.ease / 100)), 365)
+        item.ease = min(item.ease + 10, MAX_EASE)
+        item.due = now_minutes() + item.interval * 24 * 60
+    else:
+        item.reps = 0
+        item.lapses += 1
+        item.interval = 0
+        item.ease = max(item.ease - 20, MIN_EASE)
+        item.due = now_minutes() + RELEARN_MINUTES
+
+
+@app.route("/practice")
+@login_required
+def practice():
+    if current_user.role != "student":
+        flash("Unauthorized", "danger")
+        return redirect(url_for("index"))
+
+    item = next_review(current_user.id)
+    if item is None:
+        backfill_practice_queue(current_user.id)
+        item = next_review(current_user.id)
+
+    if item is None or item.due > now_minutes():
+        next_due = datetime.fromtimestamp(item.due * 60, timezone.utc) if item else None
+        return render_template("practice.html", question=None, next_due=next_due)
+
+    due_count = ReviewItem.query.filter(
+        ReviewItem.student_id == current_user.id,
+        ReviewItem.due <= now_minutes()
+    ).count()
+    prerender_math(question_math_texts([item.question]))
+    return render_template("practice.html", question=item.question, item=item, due_count=due_count)
+
+
+@app.route("/practice/<int:question_id>", methods=["POST"])
+@login_required
+def practice_answer(question_id):
+    item = ReviewItem.query.get_or_404((current_user.id, question_id))
+    answer = request.form.get("answer")
+    was_correct = grade_answer(item.question, answer, item.question.free_response)
+
+    schedule_review(item, was_correct)
+    db.session.commit()
+
+    if was_correct:
+        flash("Correct! This one will come back later.", "success")
+    else:
+        expected = item.question.free_response.expression if item.question.free_response else item.question.correct_answer
+        flash(f"Not quite, the answer was {expected}. You'll see it again soon.", "warning")
+    return redirect(url_for("practice"))
+
+
+# ---------- FREE-RESPONSE GRADING ----------
+# (part title, question, answer key) created on first start
+DEFAULT_FREE_RESPONSE_QUESTIONS = [
+    ("Practice Exercises I", "Find ∫ x cos x dx", "x sin x + cos x + C"),
+    ("Practice Exercises I", "Find ∫ 2x (x² + 1)^3 dx", "(1/4)(x² + 1)^4 + C"),
+    ("Practice Exercises II", "Find ∫ sin² x dx", "x/2 - (sin 2x)/4 + C"),
+]
+
+
+def free_response_keys(question_ids):
+    """question id -> FreeResponseKey for the free-response questions among `question_ids`."""
+    question_ids = list(question_ids)
+    if not question_ids:
+        return {}
+    return {
+        k.question_id: k
+        for k in FreeResponseKey.query.filter(FreeResponseKey.question_id.in_(question_ids))
+    }
+
+
+def answer_tolerance(key):
+    overrides = {
+        field: value
+        for field, value in (("low", key.domain_low), ("high", key.domain_high), ("rel_tol", key.rel_tol))
+        if value is not None
+    }
+    return answer_check.Tolerance(**overrides) if overrides else answer_check.DEFAULT_TOLERANCE
+
+
+def grade_answer(question, response, key=None):
+    """Multiple choice compares the letter; free response checks equivalence up to + C."""
+    if key is None:
+        return (response or "").strip().upper() == question.correct_answer.upper()
+    try:
+        return answer_check.equivalent(response, key.expression, answer_tolerance(key), seed=question.id)
+    except answer_check.ParseError:
+        return False
+
+
+def seed_free_response_questions():
+    if FreeResponseKey.query.first():
+        return
+    for title, text, expression in DEFAULT_FREE_RESPONSE_QUESTIONS:
+        part = Part.query.filter_by(title=title).first()
+        if not part:
+            continue
+        question = Question(
+            part_id=part.id, question_text=text,
+            option_a="", option_b="", option_c="", option_d="", correct_answer=""
+        )
+        db.session.add(question)
+        db.session.flush()
+        db.session.add(FreeResponseKey(question_id=question.id, expression=expression))
+    db.session.commit()
+
+
+# ---------- QUESTION TEMPLATES ----------
+QUESTION_POOL_SIZE = 2000
+
+# (part title, template kind) pairs created on first start
+DEFAULT_QUESTION_TEMPLATES = [
+    ("Practice Exercises I", "power_linear"),
+    ("Practice Exercises I", "exp_linear"),
+    ("Practice Exercises I", "reciprocal_linear"),
+    ("Practice Exercises II", "cos_linear"),
+]
+
+# Unpacked pools per worker, keyed by (template id, version)
+_template_pools = {}
+
+
+def template_pool(template):
+    key = (template.id, template.version)
+    pool = _template_pools.get(key)
+    if pool is None:
+        metrics.cache_miss("question_pool")
+        pool = _template_pools[key] = template.pool
+    else:
+        metrics.cache_hit("question_pool")
+    return pool
+
+
+def student_variant(template, student_id):
+    pool = template_pool(template)
+    index = question_templates.variant_index(pool, student_id, template.id, template.seed)
+    variant = question_templates.render_variant(template.kind, pool, index)
+    variant["id"] = template.id
+    return variant
+
+
+def student_variant_answer(template, student_id):
+    pool = template_pool(template)
+    index = question_templates.variant_index(pool, student_id, template.id, template.seed)
+    return question_templates.correct_letter(pool, index)
+
+
+def seed_question_templates():
+    if QuestionTemplate.query.first():
+        return
+    for title, kind in DEFAULT_QUESTION_TEMPLATES:
+        part = Part.query.filter_by(title=title).first()
+        if not part:
+            continue
+        seed = random.randrange(2**31)
+        db.session.add(QuestionTemplate(
+            part_id=part.id,
+            kind=kind,
+            seed=seed,
+            pool=question_templates.generate_pool(kind, QUESTION_POOL_SIZE, seed)
+        ))
+    db.session.commit()
+
+
+@app.cli.command("generate-question-pools")
+@click.option("--size", default=QUESTION_POOL_SIZE, show_default=True, help="Variants per template.")
+@click.option("--reseed", is_flag=True, help="Draw new seeds (every student gets a new variant).")
+def generate_question_pools(size, reseed):
+    """Regenerate the variant pool of every question template."""
+    for t in QuestionTemplate.query.all():
+        if reseed:
+            t.seed = random.randrange(2**31)
+        t.pool = question_templates.generate_pool(t.kind, size, t.seed)
+        t.version += 1
+        click.echo(f"{t.kind} (part {t.part_id}): {size} variants, {len(t.pool)} bytes")
+    db.session.commit()
+
+
+# ---------- MATH RENDERING ----------
+MATH_CACHE_SIZE = 5000
+
+# Worker-local LRU of rendered math, in front of the rendered_math table
+_math_cache = OrderedDict()
+_math_cache_lock = threading.Lock()
+
+
+def _remember_math(key, html):
+    with _math_cache_lock:
+        _math_cache[key] = html
+        _math_cache.move_to_end(key)
+        while len(_math_cache) > MATH_CACHE_SIZE:
+            _math_cache.popitem(last=False)
+
+
+def _cached_math(key):
+    with _math_cache_lock:
+        html = _math_cache.get(key)
+        if html is not None:
+            _math_cache.move_to_end(key)
+        return html
+
+
+def prerender_math(texts):
+    """Make sure every text has a rendering in the worker cache.
+
+    Looks up everything the worker has not seen in one query and renders and
+    stores only texts that were never rendered before.
+    """
+    wanted = {mathml.digest(t): t for t in texts if t}
+    missing = [k for k in wanted if _cached_math(k) is None]
+    for _ in range(len(wanted) - len(missing)):
+        metrics.cache_hit("math")
+    if not missing:
+        return
+
+    found = RenderedMath.query.filter(RenderedMath.digest.in_(missing)).all()
+    for row in found:
+        _remember_math(row.digest, Markup(row.html))
+        metrics.cache_hit("math")
+
+    found_keys = {row.digest for row in found}
+    new_rows = []
+    for key in missing:
+        if key in found_keys:
+            continue
+        html = mathml.to_html(wanted[key])
+        _remember_math(key, html)
+        new_rows.append({"digest": key, "html": str(html)})
+        metrics.cache_miss("math")
+    if new_rows:
+        # Separate transaction, so objects already loaded by the view are not expired
+        with db.engine.begin() as conn:
+            conn.execute(sqlite_insert(RenderedMath).on_conflict_do_nothing(), new_rows)
+
+
+@app.template_filter("math")
+def math_filter(text):
+    if not text:
+        return ""
+    key = mathml.digest(text)
+    html = _cached_math(key)
+    if html is None:
+        # Not prerendered by the view: render for this worker only.
+        metrics.cache_miss("math")
+        html = mathml.to_html(text)
+        _remember_math(key, html)
+    return html
+
+
+def question_math_texts(questions):
+    for q in questions:
+        yield q.question_text
+        yield q.option_a
+        yield q.option_b
+        yield q.option_c
+        yield q.option_d
+
+
+@app.cli.command("prerender-math")
+def prerender_math_command():
+    """Render every question and forum post into the rendered_math cache."""
+    batch = 500
+    texts = list(question_math_texts(Question.query.all()))
+    texts += [content for (content,) in db.session.query(ForumPost.content)]
+    texts += [content for (content,) in db.session.query(ForumAnswer.content)]
+    for start in range(0, len(texts), batch):
+        prerender_math(texts[start:start + batch])
+    click.echo(f"{len(set(texts))} distinct texts rendered")
+
+
+# ---------- VIDEO THUMBNAILS ----------
+@video_thumbnails.known_video
+def lesson_video_exists(video_id):
+    """Thumbnails are only downloaded for videos some part actually uses."""
+    return db.session.query(
+        Part.query.filter(db.or_(Part.lesson_video == video_id, Part.answer_video == video_id)).exists()
+    ).scalar()
+
+
+@app.cli.command("cache-video-thumbnails")
+def cache_video_thumbnails_command():
+    """Download the thumbnail of every lesson and answer video."""
+    video_ids = set()
+    for lesson_video, answer_video in db.session.query(Part.lesson_video, Part.answer_video):
+        video_ids.update(v for v in (lesson_video, answer_video) if v)
+    failed = [v for v in sorted(video_ids) if video_thumbnails.fetch(v) is None]
+    click.echo(f"Cached {len(video_ids) - len(failed)} of {len(video_ids)} thumbnails.")
+    for video_id in failed:
+        click.echo(f"  failed: {video_id}")
+
+
+# ---------- SCHOOLS (SHARDS) ----------
+def login_key(role, email_or_id):
+    """Key of a login in the shard directory."""
+    return f"{role}:{email_or_id}"
+
+
+def backfill_shard_directory():
+    """List the default school's existing logins in the directory (runs once)."""
+    if db.session.execute(db.select(db.directory).limit(1)).first():
+        return
+    db.session.execute(db.text(
+        "INSERT OR IGNORE INTO shard_directory (login, shard) "
+        "SELECT 'teacher:' || email, :shard FROM user WHERE role = 'teacher' AND email IS NOT NULL "
+        "UNION ALL "
+        "SELECT 'student:' || student_id, :shard FROM user WHERE role = 'student' AND student_id IS NOT NULL"
+    ), {"shard": DEFAULT_SHARD})
+    db.session.commit()
+
+
+# ---------- JOIN CODES ----------
+# Codes skip look-alike characters (0/O, 1/I) so they survive being read aloud
+JOIN_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+JOIN_CODE_LENGTH = 8
+TYPEAHEAD_MIN_CHARS = 2
+TYPEAHEAD_LIMIT = 10
+
+
+def new_join_code():
+    return "".join(secrets.choice(JOIN_CODE_ALPHABET) for _ in range(JOIN_CODE_LENGTH))
+
+
+def normalize_join_code(text):
+    """Codes are shown as ABCD-EFGH; accept any case, spacing and dashes."""
+    return "".join(ch for ch in text.upper() if ch.isalnum())
+
+
+def format_join_code(code):
+    half = len(code) // 2
+    return f"{code[:half]}-{code[half:]}"
+
+
+def join_code_key(code):
+    """Key of a join code in the shard directory."""
+    return login_key("join", code)
+
+
+def lookup_join_code(code):
+    """(shard, classroom_id) of a join code: its school from the directory, then the row.
+
+    Signup has not picked a shard yet, so this must not open a transaction
+    on db.session.
+    """
+    shard = db.lookup_login(join_code_key(code))
+    if shard not in db.shard_names():
+        return None
+    engine = db.catalog_engine if shard == DEFAULT_SHARD else db.shard_engine(shard)
+    with engine.connect() as conn:
+        return conn.execute(
+            db.select(ClassroomJoinCode.shard, ClassroomJoinCode.classroom_id)
+            .where(ClassroomJoinCode.code == code, ClassroomJoinCode.shard == shard)
+        ).first()
+
+
+def claim_join_code(shard):
+    """A new code, registered to `shard` in the directory (codes are unique across schools)."""
+    while True:
+        code = new_join_code()
+        if db.register_login(join_code_key(code), shard):
+            return code
+
+
+def classroom_join_codes(classroom_ids, shard=None):
+    """{classroom id: join code} of the classrooms that have one; reads only."""
+    return dict(
+        db.session.query(ClassroomJoinCode.classroom_id, ClassroomJoinCode.code)
+        .filter(ClassroomJoinCode.shard == (shard or current_shard()), ClassroomJoinCode.classroom_id.in_(classroom_ids))
+        .all()
+    )
+
+
+def ensure_join_codes(classrooms, shard=None):
+    """{classroom id: join code}, creating codes for classrooms without one. The caller commits."""
+    shard = shard or current_shard()
+    codes = classroom_join_codes([c.id for c in classrooms], shard)
+    for classroom in classrooms:
+        if classroom.id not in codes:
+            codes[classroom.id] = claim_join_code(shard)
+            db.session.add(ClassroomJoinCode(
+                code=codes[classroom.id],
+                shard=shard,
+                classroom_id=classroom.id,
+                name=classroom.name,
+                name_key=classroom.name.lower(),
+            ))
+    return codes
+
+
+def backfill_join_codes():
+    """Give every classroom of the current shard that has no join code one.
+
+    Codes made while join codes lived in the catalog are first copied into
+    their school's shard and listed in the directory, so they keep working.
+    """
+    shard = current_shard()
+    if shard != DEFAULT_SHARD:
+        db.session.execute(db.text(
+            "INSERT OR IGNORE INTO main.classroom_join_code "
+            "SELECT * FROM catalog.classroom_join_code WHERE shard = :shard"
+        ), {"shard": shard})
+    db.session.execute(db.text(
+        "INSERT OR IGNORE INTO shard_directory (login, shard) "
+        "SELECT 'join:' || code, shard FROM classroom_join_code WHERE shard = :shard"
+    ), {"shard": shard})
+    db.session.commit()
+
+    coded = db.select(ClassroomJoinCode.classroom_id).where(ClassroomJoinCode.shard == shard)
+    missing = Classroom.query.filter(Classroom.id.not_in(coded)).all()
+    if missing:
+        ensure_join_codes(missing)
+        db.session.commit()
+
+
+@app.route("/classroom/<int:classroom_id>/join_code", methods=["POST"])
+@login_required
+def reset_join_code(classroom_id):
+    """Replace a classroom's join code, e.g. after it was shared too widely."""
+    if current_user.role != "teacher" or classroom_id not in classroom_membership():
+        flash("Unauthorized", "danger")
+        return redirect(url_for("teacher_dashboard"))
+    classroom = Classroom.query.get_or_404(classroom_id)
+
+    old = classroom_join_codes([classroom.id]).get(classroom.id)
+    code = claim_join_code(current_shard())
+    replaced = db.session.execute(
+        db.update(ClassroomJoinCode)
+        .where(ClassroomJoinCode.shard == current_shard(), ClassroomJoinCode.classroom_id == classroom.id)
+        .values(code=code)
+    ).rowcount
+    if not replaced:
+        db.unregister_login(join_code_key(code))
+        code = ensure_join_codes([classroom])[classroom.id]
+    db.session.commit()
+    if old and replaced:
+        db.unregister_login(join_code_key(old))
+    flash(f"New join code for {classroom.name}: {format_join_code(code)}", "success")
+    return redirect(url_for("teacher_dashboard"))
+
+
+# ---------- COLD ARCHIVE ----------
+def archive_rows(stmt, table, key):
+    """Move the rows `stmt` selects from `table` into the archive, a batch at a time.
+
+    `stmt` selects the table's columns plus the row's classroom, labelled
+    "archive_classroom". Returns the number of rows moved.
+    """
+    moved = 0
+    batch = app.config["ARCHIVE_CHUNK_ROWS"]
+    while True:
+        rows = [dict(r) for r in db.session.execute(stmt.order_by(table.c.id).limit(batch)).mappings()]
+        if not rows:
+            return moved
+        by_classroom = {}
+        for row in rows:
+            by_classroom.setdefault(row.pop("archive_classroom"), []).append(row)
+        for classroom_id, group in by_classroom.items():
+            archive.store(table.name, classroom_id, group, key)
+        db.session.execute(db.delete(table).where(table.c.id.in_([r["id"] for r in rows])))
+        db.session.commit()
+        moved += len(rows)
+
+
+def archive_term(before, classroom_ids=None):
+    """Archive calendar events and part submissions from before `before`.
+
+    Pass classroom_ids to archive those classrooms only. Returns {table: rows moved}.
+    """
+    events = CalendarEvent.__table__
+    stmt = db.select(events, events.c.classroom_id.label("archive_classroom")).where(events.c.date < before)
+    if classroom_ids:
+        stmt = stmt.where(events.c.classroom_id.in_(classroom_ids))
+    moved = {"calendar_event": archive_rows(stmt, events, "date")}
+
+    submissions = PartSubmission.__table__
+    stmt = (
+        db.select(submissions, User.classroom_id.label("archive_classroom"))
+        .join(User, User.id == submissions.c.student_id)
+        .where(submissions.c.submitted_at < before)
+    )
+    if classroom_ids:
+        stmt = stmt.where(User.classroom_id.in_(classroom_ids))
+    moved["part_submission"] = archive_rows(stmt, submissions, "submitted_at")
+    return moved
+
+
+def archive_classroom_forum(classroom_ids):
+    """Archive every forum post and answer of closed classrooms."""
+    answers, posts = ForumAnswer.__table__, ForumPost.__table__
+    moved = {"forum_answer": archive_rows(
+        db.select(answers, posts.c.classroom_id.label("archive_classroom"))
+        .join(posts, posts.c.id == answers.c.post_id)
+        .where(posts.c.classroom_id.in_(classroom_ids)),
+        answers, "id"
+    )}
+    moved["forum_post"] = archive_rows(
+        db.select(posts, posts.c.classroom_id.label("archive_classroom"))
+        .where(posts.c.classroom_id.in_(classroom_ids)),
+        posts, "id"
+    )
+    return moved
+
+
+def archived_submissions(student, part_ids):
+    """{part id: submission} for a student's archived submissions (slow path).
+
+    Looked up by student, so submissions filed under an earlier classroom (or
+    none) are found too.
+    """
+    part_ids = set(part_ids)
+    return {
+        row["part_id"]: SimpleNamespace(**row)
+        for row in archive.rows_by("part_submission", student.id, where=lambda row: row["part_id"] in part_ids)
+    }
+
+
+def archived_events(classroom_id, first_day, last_day):
+    return [
+        SimpleNamespace(**{**row, "date": date.fromisoformat(row["date"])}, archived=True)
+        for row in archive.rows("calendar_event", classroom_id, first_day, last_day)
+        if first_day.isoformat() <= row["date"] <= last_day.isoformat()
+    ]
+
+
+@app.cli.command("archive-cold-data")
+@click.option("--before", type=click.DateTime(formats=["%Y-%m-%d"]), help="Archive events and submissions older than this date.")
+@click.option("--classroom", "classroom_ids", type=int, multiple=True, help="Closed classroom: also archive its forum. Repeatable.")
+@click.option("--no-vacuum", is_flag=True, help="Skip returning freed space to the filesystem.")
+def archive_cold_data(before, classroom_ids, no_vacuum):
+    """Move cold rows of this school (SHARD) into its compressed archive."""
+    if before is None and not classroom_ids:
+        raise click.UsageError("Give --before, --classroom, or both.")
+    moved = {}
+    if before is not None:
+        moved.update(archive_term(before, list(classroom_ids) or None))
+    if classroom_ids:
+        moved.update(archive_classroom_forum(list(classroom_ids)))
+    for table, count in moved.items():
+        click.echo(f"{table:<18}{count:>8} rows archived")
+    if not no_vacuum:
+        click.echo(f"Vacuum freed {vacuum(db.engine) // 1024} KiB")
+    for source, chunk_count, row_count, size in archive.stats():
+        click.echo(f"archive {source:<18}{row_count:>8} rows in {chunk_count} chunks, {size // 1024} KiB")
+
+
+# ---------- BACKGROUND JOBS ----------
+# Only work nobody waits for is queued; points, progress and leaderboard
+# buckets commit with the submission itself
+@jobs.task("practice-queue")
+def practice_queue_job(student_id, results):
+    # JSON object keys are strings
+    enqueue_for_practice(student_id, {int(qid): correct for qid, correct in results.items()})
+
+
+@jobs.task("prepare-course", priority=PRIORITY_LOW)
+def prepare_course_job(course_id):
+    """Warm the caches a newly assigned course's pages read, before students open them."""
+    parts = Part.query.join(Chapter).filter(Chapter.course_id == course_id).all()
+    questions = Question.query.filter(Question.part_id.in_([p.id for p in parts])).all()
+    prerender_math(question_math_texts(questions))
+    for part in parts:
+        for video_id in (part.lesson_video, part.answer_video):
+            if video_id:
+                video_thumbnails.fetch(video_id)
+
+
+def schedule_backup():
+    """Queue the next scheduled snapshot at the next BACKUP_INTERVAL boundary.
+
+    The dedup key names the slot, so workers starting up together queue it once.
+    """
+    interval = app.config["BACKUP_INTERVAL"]
+    if not interval:
+        return
+    slot = int(time.time() // interval) + 1
+    jobs.enqueue(
+        "backup-snapshot",
+        dedup_key=f"backup-snapshot:{slot}",
+        delay=slot * interval - time.time(),
+    )
+
+
+@jobs.task("backup-snapshot", priority=PRIORITY_LOW, max_attempts=3)
+def backup_snapshot_job():
+    """Snapshot every database, drop snapshots past retention, queue the next one."""
+    backups.snapshot()
+    backups.prune()
+    schedule_backup()
+
+
 # ---------- INITIALIZE DB ----------
-with app.app_context():
-    #db.drop_all()
-    db.create_all()
+def seed_default_content():
     # Add default courses if not exist
-    
+    if Course.query.filter_by(name="Integration Course").first():
+        return
+
     course1 = Course(name="Integration Course")
     course2 = Course(name="Course 2(no content)")
     db.session.add_all([course1, course2])
@@ -1452,8 +3211,36 @@ with app.app_context():
 
     db.session.add_all([q1, q2, q3, q4, q5, q6, q7, q8, q9, q10, q11, q12, q13, q14, q15, q16, q17, q18, q19, q20, q21, q22, q23, q24, q25, q26, q27, q28, q29, q30, q31, q32, q33, q34, q35, q36, q37, q38, q39, q40, q41, q42, q43, q44, q45, q46, q47, q48, q49, q50])
     db.session.commit()
-    
+
+
+# Workers start together: create tables and run the one-time backfills one process at a time
+os.makedirs(app.instance_path, exist_ok=True)
+with open(os.path.join(app.instance_path, ".startup.lock"), "w") as startup_lock, db.shard_context(DEFAULT_SHARD):
+    fcntl.flock(startup_lock, fcntl.LOCK_EX)
+    #db.drop_all()
+    db.create_all()
+    # Tables added since a school's database was created
+    for school in db.shard_names()[1:]:
+        db.create_shard(school)
+    backfill_shard_directory()
+    for school in db.shard_names():
+        with db.shard_context(school):
+            backfill_join_codes()
+    seed_default_content()
+    seed_question_templates()
+    seed_free_response_questions()
+    assign_part_slots()
+    if not CourseProgress.query.first():
+        migrate_progress()
+    backfill_points_ledger()
+    backfill_points_buckets()
+    # Backups cover every school, so they are scheduled on the default shard's queue
+    schedule_backup()
+    db.session.commit()
+
 
 # ---------- RUN APP ----------
 if __name__ == "__main__":
+    # Development server: run jobs in-process instead of `flask run-jobs`
+    jobs.start_threads(1)
     app.run(debug=True, host="0.0.0.0")
@@ -0,0 +1,224 @@
+"""Compressed archive for cold rows (closed terms and classrooms).
+
+Rows moved out of the live database are kept in a separate SQLite file per
+school shard (ARCHIVE_DIR/<shard>.db) as chunks: up to ARCHIVE_CHUNK_ROWS rows
+of one source table and classroom, serialised as JSON and zlib-compressed.
+Each chunk records the smallest and largest value of a sort key (a date, a
+timestamp or an id), so readers decompress only the chunks that can hold
+what they want. Decompressed chunks are kept in a small per-worker LRU.
+A source can also be indexed by one integer field (index()): archive_index
+then lists the chunks holding each value, and rows_by() reads just those,
+whatever classroom they were filed under. Reads never create the archive
+file; a school with nothing archived costs a stat() call.
+
+This is the slow read path: it is for old calendar months, old submissions
+and the forum history of closed classrooms, not for anything on the hot path.
+Archival writes a chunk before the live rows are deleted; if it is
+interrupted in between, the rows are archived again next time and readers
+drop the duplicates by id.
+
+vacuum() returns the space freed in the live database to the filesystem.
+"""
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from sharding import current_shard
+
+CHUNK_CACHE_SIZE = 64
+
+metadata = sa.MetaData()
+chunks = sa.Table(
+    "archive_chunk",
+    metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("source", sa.String(50), nullable=False),  # live table name
+    sa.Column("classroom_id", sa.Integer),
+    sa.Column("min_key", sa.String(40), nullable=False),
+    sa.Column("max_key", sa.String(40), nullable=False),
+    sa.Column("row_count", sa.Integer, nullable=False),
+    sa.Column("archived_at", sa.DateTime, nullable=False),
+    sa.Column("data", sa.LargeBinary, nullable=False),
+    sa.Index("ix_archive_chunk_lookup", "source", "classroom_id", "max_key"),
+)
+index_entries = sa.Table(
+    "archive_index",
+    metadata,
+    sa.Column("chunk_id", sa.Integer, nullable=False),
+    sa.Column("value", sa.Integer, nullable=False),
+    sa.Index("ix_archive_index_value", "value", "chunk_id", unique=True),
+)
+
+
+def _sort_key(value):
+    # ISO dates and timestamps sort as text; ids are zero-padded to do the same
+    if isinstance(value, int):
+        return f"{value:020d}"
+    return str(value)
+
+
+class Archive:
+    def __init__(self, app=None):
+        self._engines = {}
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self.indexed = {}  # source -> indexed field
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ARCHIVE_DIR", os.path.join(app.instance_path, "archive"))
+        app.config.setdefault("ARCHIVE_CHUNK_ROWS", 1000)
+        app.config.setdefault("ARCHIVE_COMPRESS_LEVEL", 9)
+        self.app = app
+        os.makedirs(app.config["ARCHIVE_DIR"], exist_ok=True)
+
+    def index(self, source, field):
+        """Index archived rows of `source` by an integer field, for rows_by()."""
+        self.indexed[source] = field
+
+    def engine(self, create=True):
+        """The archive database of the current shard, created on first use.
+
+        With create=False, None when this shard has no archive yet.
+        """
+        shard = current_shard()
+        engine = self._engines.get(shard)
+        if engine is None:
+            path = os.path.join(self.app.config["ARCHIVE_DIR"], f"{shard}.db")
+            if not create and not os.path.exists(path):
+                return None
+            with self._lock:
+                engine = self._engines.get(shard)
+                if engine is None:
+                    engine = sa.create_engine(f"sqlite:///{path}")
+                    unindexed = not sa.inspect(engine).has_table("archive_index")
+                    metadata.create_all(engine)
+                    if unindexed:
+                        self._reindex(engine)
+                    self._engines[shard] = engine
+        return engine
+
+    def _reindex(self, engine):
+        # Archives written before archive_index existed: index their chunks once
+        with engine.begin() as conn:
+            for source, field in self.indexed.items():
+                for chunk_id, data in conn.execute(
+                    sa.select(chunks.c.id, chunks.c.data).where(chunks.c.source == source)
+                ):
+                    self._index_chunk(conn, chunk_id, json.loads(zlib.decompress(data)), field)
+
+    @staticmethod
+    def _index_chunk(conn, chunk_id, rows, field):
+        values = {row[field] for row in rows if row.get(field) is not None}
+        if values:
+            conn.execute(index_entries.insert(), [{"chunk_id": chunk_id, "value": v} for v in values])
+
+    # ---------- writing ----------
+    def store(self, source, classroom_id, rows, key):
+        """Append rows (dicts with an "id") of one source table and classroom, sorted by `key`."""
+        rows = sorted(rows, key=lambda row: _sort_key(row[key]))
+        size = self.app.config["ARCHIVE_CHUNK_ROWS"]
+        field = self.indexed.get(source)
+        now = datetime.utcnow()
+        with self.engine().begin() as conn:
+            for start in range(0, len(rows), size):
+                part = rows[start:start + size]
+                data = json.dumps(part, default=str, separators=(",", ":")).encode()
+                chunk_id = conn.execute(chunks.insert().values(
+                    source=source,
+                    classroom_id=classroom_id,
+                    min_key=_sort_key(part[0][key]),
+                    max_key=_sort_key(part[-1][key]),
+                    row_count=len(part),
+                    archived_at=now,
+                    data=zlib.compress(data, self.app.config["ARCHIVE_COMPRESS_LEVEL"]),
+                )).inserted_primary_key[0]
+                if field is not None:
+                    self._index_chunk(conn, chunk_id, part, field)
+
+    # ---------- reading ----------
+    def _chunk_rows(self, chunk_id, data):
+        key = (current_shard(), chunk_id)
+        with self._lock:
+            rows = self._cache.get(key)
+            if rows is not None:
+                self._cache.move_to_end(key)
+                return rows
+        rows = json.loads(zlib.decompress(data))
+        with self._lock:
+            self._cache[key] = rows
+            while len(self._cache) > CHUNK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return rows
+
+    def rows(self, source, classroom_id, key_from=None, key_to=None, where=None):
+        """Archived rows of a source table and classroom, optionally within a key range.
+
+        Rows come back as dicts with dates and timestamps as ISO strings.
+        """
+        query = sa.select(chunks.c.id, chunks.c.data).where(
+            chunks.c.source == source, chunks.c.classroom_id == classroom_id
+        )
+        if key_from is not None:
+            query = query.where(chunks.c.max_key >= _sort_key(key_from))
+        if key_to is not None:
+            query = query.where(chunks.c.min_key <= _sort_key(key_to))
+        return self._read(query, where)
+
+    def rows_by(self, source, value, where=None):
+        """Archived rows of an indexed source whose indexed field equals `value`."""
+        field = self.indexed[source]
+        query = sa.select(chunks.c.id, chunks.c.data).join(
+            index_entries, index_entries.c.chunk_id == chunks.c.id
+        ).where(chunks.c.source == source, index_entries.c.value == value)
+        return self._read(query, lambda row: row[field] == value and (where is None or where(row)))
+
+    def _read(self, query, where):
+        engine = self.engine(create=False)
+        if engine is None:
+            return
+        seen = set()
+        with engine.connect() as conn:
+            found = conn.execute(query.order_by(chunks.c.min_key, chunks.c.id)).all()
+        for chunk_id, data in found:
+            for row in self._chunk_rows(chunk_id, data):
+                if row["id"] in seen or (where is not None and not where(row)):
+                    continue
+                seen.add(row["id"])
+                yield row
+
+    def stats(self):
+        """[(source, chunks, rows, compressed bytes)] for the current shard."""
+        with self.engine().connect() as conn:
+            return conn.execute(
+                sa.select(
+                    chunks.c.source,
+                    sa.func.count(),
+                    sa.func.sum(chunks.c.row_count),
+                    sa.func.sum(sa.func.length(chunks.c.data)),
+                ).group_by(chunks.c.source)
+            ).all()
+
+
+def vacuum(engine):
+    """Give free pages of the main database back to the filesystem; returns bytes freed.
+
+    The first run switches the file to incremental auto-vacuum, which needs
+    one full VACUUM; later runs only release the free pages.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        page_size = conn.exec_driver_sql("PRAGMA main.page_size").scalar()
+        before = conn.exec_driver_sql("PRAGMA main.page_count").scalar()
+        if conn.exec_driver_sql("PRAGMA main.auto_vacuum").scalar() != 2:
+            conn.exec_driver_sql("PRAGMA main.auto_vacuum = INCREMENTAL")
+            conn.exec_driver_sql("VACUUM main")
+        else:
+            conn.exec_driver_sql("PRAGMA main.incremental_vacuum")
+        after = conn.exec_driver_sql("PRAGMA main.page_count").scalar()
+    return (before - after) * page_size
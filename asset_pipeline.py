@@ -0,0 +1,341 @@
+"""Self-hosted CSS/JS bundles: purged, minified, fingerprinted, precompressed.
+
+Sources live in assets/ (Bootstrap is vendored in assets/vendor). Building
+a bundle:
+
+1. concatenates its source files (BUNDLES);
+2. for CSS, drops every rule whose selectors all use a class that appears in
+   no template or script (SAFELIST covers classes built at runtime), then
+   minifies; JS gets comment and indentation stripping;
+3. writes <name>.<content hash>.<ext> to ASSETS_DIR with .gz and .br
+   siblings (brotli is optional; without it only gzip is produced) and
+   records the file names in manifest.json.
+
+Templates link bundles with asset_url("app.css"). /assets/<file> serves
+the smallest encoding the client accepts, with a one-year immutable cache
+lifetime since the name changes whenever the content does. The build runs
+on startup when a source or template is newer than the manifest, or with
+`flask build-assets`.
+"""
+import glob
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import abort, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+BUNDLES = {
+    "app.css": ["vendor/bootstrap-5.1.3.min.css", "css/app.css", "css/video-facade.css"],
+    "app.js": ["js/video-facade.js", "js/offline.js"],
+}
+# Classes that only appear in templates through expressions (e.g. alert-{{ category }})
+SAFELIST = {
+    "alert-success", "alert-danger", "alert-warning", "alert-info", "alert-secondary",
+    "active", "show", "fade", "disabled",
+}
+MANIFEST = "manifest.json"
+# Nested at-rules whose bodies are themselves rule lists
+GROUPING_AT_RULES = ("@media", "@supports", "@layer", "@document")
+
+_CLASS_ATTR = re.compile(r"""class\s*=\s*(["'])(.*?)\1""", re.S)
+_IDENT = re.compile(r"-?[_a-zA-Z][\w-]*")
+_SELECTOR_CLASS = re.compile(r"\.(-?[_a-zA-Z][\w-]*)")
+_NOT = re.compile(r":not\([^()]*\)")
+
+
+# ---------- CSS ----------
+def _split_top(text, sep):
+    """Split on `sep` outside strings, parentheses and brackets."""
+    parts, depth, quote, start = [], 0, None, 0
+    for i, ch in enumerate(text):
+        if quote:
+            if ch == quote and text[i - 1] != "\\":
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch in "([":
+            depth += 1
+        elif ch in ")]":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def _strip_comments(css):
+    """Drop comments, keeping /*! license */ blocks."""
+    return re.sub(r"/\*(?!!).*?\*/", "", css, flags=re.S)
+
+
+def parse_css(css):
+    """[(prelude, body)]: body is a declaration string or, for @media etc., a nested list."""
+    rules, i, n = [], 0, len(css)
+    while i < n:
+        # Find the end of the prelude: "{" opens a block, ";" ends a statement (@import, @charset)
+        j, quote = i, None
+        while j < n:
+            ch = css[j]
+            if quote:
+                if ch == quote and css[j - 1] != "\\":
+                    quote = None
+            elif ch in "\"'":
+                quote = ch
+            elif ch == "/" and css.startswith("/*", j):
+                j = css.find("*/", j + 2)
+                j = n if j < 0 else j + 1
+            elif ch in "{;":
+                break
+            j += 1
+        prelude = css[i:j].strip()
+        if j >= n:
+            break
+        if css[j] == ";":
+            if prelude:
+                rules.append((prelude, None))
+            i = j + 1
+            continue
+        # Matching close brace
+        depth, k, quote = 1, j + 1, None
+        while k < n and depth:
+            ch = css[k]
+            if quote:
+                if ch == quote and css[k - 1] != "\\":
+                    quote = None
+            elif ch in "\"'":
+                quote = ch
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+            k += 1
+        body = css[j + 1:k - 1]
+        if prelude.lower().startswith(GROUPING_AT_RULES):
+            rules.append((prelude, parse_css(body)))
+        else:
+            rules.append((prelude, body))
+        i = k
+    return rules
+
+
+def _selector_used(selector, used):
+    return all(name in used for name in _SELECTOR_CLASS.findall(_NOT.sub("", selector)))
+
+
+def purge(rules, used):
+    """Keep the selectors whose classes are all in `used`; drop rules left empty."""
+    kept = []
+    for prelude, body in rules:
+        if isinstance(body, list):
+            body = purge(body, used)
+            if body:
+                kept.append((prelude, body))
+        elif body is None or prelude.startswith("@"):
+            kept.append((prelude, body))  # @font-face, @keyframes, @charset ...
+        else:
+            selectors = [s for s in _split_top(prelude, ",") if _selector_used(s, used)]
+            if selectors:
+                kept.append((",".join(selectors), body))
+    return kept
+
+
+def _minify_prelude(prelude):
+    if prelude.startswith("/*!"):
+        end = prelude.index("*/") + 2
+        return prelude[:end] + _minify_prelude(prelude[end:].strip())
+    prelude = re.sub(r"\s+", " ", prelude.strip())
+    return re.sub(r"\s*([,>~{}])\s*", r"\1", prelude)
+
+
+def _minify_declarations(body):
+    declarations = []
+    for declaration in _split_top(body, ";"):
+        if ":" not in declaration:
+            continue
+        prop, value = declaration.split(":", 1)
+        value = re.sub(r"\s+", " ", value.strip())
+        value = re.sub(r"\s*!important", "!important", value)
+        declarations.append(f"{prop.strip()}:{value}")
+    return ";".join(declarations)
+
+
+def render_css(rules):
+    out = []
+    for prelude, body in rules:
+        prelude = _minify_prelude(prelude)
+        if body is None:
+            out.append(prelude + ";")
+        elif isinstance(body, list):
+            out.append(prelude + "{" + render_css(body) + "}")
+        elif prelude.lower().startswith("@keyframes") or prelude.lower().startswith("@-webkit-keyframes"):
+            out.append(prelude + "{" + render_css(parse_css(body)) + "}")
+        else:
+            out.append(prelude + "{" + _minify_declarations(body) + "}")
+    return "".join(out)
+
+
+def build_css(sources, used):
+    rules = parse_css(_strip_comments("\n".join(sources)))
+    # Only one @charset is allowed, and it must come first
+    charset = [r for r in rules if r[0].lower().startswith("@charset")][:1]
+    rules = charset + [r for r in rules if not r[0].lower().startswith("@charset")]
+    return render_css(purge(rules, used))
+
+
+# ---------- JS ----------
+def build_js(sources):
+    """Strip comments and indentation; newlines are kept so semicolon insertion is unaffected."""
+    out = []
+    for source in sources:
+        source = re.sub(r"/\*(?!!).*?\*/", "", source, flags=re.S)
+        for line in source.splitlines():
+            line = line.strip()
+            if line and not line.startswith("//"):
+                out.append(line)
+    return "\n".join(out) + "\n"
+
+
+# ---------- used classes ----------
+def used_classes(template_dirs, script_paths):
+    used = set(SAFELIST)
+    for directory in template_dirs:
+        for path in glob.glob(os.path.join(directory, "**", "*.html"), recursive=True):
+            with open(path, encoding="utf-8") as f:
+                for _, value in _CLASS_ATTR.findall(f.read()):
+                    used.update(_IDENT.findall(value))
+    for path in script_paths:
+        with open(path, encoding="utf-8") as f:
+            used.update(_IDENT.findall(f.read()))
+    return used
+
+
+class Assets:
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ASSETS_SOURCE_DIR", os.path.join(app.root_path, "assets"))
+        app.config.setdefault("ASSETS_DIR", os.path.join(app.instance_path, "assets"))
+        app.config.setdefault("ASSETS_AUTO_BUILD", True)
+        app.config.setdefault("ASSETS_MAX_AGE", 365 * 24 * 3600)
+        self.app = app
+        self.source_dir = app.config["ASSETS_SOURCE_DIR"]
+        self.directory = app.config["ASSETS_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+
+        if app.config["ASSETS_AUTO_BUILD"] and self.stale():
+            self.build()
+        else:
+            self.load()
+
+        app.add_template_global(self.url, "asset_url")
+
+        @app.route("/assets/<filename>")
+        def asset(filename):
+            if filename not in self.manifest.values():
+                abort(404)
+            return self.send(filename)
+
+        @app.cli.command("build-assets")
+        def build_assets_command():
+            """Rebuild the CSS/JS bundles."""
+            for name, built in self.build().items():
+                size = os.path.getsize(os.path.join(self.directory, built))
+                click.echo(f"{name} -> {built} ({size} bytes)")
+
+    # ---------- build ----------
+    def _inputs(self):
+        paths = [os.path.join(self.source_dir, src) for sources in BUNDLES.values() for src in sources]
+        paths += glob.glob(os.path.join(self.app.root_path, self.app.template_folder, "**", "*.html"), recursive=True)
+        return paths
+
+    def stale(self):
+        manifest = os.path.join(self.directory, MANIFEST)
+        if not os.path.exists(manifest):
+            return True
+        built = os.path.getmtime(manifest)
+        return any(os.path.getmtime(p) > built for p in self._inputs() if os.path.exists(p))
+
+    def load(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def build(self):
+        self.load()
+        template_dir = os.path.join(self.app.root_path, self.app.template_folder)
+        scripts = [os.path.join(self.source_dir, src) for src in BUNDLES.get("app.js", [])]
+        used = used_classes([template_dir], scripts)
+
+        manifest = {}
+        for name, sources in BUNDLES.items():
+            texts = []
+            for src in sources:
+                with open(os.path.join(self.source_dir, src), encoding="utf-8") as f:
+                    texts.append(f.read())
+            content = build_css(texts, used) if name.endswith(".css") else build_js(texts)
+            data = content.encode("utf-8")
+            stem, ext = os.path.splitext(name)
+            built = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            self._write(built, data)
+            self._write(built + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                self._write(built + ".br", brotli.compress(data, quality=11))
+            manifest[name] = built
+
+        old = set(self.manifest.values())
+        self._write(MANIFEST, json.dumps(manifest, indent=2).encode())
+        self.manifest = manifest
+        # Keep the previous build too: pages rendered before a deploy may still ask for it
+        for path in glob.glob(os.path.join(self.directory, "*.*.*")):
+            base = os.path.basename(path).split(".gz")[0].split(".br")[0]
+            if base not in old and base not in manifest.values():
+                os.remove(path)
+        return manifest
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    # ---------- serving ----------
+    def url(self, name):
+        built = self.manifest.get(name)
+        if built is None:
+            raise KeyError(f"unknown asset bundle {name!r}")
+        return url_for("asset", filename=built)
+
+    def send(self, filename):
+        path = os.path.join(self.directory, filename)
+        encoding = None
+        for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if request.accept_encodings[candidate] and os.path.exists(path + suffix):
+                encoding, path = candidate, path + suffix
+                break
+        response = send_file(
+            path,
+            mimetype=mimetypes.guess_type(filename)[0],
+            max_age=self.app.config["ASSETS_MAX_AGE"],
+            etag=True,
+        )
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.cache_control.immutable = True
+        return response
@@ -0,0 +1,91 @@
+// Offline mode for students (see templates/sw.js): exercise answers go through
+// the service worker, which submits them now or queues them until the
+// connection is back. Without a service worker the forms post as usual.
+(function () {
+    var body = document.body;
+    if (!("serviceWorker" in navigator) || !body || !body.dataset.offlineOwner) {
+        return;
+    }
+    var owner = body.dataset.offlineOwner;
+    navigator.serviceWorker.register("/sw.js");
+
+    function ask(message) {
+        return new Promise(function (resolve, reject) {
+            var worker = navigator.serviceWorker.controller;
+            if (!worker) {
+                reject(new Error("no service worker yet"));
+                return;
+            }
+            var channel = new MessageChannel();
+            channel.port1.onmessage = function (event) { resolve(event.data); };
+            worker.postMessage(message, [channel.port2]);
+        });
+    }
+
+    function replaceForm(form, category, text) {
+        var alert = document.createElement("div");
+        alert.className = "alert alert-" + category;
+        alert.textContent = text;
+        form.replaceWith(alert);
+        return alert;
+    }
+
+    function showResult(form, result) {
+        if (result.queued) {
+            var alert = replaceForm(form, "warning", "Saved on this device. Your answers will be submitted when you are back online.");
+            alert.dataset.offlinePending = form.dataset.offlineSubmit;
+        } else if (result.error) {
+            replaceForm(form, "danger", result.error);
+        } else {
+            replaceForm(form, "success", "Score: " + result.correct + " / " + result.total);
+        }
+    }
+
+    document.addEventListener("submit", function (event) {
+        var form = event.target.closest("form[data-offline-submit]");
+        if (!form || !navigator.serviceWorker.controller) {
+            return;
+        }
+        event.preventDefault();
+        form.querySelectorAll("button").forEach(function (button) { button.disabled = true; });
+        ask({ type: "submit", url: form.dataset.offlineSubmit, fields: Array.from(new FormData(form).entries()), owner: owner })
+            .then(function (result) { showResult(form, result); }, function () { form.submit(); });
+    });
+
+    // A queued submission went through (or was given up): show the outcome where it is on screen
+    navigator.serviceWorker.addEventListener("message", function (event) {
+        if (event.data.type !== "synced") {
+            return;
+        }
+        var result = event.data.result;
+        document.querySelectorAll("[data-offline-pending]").forEach(function (alert) {
+            if (alert.dataset.offlinePending === event.data.url) {
+                // Submitted, or given up on after repeated failures
+                alert.className = "alert alert-" + (result.error ? "danger" : "success");
+                alert.textContent = result.error || "Score: " + result.correct + " / " + result.total;
+                delete alert.dataset.offlinePending;
+            }
+        });
+    });
+
+    function start() {
+        ask({ type: "pending", owner: owner }).then(function (urls) {
+            document.querySelectorAll("form[data-offline-submit]").forEach(function (form) {
+                if (urls.indexOf(form.dataset.offlineSubmit) !== -1) {
+                    showResult(form, { queued: true });
+                }
+            });
+            return ask({ type: "flush" });
+        }).catch(function () {});
+        if (body.dataset.offlineManifest) {
+            ask({ type: "precache", manifest: body.dataset.offlineManifest }).catch(function () {});
+        }
+    }
+
+    if (navigator.serviceWorker.controller) {
+        start();
+    } else {
+        navigator.serviceWorker.addEventListener("controllerchange", start);
+    }
+    window.addEventListener("online", function () { ask({ type: "flush" }).catch(function () {}); });
+})();
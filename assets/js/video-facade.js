@@ -0,0 +1,14 @@
+// Swap a .video-facade placeholder for the real YouTube player on click.
+document.addEventListener("click", function (event) {
+    var facade = event.target.closest(".video-facade");
+    if (!facade || facade.querySelector("iframe")) {
+        return;
+    }
+    var iframe = document.createElement("iframe");
+    iframe.src = "https://www.youtube-nocookie.com/embed/" + facade.dataset.videoId + "?autoplay=1";
+    iframe.title = facade.getAttribute("aria-label") || "Video";
+    iframe.allow = "accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture";
+    iframe.allowFullscreen = true;
+    facade.style.backgroundImage = "none";
+    facade.appendChild(iframe);
+});
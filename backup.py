@@ -0,0 +1,278 @@
+"""Online snapshots of every SQLite database, and fast restore.
+
+A snapshot is a directory BACKUP_DIR/<UTC timestamp>/ holding a copy of the
+main database (the catalog and the default school), every school shard and
+every cold archive, plus manifest.json with each file's SHA-256 and size.
+
+Copies use SQLite's online backup API in steps of BACKUP_PAGES_PER_STEP pages,
+pausing BACKUP_STEP_PAUSE seconds between steps. A step only holds a shared
+lock, so writers wait at most one step, never for the whole copy. If another
+connection writes to the database mid-copy, SQLite restarts the copy, and the
+snapshot is always consistent. Databases are copied one after another, so a
+snapshot is consistent per file, not across files.
+
+Snapshots are incremental: a database whose size and modification time are
+unchanged since the previous snapshot is hard-linked from it instead of read
+again, which makes idle shards and archives free. A linked file is one file
+on disk shared by several snapshots, so copy snapshots off the machine for
+disaster recovery. Snapshots are written to a ".partial" directory that is
+renamed when complete, and only the newest BACKUP_KEEP are kept.
+
+restore() first verifies every checksum. It then copies each file back with
+the backup API in a single step, so running workers see the restored data on
+their next query without a restart; their in-memory caches may still hold
+old values for a while.
+
+    flask backup                        take a snapshot now
+    flask list-backups
+    flask verify-backup [NAME]
+    flask restore-backup NAME           disaster recovery, or reset staging/bench
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+import click
+
+MANIFEST = "manifest.json"
+PARTIAL = ".partial"
+ABANDONED_AFTER = 24 * 3600  # a partial snapshot this old was interrupted
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BackupError(Exception):
+    pass
+
+
+class Backups:
+    def __init__(self, app=None, db=None, metrics=None):
+        self.metrics = metrics
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault("BACKUP_DIR", os.path.join(app.instance_path, "backups"))
+        app.config.setdefault("BACKUP_INTERVAL", 6 * 3600)  # seconds between scheduled snapshots; 0 = off
+        app.config.setdefault("BACKUP_KEEP", 28)
+        app.config.setdefault("BACKUP_PAGES_PER_STEP", 256)
+        app.config.setdefault("BACKUP_STEP_PAUSE", 0.005)
+        self.app = app
+        self.db = db
+        self.directory = app.config["BACKUP_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+        if self.metrics is not None:
+            self.metrics.add_collector(self._backup_gauges)
+        self._register_commands(app)
+
+    # ---------- what to back up ----------
+    def databases(self):
+        """{name in the snapshot: live path} of every database file the app owns."""
+        db = self.db
+        main = db.catalog_engine if hasattr(db, "catalog_engine") else db.engine
+        files = {"main.db": main.url.database}
+        for shard in getattr(db, "shard_names", lambda: [])()[1:]:
+            files[f"shards/{shard}.db"] = db.shard_path(shard)
+        archive_dir = self.app.config.get("ARCHIVE_DIR")
+        if archive_dir and os.path.isdir(archive_dir):
+            for name in sorted(os.listdir(archive_dir)):
+                if name.endswith(".db"):
+                    files[f"archive/{name}"] = os.path.join(archive_dir, name)
+        return files
+
+    # ---------- snapshots ----------
+    def snapshots(self):
+        """Complete snapshot names, oldest first."""
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if os.path.exists(os.path.join(self.directory, name, MANIFEST))
+        )
+
+    def manifest(self, name):
+        path = os.path.join(self.directory, name, MANIFEST)
+        if not os.path.exists(path):
+            raise BackupError(f"no such snapshot: {name}")
+        with open(path) as f:
+            return json.load(f)
+
+    def _copy_online(self, source, target, pages):
+        pause = self.app.config["BACKUP_STEP_PAUSE"]
+
+        def between_steps(status, remaining, total):
+            if pause and remaining:
+                time.sleep(pause)  # let writers in
+
+        src = sqlite3.connect(f"file:{source}?mode=ro", uri=True, timeout=30)
+        dst = sqlite3.connect(target, timeout=30)
+        try:
+            src.backup(dst, pages=pages, progress=between_steps)
+        finally:
+            dst.close()
+            src.close()
+
+    def snapshot(self):
+        """Take a snapshot of every database; returns its name."""
+        started = time.monotonic()
+        name = datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+        work = os.path.join(self.directory, name + PARTIAL)
+        previous = self.snapshots()
+        before = self.manifest(previous[-1])["databases"] if previous else {}
+        os.makedirs(work)
+
+        entries = {}
+        for logical, source in self.databases().items():
+            if not os.path.exists(source):
+                continue
+            target = os.path.join(work, logical)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            stat = os.stat(source)
+            old = before.get(logical)
+            # A journal next to the file means a write is in progress: copy it
+            unchanged = (
+                old is not None
+                and not os.path.exists(source + "-journal")
+                and (old["source_size"], old["source_mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+            )
+            if unchanged:
+                try:
+                    os.link(os.path.join(self.directory, previous[-1], logical), target)
+                    entries[logical] = {**old, "copied": False}
+                    continue
+                except OSError:
+                    pass
+            self._copy_online(source, target, self.app.config["BACKUP_PAGES_PER_STEP"])
+            entries[logical] = {
+                "sha256": _sha256(target),
+                "bytes": os.path.getsize(target),
+                "source_size": stat.st_size,
+                "source_mtime_ns": stat.st_mtime_ns,
+                "copied": True,
+            }
+
+        with open(os.path.join(work, MANIFEST), "w") as f:
+            json.dump({
+                "created": datetime.utcnow().isoformat(),
+                "seconds": round(time.monotonic() - started, 3),
+                "databases": entries,
+            }, f, indent=2)
+        os.rename(work, os.path.join(self.directory, name))
+        return name
+
+    def prune(self):
+        """Delete all but the newest BACKUP_KEEP snapshots (0 keeps all), and abandoned partial ones."""
+        removed = []
+        keep = self.app.config["BACKUP_KEEP"]
+        names = self.snapshots()
+        stale = names[:-keep] if keep else []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(PARTIAL) and time.time() - os.path.getmtime(path) > ABANDONED_AFTER:
+                stale.append(name)
+        for name in stale:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            removed.append(name)
+        return removed
+
+    def verify(self, name):
+        """Names of the files of a snapshot whose checksum does not match."""
+        bad = []
+        for logical, entry in self.manifest(name)["databases"].items():
+            path = os.path.join(self.directory, name, logical)
+            if not os.path.exists(path) or _sha256(path) != entry["sha256"]:
+                bad.append(logical)
+        return bad
+
+    # ---------- restore ----------
+    def _live_path(self, logical):
+        folder, _, filename = logical.rpartition("/")
+        if not folder:
+            return self.databases()["main.db"]
+        if folder == "shards":
+            return os.path.join(self.app.config["SHARD_DIR"], filename)
+        if folder == "archive":
+            return os.path.join(self.app.config["ARCHIVE_DIR"], filename)
+        raise BackupError(f"unknown database in snapshot: {logical}")
+
+    def restore(self, name):
+        """Bring every database of a snapshot back online; returns the restored names.
+
+        Databases created after the snapshot (a newer school) are left as they are.
+        """
+        bad = self.verify(name)
+        if bad:
+            raise BackupError(f"snapshot {name} is damaged: {', '.join(bad)}")
+        restored = []
+        for logical in self.manifest(name)["databases"]:
+            target = self._live_path(logical)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # One step: the target is locked once, briefly, instead of per page
+            self._copy_online(os.path.join(self.directory, name, logical), target, -1)
+            restored.append(logical)
+        return restored
+
+    # ---------- metrics ----------
+    def _backup_gauges(self):
+        names = self.snapshots()
+        yield "backup_snapshots", None, len(names)
+        if names:
+            created = datetime.fromisoformat(self.manifest(names[-1])["created"])
+            yield "backup_last_snapshot_age_seconds", None, max((datetime.utcnow() - created).total_seconds(), 0.0)
+
+    # ---------- commands ----------
+    def _register_commands(self, app):
+        @app.cli.command("backup")
+        @click.option("--no-prune", is_flag=True, help="keep snapshots beyond BACKUP_KEEP")
+        def backup_command(no_prune):
+            """Take a snapshot of every database now."""
+            name = self.snapshot()
+            manifest = self.manifest(name)
+            copied = sum(e["copied"] for e in manifest["databases"].values())
+            click.echo(
+                f"Snapshot {name}: {len(manifest['databases'])} database(s), "
+                f"{copied} copied, the rest unchanged, in {manifest['seconds']}s."
+            )
+            if not no_prune:
+                for old in self.prune():
+                    click.echo(f"  removed {old}")
+
+        @app.cli.command("list-backups")
+        def list_backups():
+            """Show the snapshots, oldest first."""
+            for name in self.snapshots():
+                manifest = self.manifest(name)
+                size = sum(e["bytes"] for e in manifest["databases"].values())
+                click.echo(f"{name}  {len(manifest['databases']):>3} database(s)  {size // 1024:>10} KiB")
+
+        @app.cli.command("verify-backup")
+        @click.argument("name", required=False)
+        def verify_backup(name):
+            """Check the checksums of one snapshot, or of all of them."""
+            failed = False
+            for snapshot in [name] if name else self.snapshots():
+                bad = self.verify(snapshot)
+                failed = failed or bool(bad)
+                click.echo(f"{snapshot}: " + ("damaged: " + ", ".join(bad) if bad else "ok"))
+            if failed:
+                raise SystemExit(1)
+
+        @app.cli.command("restore-backup")
+        @click.argument("name")
+        @click.confirmation_option(prompt="Replace the live databases with this snapshot?")
+        def restore_backup(name):
+            """Replace the live databases with snapshot NAME."""
+            started = time.monotonic()
+            try:
+                restored = self.restore(name)
+            except BackupError as e:
+                raise click.ClickException(str(e))
+            click.echo(f"Restored {len(restored)} database(s) from {name} in {time.monotonic() - started:.1f}s.")
@@ -0,0 +1,17 @@
+"""Benchmark tooling: a synthetic school generator, a load driver and a
+stand-in model server for the chapter tutor (bench.fake_llm).
+
+Both scripts point the app at their own database through DATABASE_URL before
+importing it, so they never touch instance/database.db.
+
+    python -m bench.synthetic_school --db instance/bench.db --classrooms 40
+    python -m bench.load_test --db instance/bench.db --users 20 --duration 30
+"""
+import os
+
+
+def use_database(path):
+    """Point app.py at `path` (must run before `import app`)."""
+    path = os.path.abspath(path)
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    return path
@@ -0,0 +1,94 @@
+"""Local stand-in for the tutor's model server.
+
+Speaks just enough of the OpenAI chat completions API (POST
+/v1/chat/completions, streamed or not) for tutor.OpenAIChatBackend: it
+answers every question with a canned explanation after --first-token
+seconds, one word every --token-delay seconds, like a real model would.
+Lets the tutor run in development and under load without an API key.
+
+    python -m bench.fake_llm --port 8089 --first-token 0.5 --token-delay 0.03
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = (
+    "Good question! Start from the definition used in this chapter and write down "
+    "what you are given and what you need to find. Try a simpler example first, "
+    "check each step, and then apply the same idea to your problem. "
+    "You asked: {question}"
+)
+
+
+def make_handler(first_token, token_delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            question = next(
+                (m["content"] for m in reversed(body.get("messages", [])) if m.get("role") == "user"), ""
+            )
+            words = ANSWER.format(question=question).split(" ")
+            time.sleep(first_token)
+
+            if not body.get("stream"):
+                time.sleep(token_delay * len(words))
+                self._send_json({"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for i, word in enumerate(words):
+                    self._chunk({"choices": [{"delta": {"content": word if i == 0 else " " + word}}]})
+                    time.sleep(token_delay)
+                self._chunk("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the app stopped reading: its student left
+
+        def _chunk(self, payload):
+            data = payload if isinstance(payload, str) else json.dumps(payload)
+            event = f"data: {data}\n\n".encode()
+            self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+
+        def _send_json(self, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--first-token", type=float, default=0.5, help="seconds before the first word")
+    parser.add_argument("--token-delay", type=float, default=0.03, help="seconds between words")
+    args = parser.parse_args(argv)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.first_token, args.token_delay))
+    print(f"Fake model server on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Scripted load driver for the hot routes.
+
+Runs virtual students against the app in-process (Flask test client, one per
+thread) and reports p50/p95/p99 latency, throughput and SQL statements per
+request for each route, plus how many requests tripped the query_stats N+1
+detector. Generate a database with bench.synthetic_school first.
+
+    python -m bench.load_test --db instance/bench.db --users 20 --duration 30 --json bench_output.json
+    python -m bench.load_test --db instance/bench.db --baseline bench_output.json
+
+With --baseline the run exits non-zero if any route's p95 latency or mean query
+count regressed by more than --max-regression.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import query_stats
+from bench import use_database
+from bench.synthetic_school import BENCH_PASSWORD
+
+ROUTES = ("login", "student_dashboard", "chapter_page", "submit_part", "leaderboard", "forum", "calendar")
+
+# Relative frequency of each route in the request mix.
+DEFAULT_MIX = {
+    "login": 1,
+    "student_dashboard": 6,
+    "chapter_page": 8,
+    "submit_part": 2,
+    "leaderboard": 2,
+    "forum": 3,
+    "calendar": 2,
+}
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.n_plus_one = defaultdict(int)
+
+    def record(self, route, seconds, stats, status):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            self.queries[route].append(stats.count)
+            self.statuses[route][status] += 1
+            if stats.repeated():
+                self.n_plus_one[route] += 1
+
+    def summary(self, wall_time):
+        report = {"wall_time": wall_time, "routes": {}}
+        total = 0
+        for route in ROUTES:
+            samples = sorted(self.latencies.get(route, []))
+            if not samples:
+                continue
+            total += len(samples)
+            queries = self.queries[route]
+            report["routes"][route] = {
+                "requests": len(samples),
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "mean_queries": sum(queries) / len(queries),
+                "max_queries": max(queries),
+                "n_plus_one_requests": self.n_plus_one[route],
+                "statuses": dict(self.statuses[route]),
+            }
+        report["requests"] = total
+        report["throughput_rps"] = total / wall_time if wall_time else 0.0
+        return report
+
+
+def load_students(mathwow, limit, rng):
+    """Pick bench students and precompute what each one can request."""
+    db = mathwow.db
+    students = (
+        mathwow.User.query.filter(mathwow.User.role == "student", mathwow.User.student_id.like("bench-s%"))
+        .filter(mathwow.User.classroom_id.isnot(None))
+        .all()
+    )
+    rng.shuffle(students)
+    profiles = []
+    for student in students[:limit]:
+        chapters = (
+            db.session.query(mathwow.Chapter.id)
+            .join(mathwow.classroom_course, mathwow.classroom_course.c.course_id == mathwow.Chapter.course_id)
+            .filter(mathwow.classroom_course.c.classroom_id == student.classroom_id)
+            .all()
+        )
+        chapter_ids = [c.id for c in chapters]
+        submitted = {
+            s.part_id for s in mathwow.PartSubmission.query.filter_by(student_id=student.id)
+        }
+        open_parts = []
+        if chapter_ids:
+            parts = mathwow.Part.query.filter(
+                mathwow.Part.chapter_id.in_(chapter_ids), mathwow.Part.type == "exercise"
+            ).all()
+            for part in parts:
+                if part.id not in submitted:
+                    open_parts.append((part.id, [q.id for q in part.questions]))
+        profiles.append({
+            "student_id": student.student_id,
+            "chapters": chapter_ids,
+            "open_parts": open_parts,
+        })
+    db.session.remove()
+    return profiles
+
+
+def login(client, profile):
+    return client.post(
+        "/login",
+        data={"role": "student", "email_or_id": profile["student_id"], "password": BENCH_PASSWORD},
+    )
+
+
+def run_request(route, client, profile, rng):
+    """Issue one request for `route`; returns the response or None if not applicable."""
+    if route == "login":
+        client.get("/logout")
+        return login(client, profile)
+    if route == "student_dashboard":
+        return client.get("/student_dashboard")
+    if route == "chapter_page":
+        if not profile["chapters"]:
+            return None
+        return client.get(f"/chapter/{rng.choice(profile['chapters'])}")
+    if route == "submit_part":
+        # PartSubmission is unique per (student, part): never submit a part twice.
+        if not profile["open_parts"]:
+            return None
+        part_id, question_ids = profile["open_parts"].pop()
+        answers = {f"q_{qid}": rng.choice("ABCD") for qid in question_ids}
+        return client.post(f"/submit_part/{part_id}", data=answers)
+    if route == "leaderboard":
+        return client.get("/leaderboard")
+    if route == "forum":
+        return client.get("/forum")
+    if route == "calendar":
+        return client.get("/calendar")
+    raise ValueError(f"unknown route {route!r}")
+
+
+def worker(mathwow, recorder, profile, mix, deadline, max_requests, seed):
+    rng = random.Random(seed)
+    routes, weights = zip(*mix.items())
+    client = mathwow.app.test_client()
+    login(client, profile)
+    sent = 0
+    while time.perf_counter() < deadline and (not max_requests or sent < max_requests):
+        route = rng.choices(routes, weights)[0]
+        with query_stats.track() as stats:
+            start = time.perf_counter()
+            response = run_request(route, client, profile, rng)
+            if response is not None:
+                # Streamed pages render while the body is read: time all of it,
+                # and close here so the request context is popped by this thread
+                response.get_data()
+                response.close()
+            elapsed = time.perf_counter() - start
+        if response is None:
+            continue
+        recorder.record(route, elapsed, stats, response.status_code)
+        sent += 1
+
+
+def run(mathwow, users=10, duration=10.0, requests_per_user=0, mix=None, seed=1):
+    rng = random.Random(seed)
+    mix = {route: weight for route, weight in (mix or DEFAULT_MIX).items() if weight > 0}
+    mathwow.app.config["SQL_STATS_LOG"] = False
+    # Virtual students submit far faster than real ones
+    mathwow.app.config["RATE_LIMIT_ENABLED"] = False
+    with mathwow.app.app_context():
+        profiles = load_students(mathwow, users, rng)
+    if not profiles:
+        raise SystemExit("No bench students found; run `python -m bench.synthetic_school` first.")
+
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(mathwow, recorder, profile, mix, deadline, requests_per_user, seed + i),
+        )
+        for i, profile in enumerate(profiles)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder.summary(time.perf_counter() - start)
+
+
+def print_report(report, out=sys.stdout):
+    header = f"{'route':<18}{'reqs':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'max q':>7}{'n+1':>6}  statuses"
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    for route, r in report["routes"].items():
+        statuses = ",".join(f"{k}:{v}" for k, v in sorted(r["statuses"].items()))
+        print(
+            f"{route:<18}{r['requests']:>7}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+            f"{r['mean_queries']:>9.1f}{r['max_queries']:>7}{r['n_plus_one_requests']:>6}  {statuses}",
+            file=out,
+        )
+    print(
+        f"\n{report['requests']} requests in {report['wall_time']:.1f}s "
+        f"({report['throughput_rps']:.1f} req/s)",
+        file=out,
+    )
+
+
+def compare(report, baseline, max_regression):
+    """Return a list of human readable regressions against a baseline report."""
+    problems = []
+    for route, r in report["routes"].items():
+        base = baseline.get("routes", {}).get(route)
+        if not base:
+            continue
+        for key in ("p95_ms", "mean_queries"):
+            if base[key] and r[key] > base[key] * (1 + max_regression):
+                problems.append(f"{route}: {key} {base[key]:.1f} -> {r[key]:.1f}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="instance/bench.db")
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual students")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop each user after N requests (0 = no limit)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json report")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed fractional slowdown")
+    args = parser.parse_args(argv)
+
+    use_database(args.db)
+    import app as mathwow
+
+    report = run(mathwow, users=args.users, duration=args.duration, requests_per_user=args.requests, seed=args.seed)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(report, json.load(f), args.max_regression)
+        if problems:
+            print("\nRegressions against baseline:")
+            for p in problems:
+                print("  " + p)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""Generate a synthetic school for benchmarking.
+
+Creates classrooms, teachers, students, courses, chapters, parts and questions,
+then fills in part submissions and progress bitsets, forum threads and
+calendar events at roughly the volumes a real school produces.
+
+Every generated account uses the password in BENCH_PASSWORD:
+students log in with student_id "bench-s<n>", teachers with "bench-t<n>@example.com".
+"""
+import argparse
+import os
+import random
+import string
+import sys
+from datetime import date, datetime, timedelta
+
+from bench import use_database
+
+BENCH_PASSWORD = "bench"
+
+
+def _video_id(rng):
+    return "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(11))
+
+
+def build_school(
+    classrooms=10,
+    students_per_class=30,
+    courses=3,
+    chapters_per_course=5,
+    parts_per_chapter=5,
+    questions_per_part=5,
+    submission_rate=0.6,
+    posts_per_class=20,
+    answers_per_post=3,
+    events_per_class=15,
+    seed=1234,
+):
+    """Insert the synthetic school into the database app.py is configured for.
+
+    Must be called inside an app context. Rows are inserted in bulk with explicit
+    ids so generating tens of thousands of students stays fast.
+    """
+    import app as mathwow
+    from werkzeug.security import generate_password_hash
+
+    db = mathwow.db
+    rng = random.Random(seed)
+    password = generate_password_hash(BENCH_PASSWORD, method="pbkdf2:sha256")
+    now = datetime.utcnow()
+
+    def next_id(model):
+        return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+    def insert(table, rows):
+        if rows:
+            db.session.execute(table.insert(), rows)
+
+    # --- Course content ---
+    course_rows, chapter_rows, part_rows, question_rows, note_rows = [], [], [], [], []
+    course_id, chapter_id = next_id(mathwow.Course), next_id(mathwow.Chapter)
+    part_id, question_id = next_id(mathwow.Part), next_id(mathwow.Question)
+    note_id = next_id(mathwow.LessonNote)
+    course_parts = {}  # course id -> [(part id, is_exercise)]
+
+    for c in range(courses):
+        course_rows.append({"id": course_id, "name": f"Bench Course {course_id}", "description": "Synthetic"})
+        course_parts[course_id] = []
+        for order in range(1, chapters_per_course + 1):
+            chapter_rows.append({"id": chapter_id, "course_id": course_id, "title": f"Chapter {order}", "order": order})
+            for p in range(parts_per_chapter):
+                is_exercise = p % 2 == 1
+                part_rows.append({
+                    "id": part_id,
+                    "chapter_id": chapter_id,
+                    "title": f"Part {p + 1}",
+                    "type": "exercise" if is_exercise else "teaching",
+                    "lesson_video": _video_id(rng),
+                })
+                note_rows.append({"id": note_id, "part_id": part_id, "pdf_url": "notes/Lesson 2 Notes.pdf"})
+                note_id += 1
+                if is_exercise:
+                    for q in range(questions_per_part):
+                        a, n = rng.randint(1, 9), rng.randint(2, 6)
+                        question_rows.append({
+                            "id": question_id,
+                            "part_id": part_id,
+                            "question_text": f"What is ∫ ({a}x + 1)^{n} dx?",
+                            "option_a": f"(1/{a * (n + 1)})({a}x + 1)^{n + 1} + C",
+                            "option_b": f"({a}x + 1)^{n + 1} + C",
+                            "option_c": f"{n}({a}x + 1)^{n - 1} + C",
+                            "option_d": f"(1/{n + 1})({a}x + 1)^{n + 1} + C",
+                            "correct_answer": "A",
+                        })
+                        question_id += 1
+                course_parts[course_id].append((part_id, is_exercise))
+                part_id += 1
+            chapter_id += 1
+        course_id += 1
+
+    insert(mathwow.Course.__table__, course_rows)
+    insert(mathwow.Chapter.__table__, chapter_rows)
+    insert(mathwow.Part.__table__, part_rows)
+    insert(mathwow.LessonNote.__table__, note_rows)
+    insert(mathwow.Question.__table__, question_rows)
+
+    # --- Classrooms, teachers and students ---
+    classroom_rows, user_rows, teacher_links, course_links = [], [], [], []
+    classroom_id, user_id = next_id(mathwow.Classroom), next_id(mathwow.User)
+    class_members = {}  # classroom id -> (teacher id, [student ids], [course ids])
+    student_number = 0
+
+    for k in range(classrooms):
+        classroom_rows.append({"id": classroom_id, "name": f"Bench Class {classroom_id}"})
+        teacher_id = user_id
+        user_rows.append({
+            "id": teacher_id,
+            "role": "teacher",
+            "name": f"Teacher {classroom_id}",
+            "email": f"bench-t{classroom_id}@example.com",
+            "student_id": None,
+            "password": password,
+            "points": 0,
+            "classroom_id": None,
+        })
+        user_id += 1
+        teacher_links.append({"teacher_id": teacher_id, "classroom_id": classroom_id})
+
+        assigned = rng.sample(list(course_parts), rng.randint(1, len(course_parts))) if course_parts else []
+        for cid in assigned:
+            course_links.append({"classroom_id": classroom_id, "course_id": cid})
+
+        students = []
+        for s in range(students_per_class):
+            student_number += 1
+            user_rows.append({
+                "id": user_id,
+                "role": "student",
+                "name": f"Student {student_number}",
+                "email": None,
+                "student_id": f"bench-s{student_number}",
+                "password": password,
+                "points": 0,
+                "classroom_id": classroom_id,
+            })
+            students.append(user_id)
+            user_id += 1
+
+        class_members[classroom_id] = (teacher_id, students, assigned)
+        classroom_id += 1
+
+    insert(mathwow.Classroom.__table__, classroom_rows)
+    insert(mathwow.User.__table__, user_rows)
+    insert(mathwow.teacher_class, teacher_links)
+    mathwow.membership_generation.bump()  # raw teacher_class writes skip the ORM's invalidation
+    insert(mathwow.classroom_course, course_links)
+
+    # --- Progress ---
+    submission_rows, done = [], []
+    points = {}
+    for teacher_id, students, assigned in class_members.values():
+        parts = [p for cid in assigned for p in course_parts[cid]]
+        for sid in students:
+            for pid, is_exercise in parts:
+                if rng.random() >= submission_rate:
+                    continue
+                when = now - timedelta(minutes=rng.randint(0, 60 * 24 * 120))
+                if is_exercise:
+                    correct = rng.randint(0, questions_per_part)
+                    submission_rows.append({
+                        "student_id": sid,
+                        "part_id": pid,
+                        "correct": correct,
+                        "total": questions_per_part,
+                        "submitted_at": when,
+                    })
+                    points[sid] = points.get(sid, 0) + correct * 10
+                done.append((sid, pid))
+
+    insert(mathwow.PartSubmission.__table__, submission_rows)
+    mathwow.assign_part_slots()
+    slots = {
+        part_id: (course_id, bit)
+        for part_id, course_id, bit in db.session.query(
+            mathwow.PartSlot.part_id, mathwow.PartSlot.course_id, mathwow.PartSlot.bit
+        )
+    }
+    bitsets = {}
+    for sid, pid in done:
+        course_id, bit = slots[pid]
+        bitsets[(sid, course_id)] = bitsets.get((sid, course_id), 0) | (1 << bit)
+    mathwow.add_progress((sid, cid, bitset) for (sid, cid), bitset in bitsets.items())
+    user_table = mathwow.User.__table__
+    for sid, total in points.items():
+        db.session.execute(user_table.update().where(user_table.c.id == sid).values(points=total))
+
+    # --- Forum and calendar ---
+    post_rows, answer_rows, event_rows = [], [], []
+    post_id = next_id(mathwow.ForumPost)
+    today = date.today()
+    for cid, (teacher_id, students, assigned) in class_members.items():
+        members = [teacher_id] + students
+        for _ in range(posts_per_class):
+            post_rows.append({
+                "id": post_id,
+                "content": f"How do I integrate x^{rng.randint(2, 9)} e^x?",
+                "classroom_id": cid,
+                "author_id": rng.choice(members),
+            })
+            for _ in range(rng.randint(0, answers_per_post * 2)):
+                answer_rows.append({
+                    "content": "Use integration by parts repeatedly.",
+                    "post_id": post_id,
+                    "author_id": rng.choice(members),
+                })
+            post_id += 1
+        for _ in range(events_per_class):
+            event_rows.append({
+                "title": rng.choice(["Quiz", "Homework due", "Revision", "Test"]),
+                "date": today + timedelta(days=rng.randint(-180, 180)),
+                "time": f"{rng.randint(8, 15)}:{rng.choice(['00', '30'])}",
+                "classroom_id": cid,
+            })
+
+    insert(mathwow.ForumPost.__table__, post_rows)
+    insert(mathwow.ForumAnswer.__table__, answer_rows)
+    insert(mathwow.CalendarEvent.__table__, event_rows)
+
+    db.session.commit()
+    mathwow.backfill_join_codes()  # raw classroom inserts get no join code (or typeahead entry)
+
+    return {
+        "classrooms": len(classroom_rows),
+        "users": len(user_rows),
+        "courses": len(course_rows),
+        "chapters": len(chapter_rows),
+        "parts": len(part_rows),
+        "questions": len(question_rows),
+        "part_submissions": len(submission_rows),
+        "parts_completed": len(done),
+        "forum_posts": len(post_rows),
+        "forum_answers": len(answer_rows),
+        "calendar_events": len(event_rows),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="instance/bench.db", help="database file to (re)create")
+    parser.add_argument("--classrooms", type=int, default=10)
+    parser.add_argument("--students", type=int, default=30, help="students per classroom")
+    parser.add_argument("--courses", type=int, default=3)
+    parser.add_argument("--chapters", type=int, default=5, help="chapters per course")
+    parser.add_argument("--parts", type=int, default=5, help="parts per chapter")
+    parser.add_argument("--questions", type=int, default=5, help="questions per exercise part")
+    parser.add_argument("--submission-rate", type=float, default=0.6)
+    parser.add_argument("--posts", type=int, default=20, help="forum posts per classroom")
+    parser.add_argument("--answers", type=int, default=3, help="mean answers per post")
+    parser.add_argument("--events", type=int, default=15, help="calendar events per classroom")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    path = use_database(args.db)
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    import app as mathwow
+
+    with mathwow.app.app_context():
+        summary = build_school(
+            classrooms=args.classrooms,
+            students_per_class=args.students,
+            courses=args.courses,
+            chapters_per_course=args.chapters,
+            parts_per_chapter=args.parts,
+            questions_per_part=args.questions,
+            submission_rate=args.submission_rate,
+            posts_per_class=args.posts,
+            answers_per_post=args.answers,
+            events_per_class=args.events,
+            seed=args.seed,
+        )
+
+    print(f"Synthetic school written to {path}")
+    for name, count in summary.items():
+        print(f"  {name:<18} {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Negotiated response compression and streamed template rendering.
+
+Compression compresses text responses (HTML, JSON, plain text) with brotli
+or gzip, whichever the client prefers of those available; brotli is used
+only when the optional brotli package is installed. Buffered responses are
+compressed in one go. Streamed responses are compressed chunk by chunk with
+a sync flush after each chunk, so the browser can start rendering the top
+of the page while the rest is still being generated.
+
+stream_template() renders a template as a stream of small chunks (every
+STREAM_BUFFER_SIZE template events) instead of one string: the first bytes
+leave the worker as soon as the page header is rendered, and the full page
+is never held in memory. The body is generated after the after_request hooks
+have run, so per-request bookkeeping that must cover rendering belongs in
+teardown_request, which runs when the last chunk has been sent. A hook that
+needs the whole page first (e.g. X-SQL-* headers) sets g.buffer_templates.
+"""
+import gzip
+import zlib
+
+from flask import Response, before_render_template, current_app, g, get_flashed_messages, render_template
+from flask import request, stream_with_context, template_rendered
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+COMPRESSIBLE = {
+    "text/html", "text/plain", "text/css", "text/csv", "text/javascript",
+    "application/json", "application/javascript", "image/svg+xml",
+}
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but the response body is generated while it is sent."""
+    if g.get("buffer_templates"):
+        return Response(render_template(template_name, **context), mimetype="text/html")
+    app = current_app._get_current_object()
+    # Read flashes now: the session cookie is written before the body is streamed.
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    def generate():
+        before_render_template.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+        stream = template.stream(context)
+        stream.enable_buffering(app.config["STREAM_BUFFER_SIZE"])
+        yield from stream
+        template_rendered.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+
+    return Response(stream_with_context(generate()), mimetype="text/html")
+
+
+class Compression:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+        app.config.setdefault("COMPRESS_GZIP_LEVEL", 6)
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", 5)
+        app.config.setdefault("STREAM_BUFFER_SIZE", 64)  # template events per chunk
+        self.app = app
+        app.after_request(self._compress)
+
+    def _encoding(self):
+        accept = request.accept_encodings
+        options = [("gzip", accept["gzip"])]
+        if brotli is not None:
+            options.insert(0, ("br", accept["br"]))
+        best, quality = None, 0
+        for name, q in options:
+            if q > quality:
+                best, quality = name, q
+        return best
+
+    def _compress(self, response):
+        if (
+            response.direct_passthrough  # send_file: static and prebuilt assets
+            or "Content-Encoding" in response.headers
+            or not 200 <= response.status_code < 300
+            or response.mimetype not in COMPRESSIBLE
+            or request.method == "HEAD"
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self._encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.app.config["COMPRESS_MIN_SIZE"]:
+                return response
+            if encoding == "br":
+                data = brotli.compress(data, quality=self.app.config["COMPRESS_BROTLI_QUALITY"])
+            else:
+                data = gzip.compress(data, compresslevel=self.app.config["COMPRESS_GZIP_LEVEL"])
+            response.set_data(data)
+        response.headers["Content-Encoding"] = encoding
+        # A strong ETag of the uncompressed body no longer matches
+        if response.headers.get("ETag", "").startswith('"'):
+            response.headers["ETag"] = "W/" + response.headers["ETag"]
+        return response
+
+    def _compress_stream(self, chunks, encoding):
+        try:
+            yield from self._compressed_chunks(chunks, encoding)
+        finally:
+            # Client went away or we finished: release the request context held by the stream
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    def _compressed_chunks(self, chunks, encoding):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=self.app.config["COMPRESS_BROTLI_QUALITY"])
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                out = compressor.process(chunk) + compressor.flush()
+                if out:
+                    yield out
+            yield compressor.finish()
+        else:
+            compressor = zlib.compressobj(self.app.config["COMPRESS_GZIP_LEVEL"], zlib.DEFLATED, 31)
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                out = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if out:
+                    yield out
+            yield compressor.flush()
@@ -0,0 +1,329 @@
+"""Durable background jobs for work that does not need to finish inside a request.
+
+Jobs are rows in the `job` table of the application database. A view calls
+enqueue() and commits as usual, so a job exists exactly when the request's own
+changes do, and the response does not wait for it. Workers (`flask run-jobs`)
+claim the most urgent ready job with a single UPDATE ... RETURNING, run its
+handler and delete the row in the same transaction as the handler's writes.
+
+* priority: lower runs first; ties go to the job that became ready first
+* retries: a failed job is retried after JOB_RETRY_DELAY * 2**(attempts - 1)
+  seconds (capped at JOB_MAX_RETRY_DELAY) until max_attempts, then it stays
+  in the table as "failed" for `flask retry-failed-jobs`
+* dedup_key: while a job with the same key is queued or running, enqueueing
+  another one is a no-op
+* a job whose worker died is put back in the queue after JOB_TIMEOUT seconds,
+  so handlers must be idempotent
+
+With a sharded database (sharding.py) every school has its own queue next to
+its data; workers take turns over all of them.
+
+Metrics: jobs_total by task and outcome, job_wait_seconds (ready to started),
+job_duration_seconds, and job_queue_depth / job_oldest_ready_seconds read from
+the table when /metrics is scraped.
+"""
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from functools import partial
+
+import click
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 100
+PRIORITY_LOW = 1000
+
+
+class JobQueue:
+    def __init__(self, app=None, db=None, metrics=None):
+        self.handlers = {}
+        self.metrics = metrics
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault("JOB_POLL_INTERVAL", 0.5)
+        app.config.setdefault("JOB_TIMEOUT", 300)
+        app.config.setdefault("JOB_RETRY_DELAY", 5)
+        app.config.setdefault("JOB_MAX_RETRY_DELAY", 3600)
+        self.app = app
+        self.db = db
+        self.table = db.Table(
+            "job",
+            db.Column("id", db.Integer, primary_key=True),
+            db.Column("task", db.String(50), nullable=False),
+            db.Column("payload", db.Text, nullable=False),
+            db.Column("priority", db.Integer, nullable=False),
+            db.Column("status", db.String(10), nullable=False),  # queued, running, failed
+            db.Column("attempts", db.Integer, nullable=False, default=0),
+            db.Column("max_attempts", db.Integer, nullable=False),
+            db.Column("dedup_key", db.String(200)),
+            db.Column("run_at", db.DateTime, nullable=False),
+            db.Column("created_at", db.DateTime, nullable=False),
+            db.Column("started_at", db.DateTime),
+            db.Column("locked_by", db.String(100)),
+            db.Column("last_error", db.Text),
+            # The claim query: next queued job by priority, then readiness
+            db.Index("ix_job_ready", "status", "priority", "run_at"),
+            db.Index(
+                "ux_job_dedup", "dedup_key", unique=True,
+                sqlite_where=db.text("status IN ('queued', 'running')")
+            ),
+        )
+        if self.metrics is not None:
+            self.metrics.add_collector(self._queue_gauges)
+        self._register_commands(app)
+
+    # ---------- producing ----------
+    def task(self, name, priority=PRIORITY_NORMAL, max_attempts=5):
+        """Register the decorated function as the handler of `name` jobs.
+
+        The handler is called with the job's payload as keyword arguments,
+        inside an app context; it must not commit.
+        """
+        def decorator(fn):
+            self.handlers[name] = (fn, priority, max_attempts)
+            return fn
+        return decorator
+
+    def enqueue(self, task, payload=None, priority=None, dedup_key=None, delay=0):
+        """Add a job in the current transaction; the caller commits.
+
+        Returns False if a job with the same dedup_key is already pending.
+        """
+        _, default_priority, max_attempts = self.handlers[task]
+        now = datetime.utcnow()
+        t = self.table
+        return bool(self.db.session.execute(
+            sqlite_insert(t)
+            .values(
+                task=task,
+                payload=json.dumps(payload or {}),
+                priority=default_priority if priority is None else priority,
+                status="queued",
+                attempts=0,
+                max_attempts=max_attempts,
+                dedup_key=dedup_key,
+                run_at=now + timedelta(seconds=delay),
+                created_at=now,
+            )
+            .on_conflict_do_nothing(
+                index_elements=["dedup_key"],
+                index_where=t.c.status.in_(["queued", "running"]),
+            )
+        ).rowcount)
+
+    # ---------- consuming ----------
+    def _claim(self, worker):
+        t = self.table
+        now = datetime.utcnow()
+        ready = (
+            self.db.select(t.c.id)
+            .where(t.c.status == "queued", t.c.run_at <= now)
+            .order_by(t.c.priority, t.c.run_at, t.c.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        with self.db.engine.begin() as conn:
+            return conn.execute(
+                self.db.update(t)
+                .where(t.c.id == ready, t.c.status == "queued")
+                .values(status="running", attempts=t.c.attempts + 1, started_at=now, locked_by=worker)
+                .returning(t.c.id, t.c.task, t.c.payload, t.c.attempts, t.c.max_attempts, t.c.run_at)
+            ).first()
+
+    def _contexts(self):
+        """One app context factory per database holding a queue (each school shard)."""
+        shard_names = getattr(self.db, "shard_names", None)
+        if shard_names is None:
+            return [self.app.app_context]
+        return [partial(self.db.shard_context, name) for name in shard_names()]
+
+    def run_one(self, worker, context=None):
+        """Claim and run the next ready job. Returns False if there was none."""
+        with (context or self.app.app_context)():
+            job = self._claim(worker)
+            if job is None:
+                return False
+            session = self.db.session
+            t = self.table
+            start = time.perf_counter()
+            self._observe("job_wait_seconds", job.task, (datetime.utcnow() - job.run_at).total_seconds())
+            try:
+                handler = self.handlers[job.task][0]
+                handler(**json.loads(job.payload))
+                session.execute(self.db.delete(t).where(t.c.id == job.id))
+                session.commit()
+                outcome = "done"
+            except Exception:
+                session.rollback()
+                self.app.logger.exception("job %s (%s) failed", job.id, job.task)
+                outcome = self._retry_or_fail(job, traceback.format_exc())
+            self._observe("job_duration_seconds", job.task, time.perf_counter() - start)
+            if self.metrics is not None:
+                self.metrics.inc("jobs_total", {"task": job.task, "outcome": outcome})
+            return True
+
+    def _retry_or_fail(self, job, error):
+        t = self.table
+        config = self.app.config
+        if job.attempts >= job.max_attempts:
+            values = {"status": "failed"}
+            outcome = "failed"
+        else:
+            delay = min(config["JOB_RETRY_DELAY"] * 2 ** (job.attempts - 1), config["JOB_MAX_RETRY_DELAY"])
+            values = {"status": "queued", "run_at": datetime.utcnow() + timedelta(seconds=delay)}
+            outcome = "retry"
+        with self.db.engine.begin() as conn:
+            conn.execute(
+                self.db.update(t).where(t.c.id == job.id)
+                .values(locked_by=None, last_error=error[-4000:], **values)
+            )
+        return outcome
+
+    def requeue_stale(self, context=None):
+        """Put jobs whose worker stopped answering back in the queue (or fail them)."""
+        t = self.table
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config["JOB_TIMEOUT"])
+        stale = (t.c.status == "running") & (t.c.started_at < cutoff)
+        with (context or self.app.app_context)(), self.db.engine.begin() as conn:
+            conn.execute(
+                self.db.update(t).where(stale, t.c.attempts >= t.c.max_attempts)
+                .values(status="failed", locked_by=None, last_error="timed out")
+            )
+            return conn.execute(
+                self.db.update(t).where(stale)
+                .values(status="queued", locked_by=None, run_at=datetime.utcnow())
+            ).rowcount
+
+    def work(self, stop=None, burst=False):
+        """Run jobs until `stop` is set (or, with burst, until the queue is empty)."""
+        stop = stop or threading.Event()
+        worker = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+        poll = self.app.config["JOB_POLL_INTERVAL"]
+        last_requeue = last_flush = 0.0
+        while not stop.is_set():
+            contexts = self._contexts()
+            if time.monotonic() - last_requeue > self.app.config["JOB_TIMEOUT"] / 2:
+                for context in contexts:
+                    self.requeue_stale(context)
+                last_requeue = time.monotonic()
+            ran = False
+            for context in contexts:
+                ran = self.run_one(worker, context) or ran
+            if self.metrics is not None and time.monotonic() - last_flush >= self.app.config["METRICS_FLUSH_INTERVAL"]:
+                self.metrics.flush()
+                last_flush = time.monotonic()
+            if not ran:
+                if burst:
+                    break
+                stop.wait(poll)
+        if self.metrics is not None:
+            self.metrics.flush()
+
+    def _work_until_interrupted(self, stop, burst):
+        try:
+            self.work(stop, burst)
+        except KeyboardInterrupt:
+            stop.set()
+
+    def start_threads(self, count=1):
+        """Run workers in background threads of this process (development server)."""
+        stop = threading.Event()
+        for _ in range(count):
+            threading.Thread(target=self.work, args=(stop,), daemon=True).start()
+        return stop
+
+    # ---------- observability ----------
+    def _observe(self, name, task, seconds):
+        if self.metrics is not None:
+            self.metrics.observe(name, {"task": task}, max(seconds, 0.0))
+
+    def _queue_gauges(self):
+        now = datetime.utcnow()
+        depth, oldest = {}, {}
+        for (task, status), (count, first) in self.stats().items():
+            depth[task, status] = depth.get((task, status), 0) + count
+            if status == "queued":
+                oldest[task] = min(oldest.get(task, first), first)
+        for (task, status), count in depth.items():
+            yield "job_queue_depth", {"task": task, "status": status}, count
+        for task, first in oldest.items():
+            yield "job_oldest_ready_seconds", {"task": task}, max((now - first).total_seconds(), 0.0)
+
+    def stats(self):
+        """{(task, status): (count, earliest run_at)} over every queue."""
+        t = self.table
+        totals = {}
+        for context in self._contexts():
+            with context():
+                rows = self.db.session.execute(
+                    self.db.select(t.c.task, t.c.status, self.db.func.count(), self.db.func.min(t.c.run_at))
+                    .group_by(t.c.task, t.c.status)
+                )
+                for task, status, count, first in rows:
+                    if (task, status) in totals:
+                        total, earliest = totals[task, status]
+                        count, first = total + count, min(earliest, first)
+                    totals[task, status] = (count, first)
+        return totals
+
+    # ---------- commands ----------
+    def _register_commands(self, app):
+        @app.cli.command("run-jobs")
+        @click.option("--processes", default=1, show_default=True, help="Worker processes to start.")
+        @click.option("--burst", is_flag=True, help="Exit once the queue is empty.")
+        def run_jobs(processes, burst):
+            """Process background jobs until interrupted."""
+            with app.app_context():
+                self.db.engine.dispose()  # children open their own connections
+            stop = multiprocessing.Event()
+            signal.signal(signal.SIGTERM, lambda *_: stop.set())
+            children = [
+                multiprocessing.Process(target=self._work_until_interrupted, args=(stop, burst))
+                for _ in range(processes - 1)
+            ]
+            for child in children:
+                child.start()
+            self._work_until_interrupted(stop, burst)
+            for child in children:
+                child.join()
+
+        @app.cli.command("jobs-status")
+        def jobs_status():
+            """Show how many jobs of each task are queued, running or failed."""
+            counts = self.stats()
+            if not counts:
+                click.echo("No jobs.")
+            for (task, status), (count, _) in sorted(counts.items()):
+                click.echo(f"{task:<24}{status:<10}{count:>8}")
+
+        @app.cli.command("retry-failed-jobs")
+        @click.option("--task", help="Only jobs of this task.")
+        def retry_failed_jobs(task):
+            """Queue failed jobs again with a fresh set of attempts."""
+            t = self.table
+            pending = self.db.select(t.c.dedup_key).where(
+                t.c.status.in_(["queued", "running"]), t.c.dedup_key.is_not(None)
+            )
+            # A failed job whose key is pending again would be a duplicate
+            query = self.db.update(t).where(
+                t.c.status == "failed",
+                t.c.dedup_key.is_(None) | t.c.dedup_key.not_in(pending),
+            )
+            if task:
+                query = query.where(t.c.task == task)
+            count = 0
+            for context in self._contexts():
+                with context(), self.db.engine.begin() as conn:
+                    count += conn.execute(
+                        query.values(status="queued", attempts=0, run_at=datetime.utcnow())
+                    ).rowcount
+            click.echo(f"Queued {count} failed jobs again.")
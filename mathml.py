@@ -0,0 +1,175 @@
+"""Convert the plain-text math used in questions and forum posts to MathML.
+
+Question options are written like "(1/7)(x + 1)^7 + C", "x^(2/3)", "e^{3x}"
+or "√(x² - 4)". Browsers render MathML natively, so turning the parts that
+plain text cannot show (powers and roots) into inline <math> islands gives
+correct math with no client-side typesetting library. Everything else stays
+escaped text, which keeps prose in forum posts wrapping normally.
+
+to_html() is pure and deterministic, so its output can be cached by a hash
+of the input (see RENDERER_VERSION).
+"""
+import hashlib
+import re
+
+from markupsafe import Markup, escape
+
+# Bump when the output format changes so cached renderings are recomputed.
+RENDERER_VERSION = "1"
+
+FUNCTIONS = {
+    "sin", "cos", "tan", "sec", "csc", "cot", "ln", "log", "exp",
+    "arcsin", "arccos", "arctan", "sinh", "cosh", "tanh",
+}
+OPEN = {"(": ")", "{": "}", "[": "]"}
+CLOSE = {v: k for k, v in OPEN.items()}
+OPERATORS = {"*": "·", "-": "−"}
+
+_TOKEN = re.compile(r"(\d+(?:\.\d+)?)|([A-Za-z]+)|(\s+)|(.)", re.S)
+
+
+def digest(text):
+    return hashlib.sha1((RENDERER_VERSION + "\0" + text).encode()).hexdigest()
+
+
+# ---------- parsing ----------
+def _tokens(text):
+    for number, word, space, char in _TOKEN.findall(text):
+        if number:
+            yield ("num", number)
+        elif word:
+            yield ("word", word)
+        elif space:
+            yield ("space", space)
+        else:
+            yield ("char", char)
+
+
+def _group(tokens):
+    """Nest bracketed runs: returns a list of tokens and ("group", open, close, items)."""
+    stack = [("root", None, [])]
+    for tok in tokens:
+        kind, value = tok
+        if kind == "char" and value in OPEN:
+            stack.append(("group", value, []))
+        elif kind == "char" and value in CLOSE and len(stack) > 1 and stack[-1][1] == CLOSE[value]:
+            _, opener, items = stack.pop()
+            stack[-1][2].append(("group", opener, value, items))
+        else:
+            stack[-1][2].append(tok)
+    # Unclosed brackets: flatten back into plain tokens.
+    while len(stack) > 1:
+        _, opener, items = stack.pop()
+        stack[-1][2].extend([("char", opener)] + items)
+    return stack[0][2]
+
+
+def _attach(items):
+    """Fold `base ^ exponent` and `√ arg` into ("sup", ...) / ("sqrt", ...) nodes."""
+    out = []
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if item[0] == "group":
+            item = ("group", item[1], item[2], _attach(item[3]))
+        if item == ("char", "√") and i + 1 < len(items) and items[i + 1][0] != "space":
+            arg = items[i + 1]
+            if arg[0] == "group":
+                arg = ("group", arg[1], arg[2], _attach(arg[3]))
+            out.append(("sqrt", arg))
+            i += 2
+            continue
+        if item == ("char", "^") and out and out[-1][0] != "space" and i + 1 < len(items) and items[i + 1][0] != "space":
+            exponent = items[i + 1]
+            if exponent[0] == "group":
+                exponent = ("group", exponent[1], exponent[2], _attach(exponent[3]))
+            out.append(("sup", out.pop(), exponent))
+            i += 2
+            continue
+        out.append(item)
+        i += 1
+    return out
+
+
+# ---------- output ----------
+def _has_math(item):
+    if item[0] in ("sup", "sqrt"):
+        return True
+    if item[0] == "group":
+        return any(_has_math(child) for child in item[3])
+    return False
+
+
+def _mathml_items(items):
+    return "".join(_mathml(item) for item in items)
+
+
+def _unwrapped(item):
+    """Contents of a bracket group without the brackets, as one mrow."""
+    if item[0] == "group":
+        inner = [child for child in item[3] if child[0] != "space"]
+        if (
+            len(inner) == 3
+            and inner[0][0] == "num"
+            and inner[1] == ("char", "/")
+            and inner[2][0] == "num"
+        ):
+            return f"<mfrac>{_mathml(inner[0])}{_mathml(inner[2])}</mfrac>"
+        return f"<mrow>{_mathml_items(item[3])}</mrow>"
+    return _mathml(item)
+
+
+def _mathml(item):
+    kind = item[0]
+    if kind == "num":
+        return f"<mn>{escape(item[1])}</mn>"
+    if kind == "word":
+        if item[1] in FUNCTIONS or len(item[1]) == 1:
+            return f"<mi>{escape(item[1])}</mi>"
+        return f"<mtext>{escape(item[1])}</mtext>"
+    if kind == "space":
+        return ""
+    if kind == "char":
+        char = item[1]
+        if char.isalpha():
+            return f"<mi>{escape(char)}</mi>"
+        if char.isdigit():
+            return f"<mn>{escape(char)}</mn>"
+        return f"<mo>{escape(OPERATORS.get(char, char))}</mo>"
+    if kind == "group":
+        if item[1] == "{":
+            return f"<mrow>{_mathml_items(item[3])}</mrow>"
+        return f"<mrow><mo>{item[1]}</mo>{_mathml_items(item[3])}<mo>{item[2]}</mo></mrow>"
+    if kind == "sup":
+        return f"<msup>{_mathml(item[1])}{_unwrapped(item[2])}</msup>"
+    if kind == "sqrt":
+        return f"<msqrt>{_unwrapped(item[1])}</msqrt>"
+    raise ValueError(kind)
+
+
+def _text(item):
+    kind = item[0]
+    if kind == "group":
+        return item[1] + "".join(_text(child) for child in item[3]) + item[2]
+    return item[1]
+
+
+def _html(items):
+    parts = []
+    for item in items:
+        if item[0] in ("sup", "sqrt"):
+            parts.append(f"<math>{_mathml(item)}</math>")
+        elif item[0] == "group" and _has_math(item):
+            parts.append(f"<math>{_mathml(item)}</math>")
+        else:
+            parts.append(str(escape(_text(item))))
+    return "".join(parts)
+
+
+def to_html(text):
+    """Escaped HTML with powers and roots as inline MathML."""
+    if not text:
+        return Markup("")
+    if "^" not in text and "√" not in text:
+        return escape(text)
+    return Markup(_html(_attach(_group(_tokens(text)))))
@@ -0,0 +1,323 @@
+"""Request metrics in Prometheus text format.
+
+Each worker process keeps its counters, histograms and gauges in memory and
+flushes them to METRICS_DIR/<pid>.json at most every METRICS_FLUSH_INTERVAL
+seconds. /metrics merges every process file, so the numbers are correct no
+matter which worker answers the scrape:
+
+* counters and histograms are summed across processes; files left behind by
+  dead workers are folded into _dead.json so their totals are not lost
+* gauges are summed across live processes only
+
+Collected out of the box: per-endpoint latency histograms, request counts by
+status, in-flight requests and database pool usage. Caches report through
+cache_hit() / cache_miss(). Collectors added with add_collector() yield
+(name, labels, value) gauges computed at scrape time, for values that live in
+the database rather than in any one process.
+
+/metrics answers admins, scrapers that send "Authorization: Bearer
+<METRICS_TOKEN>", and addresses listed in METRICS_ALLOWED_IPS (empty by
+default). Behind a reverse proxy on the same host every request arrives from
+127.0.0.1, so listing loopback there would open /metrics to everyone; give
+the scraper the token instead, or let the proxy itself refuse public
+requests for /metrics.
+"""
+import atexit
+import fcntl
+import hmac
+import json
+import os
+import threading
+import time
+
+from flask import Response, abort, g, request
+
+from admin import is_admin
+
+PREFIX = "mathwow_"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEAD_FILE = "_dead.json"
+
+HELP = {
+    "requests_total": ("counter", "HTTP requests by endpoint, method and status."),
+    "request_duration_seconds": ("histogram", "HTTP request latency by endpoint."),
+    "requests_in_flight": ("gauge", "Requests currently being handled."),
+    "db_pool_size": ("gauge", "Configured database connection pool size."),
+    "db_pool_checked_out": ("gauge", "Database connections currently checked out."),
+    "db_pool_overflow": ("gauge", "Database connections opened beyond the pool size."),
+    "cache_hits_total": ("counter", "Cache lookups answered from the cache."),
+    "cache_misses_total": ("counter", "Cache lookups that had to compute the value."),
+    "rate_limited_total": ("counter", "Write requests rejected with 429 by the rate limiter."),
+    "jobs_total": ("counter", "Background jobs run, by task and outcome (done, retry, failed)."),
+    "job_wait_seconds": ("histogram", "Time from a job becoming ready to a worker starting it."),
+    "job_duration_seconds": ("histogram", "Time spent running a background job."),
+    "job_queue_depth": ("gauge", "Jobs in the queue by task and status."),
+    "job_oldest_ready_seconds": ("gauge", "Age of the oldest queued job of each task."),
+    "backup_snapshots": ("gauge", "Database snapshots kept in BACKUP_DIR."),
+    "backup_last_snapshot_age_seconds": ("gauge", "Time since the newest database snapshot was taken."),
+    "tutor_requests_total": ("counter", "Tutor questions by outcome (cached, answered, busy, error)."),
+    "tutor_in_flight": ("gauge", "Tutor answers currently being generated."),
+    "tutor_first_token_seconds": ("histogram", "Time from asking the tutor model to its first words."),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Metrics:
+    def __init__(self, app=None, db=None):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.collectors = []
+        self.buckets = DEFAULT_BUCKETS
+        self.directory = None
+        self._last_flush = 0.0
+        if app is not None:
+            self.init_app(app, db)
+
+    # ---------- recording ----------
+    def inc(self, name, labels=None, value=1):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = _key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # One slot per bucket plus +Inf, then sum and count.
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(self.buckets)] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def set_gauge(self, name, labels, value):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def add_gauge(self, name, labels, delta):
+        key = _key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def cache_hit(self, cache):
+        self.inc("cache_hits_total", {"cache": cache})
+
+    def cache_miss(self, cache):
+        self.inc("cache_misses_total", {"cache": cache})
+
+    # ---------- Flask wiring ----------
+    def init_app(self, app, db=None):
+        app.config.setdefault("METRICS_DIR", os.path.join(app.instance_path, "metrics"))
+        app.config.setdefault("METRICS_FLUSH_INTERVAL", 1.0)
+        app.config.setdefault("METRICS_ALLOWED_IPS", ())
+        app.config.setdefault("METRICS_TOKEN", None)
+        self.app = app
+        self.db = db
+        self.directory = app.config["METRICS_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+        atexit.register(self.flush)
+
+        @app.before_request
+        def _metrics_start():
+            g.metrics_start = time.perf_counter()
+            g.metrics_in_flight = True
+            self.add_gauge("requests_in_flight", None, 1)
+
+        @app.after_request
+        def _metrics_record(response):
+            # Timed in teardown: a streamed page is still being rendered here
+            g.metrics_status = response.status_code
+            return response
+
+        @app.teardown_request
+        def _metrics_finish(exc):
+            start = g.pop("metrics_start", None)
+            status = g.pop("metrics_status", 500)
+            if start is not None:
+                # An unhandled exception (in the view or while streaming) counts as a 500
+                self._record(request.endpoint, 500 if exc is not None else status, time.perf_counter() - start)
+            if g.pop("metrics_in_flight", False):
+                self.add_gauge("requests_in_flight", None, -1)
+            if time.monotonic() - self._last_flush >= app.config["METRICS_FLUSH_INTERVAL"]:
+                self.flush()
+
+        def scraper_allowed():
+            token = app.config["METRICS_TOKEN"]
+            if token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+                return True
+            return request.remote_addr in app.config["METRICS_ALLOWED_IPS"]
+
+        @app.route("/metrics")
+        def metrics():
+            if not scraper_allowed() and not is_admin():
+                abort(404)
+            self.flush()
+            return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+    def _record(self, endpoint, status, elapsed):
+        endpoint = endpoint or "unmatched"
+        self.inc("requests_total", {"endpoint": endpoint, "method": request.method, "status": str(status)})
+        self.observe("request_duration_seconds", {"endpoint": endpoint}, elapsed)
+
+    def _pool_gauges(self):
+        if self.db is None:
+            return
+        try:
+            pool = self.db.engine.pool
+        except RuntimeError:  # no app context
+            return
+        for name, attr in (("db_pool_size", "size"), ("db_pool_checked_out", "checkedout"), ("db_pool_overflow", "overflow")):
+            if hasattr(pool, attr):
+                self.set_gauge(name, None, max(getattr(pool, attr)(), 0))
+
+    # ---------- multi-process storage ----------
+    def _snapshot(self):
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "buckets": list(self.buckets),
+                "counters": [[n, dict(l), v] for (n, l), v in self.counters.items()],
+                "histograms": [[n, dict(l), h] for (n, l), h in self.histograms.items()],
+                "gauges": [[n, dict(l), v] for (n, l), v in self.gauges.items()],
+            }
+
+    def flush(self):
+        if self.directory is None:
+            return
+        self._pool_gauges()
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp = path + ".tmp"
+        with self._flush_lock:
+            with open(tmp, "w") as f:
+                json.dump(self._snapshot(), f)
+            os.replace(tmp, path)
+            self._last_flush = time.monotonic()
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _reap_dead(self):
+        """Fold counters of exited workers into _dead.json and drop their files."""
+        lock_path = os.path.join(self.directory, ".lock")
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            dead = self._read(DEAD_FILE) or {"counters": [], "histograms": []}
+            changed = False
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json") or name == DEAD_FILE:
+                    continue
+                pid = int(name[:-5]) if name[:-5].isdigit() else None
+                if pid is None or _pid_alive(pid):
+                    continue
+                data = self._read(name)
+                if data:
+                    merged = self._merge([dead, data], include_gauges=False)
+                    dead = {
+                        "counters": [[n, dict(l), v] for (n, l), v in merged["counters"].items()],
+                        "histograms": [[n, dict(l), h] for (n, l), h in merged["histograms"].items()],
+                    }
+                os.remove(os.path.join(self.directory, name))
+                changed = True
+            if changed:
+                tmp = os.path.join(self.directory, DEAD_FILE + ".tmp")
+                with open(tmp, "w") as f:
+                    json.dump(dead, f)
+                os.replace(tmp, os.path.join(self.directory, DEAD_FILE))
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _merge(self, snapshots, include_gauges=True):
+        counters, histograms, gauges = {}, {}, {}
+        for snap in snapshots:
+            for n, l, v in snap.get("counters", []):
+                key = _key(n, l)
+                counters[key] = counters.get(key, 0) + v
+            for n, l, h in snap.get("histograms", []):
+                key = _key(n, l)
+                if key in histograms:
+                    histograms[key] = [a + b for a, b in zip(histograms[key], h)]
+                else:
+                    histograms[key] = list(h)
+            if include_gauges:
+                for n, l, v in snap.get("gauges", []):
+                    key = _key(n, l)
+                    gauges[key] = gauges.get(key, 0) + v
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def collect(self):
+        """Merged view across every worker process."""
+        self._reap_dead()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                data = self._read(name)
+                if data:
+                    snapshots.append(data)
+        return self._merge(snapshots)
+
+    # ---------- exposition ----------
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        body = ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + body + "}"
+
+    def render(self):
+        merged = self.collect()
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                merged["gauges"][_key(name, labels)] = value
+        by_name = {}
+        for kind in ("counters", "histograms", "gauges"):
+            for (name, labels), value in merged[kind].items():
+                by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text = HELP.get(name, ("untyped", name))
+            full = PREFIX + name
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, value in sorted(by_name[name]):
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(list(self.buckets) + ["+Inf"], value[:-2]):
+                        cumulative += count
+                        lines.append(f"{full}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{full}_sum{self._labels(labels)} {value[-2]}")
+                    lines.append(f"{full}_count{self._labels(labels)} {value[-1]}")
+                else:
+                    lines.append(f"{full}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,323 @@
+"""On-demand request profiling for operators.
+
+A request is profiled when
+
+* an operator adds ?profile=1 to any URL, or
+* it matches a trigger armed from /admin/profiles: either "the next N requests
+  to <endpoint>" (optionally only for one user, named by school and user id,
+  as ids are only unique within a school's shard) or "a fraction of requests
+  to <endpoint>".
+
+Profiled requests run under cProfile and also record SQL time (query_stats)
+and template render time (Flask template signals). Each report is one JSON
+file in PROFILE_DIR; only the newest PROFILE_MAX_REPORTS are kept.
+Triggers live in PROFILE_DIR/triggers.json so every worker process sees them;
+changes are made under an flock on triggers.lock and land by atomic rename,
+so readers never see a half-written file.
+"""
+import cProfile
+import fcntl
+import io
+import json
+import os
+import pstats
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import Response, abort, flash, g, redirect, render_template, request, url_for
+from flask import before_render_template, template_rendered
+from flask_login import current_user
+
+import query_stats
+from admin import admin_required, is_admin
+from sharding import DEFAULT_SHARD, current_shard
+
+TRIGGERS_FILE = "triggers.json"
+TRIGGERS_LOCK = "triggers.lock"
+
+
+class Profiler:
+    def __init__(self, app=None, db=None):
+        self._triggers = []
+        self._triggers_version = None
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        app.config.setdefault("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+        app.config.setdefault("PROFILE_MAX_REPORTS", 50)
+        app.config.setdefault("PROFILE_TOP_FUNCTIONS", 40)
+        self.app = app
+        self.db = db
+        self.directory = app.config["PROFILE_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+        self._register_routes(app)
+
+    # ---------- triggers ----------
+    @contextmanager
+    def _locked_triggers(self):
+        """Read-modify-write triggers.json under an exclusive lock."""
+        path = os.path.join(self.directory, TRIGGERS_FILE)
+        with open(os.path.join(self.directory, TRIGGERS_LOCK), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path) as f:
+                        raw = f.read()
+                except FileNotFoundError:
+                    raw = ""
+                triggers = json.loads(raw) if raw.strip() else []
+                yield triggers
+                # Durable before it is visible, and visible before the lock is released
+                tmp = path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(triggers, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def triggers(self):
+        """Armed triggers, re-read only when another worker changed the file."""
+        path = os.path.join(self.directory, TRIGGERS_FILE)
+        try:
+            st = os.stat(path)
+            version = (st.st_ino, st.st_mtime_ns)
+            if version != self._triggers_version:
+                with open(path) as f:
+                    raw = f.read()
+                self._triggers = json.loads(raw) if raw.strip() else []
+                self._triggers_version = version
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError):
+            # Unreadable right now: keep the triggers we had, try again next request
+            self.app.logger.warning("could not read %s", path)
+        return self._triggers
+
+    def arm(self, endpoint, user_id=None, shard=None, count=None, rate=None):
+        with self._locked_triggers() as triggers:
+            triggers.append({
+                "id": uuid.uuid4().hex[:8],
+                "endpoint": endpoint,
+                "user_id": user_id,
+                "shard": (shard or DEFAULT_SHARD) if user_id is not None else None,
+                "remaining": count,
+                "rate": rate,
+            })
+
+    def disarm(self, trigger_id):
+        with self._locked_triggers() as triggers:
+            triggers[:] = [t for t in triggers if t["id"] != trigger_id]
+
+    def _matches(self, trigger):
+        if trigger["endpoint"] != request.endpoint:
+            return False
+        if trigger["user_id"] is not None:
+            if trigger.get("shard") != current_shard():
+                return False
+            if not current_user.is_authenticated or current_user.id != trigger["user_id"]:
+                return False
+        return True
+
+    def _should_profile(self):
+        if request.args.get("profile") == "1" and is_admin():
+            return "operator"
+        for trigger in self.triggers():
+            if not self._matches(trigger):
+                continue
+            if trigger["rate"] is not None:
+                if random.random() < trigger["rate"]:
+                    return "sampled"
+                continue
+            # Counted trigger: claim one shot under the lock so that only one
+            # worker profiles each armed request.
+            with self._locked_triggers() as triggers:
+                for t in triggers:
+                    if t["id"] == trigger["id"] and t["remaining"]:
+                        t["remaining"] -= 1
+                        triggers[:] = [x for x in triggers if x["rate"] is not None or x["remaining"]]
+                        return "armed"
+        return None
+
+    def shard_names(self):
+        return self.db.shard_names() if self.db is not None else [DEFAULT_SHARD]
+
+    # ---------- request hooks ----------
+    def _start(self):
+        if request.endpoint and request.endpoint.startswith("admin_profile"):
+            return
+        reason = self._should_profile()
+        if not reason:
+            return
+        g.profile = {
+            "id": datetime.utcnow().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6],
+            "reason": reason,
+            "started": time.perf_counter(),
+            "template_ms": 0.0,
+            "templates": [],
+            "sql": query_stats.track(),
+            "profiler": cProfile.Profile(),
+        }
+        g.profile["sql_stats"] = g.profile["sql"].__enter__()
+        g.profile["profiler"].enable()
+
+    def _template_started(self, sender, template, context, **extra):
+        if "profile" in g:
+            g.profile["template_start"] = time.perf_counter()
+
+    def _template_finished(self, sender, template, context, **extra):
+        if "profile" in g and "template_start" in g.profile:
+            elapsed = (time.perf_counter() - g.profile.pop("template_start")) * 1000
+            g.profile["template_ms"] += elapsed
+            g.profile["templates"].append({"name": template.name, "ms": round(elapsed, 2)})
+
+    def _finish(self, response):
+        # A streamed page is rendered after this hook: the report is written
+        # in _teardown, which runs once the last chunk has been sent.
+        profile = g.get("profile")
+        if profile is not None:
+            profile["status"] = response.status_code
+            response.headers["X-Profile-Id"] = profile["id"]
+        return response
+
+    def _teardown(self, exc):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        profile["profiler"].disable()
+        profile["sql"].__exit__(None, None, None)
+        if "status" not in profile:
+            return  # the view raised before after_request ran: keep nothing
+        total_ms = (time.perf_counter() - profile["started"]) * 1000
+        sql = profile["sql_stats"]
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile["profiler"], stream=out)
+        stats.sort_stats("cumulative").print_stats(self.app.config["PROFILE_TOP_FUNCTIONS"])
+
+        report = {
+            "id": profile["id"],
+            "created": datetime.utcnow().isoformat(timespec="seconds"),
+            "reason": profile["reason"],
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "endpoint": request.endpoint,
+            "user_id": current_user.id if current_user.is_authenticated else None,
+            "shard": current_shard(),
+            "status": 500 if exc is not None else profile["status"],
+            "total_ms": round(total_ms, 2),
+            "sql_ms": round(sql.total_time * 1000, 2),
+            "queries": sql.count,
+            "n_plus_one": sql.as_dict()["n_plus_one"],
+            "template_ms": round(profile["template_ms"], 2),
+            "templates": profile["templates"],
+            "profile": out.getvalue(),
+        }
+        self._save(report)
+
+    # ---------- storage ----------
+    def _save(self, report):
+        path = os.path.join(self.directory, report["id"] + ".json")
+        with open(path, "w") as f:
+            json.dump(report, f)
+        self._prune()
+
+    def _prune(self):
+        reports = sorted(self._report_files())
+        for name in reports[:-self.app.config["PROFILE_MAX_REPORTS"]]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _report_files(self):
+        return [n for n in os.listdir(self.directory) if n.endswith(".json") and n != TRIGGERS_FILE]
+
+    def reports(self):
+        summaries = []
+        for name in sorted(self._report_files(), reverse=True):
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    report = json.load(f)
+            except (OSError, ValueError):
+                continue
+            report.pop("profile", None)
+            summaries.append(report)
+        return summaries
+
+    def load(self, report_id):
+        if os.path.basename(report_id) != report_id:
+            return None
+        try:
+            with open(os.path.join(self.directory, report_id + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # ---------- admin endpoints ----------
+    def _register_routes(self, app):
+        profiler = self
+
+        @app.route("/admin/profiles", methods=["GET", "POST"])
+        @admin_required
+        def admin_profiles():
+            if request.method == "POST":
+                if request.form.get("disarm"):
+                    profiler.disarm(request.form["disarm"])
+                    flash("Trigger removed.", "success")
+                    return redirect(url_for("admin_profiles"))
+
+                endpoint = request.form.get("endpoint", "").strip()
+                if endpoint not in app.view_functions:
+                    flash("Unknown endpoint.", "danger")
+                    return redirect(url_for("admin_profiles"))
+                user_id = request.form.get("user_id", type=int)
+                shard = request.form.get("shard") or DEFAULT_SHARD
+                if shard not in profiler.shard_names():
+                    flash("Unknown school.", "danger")
+                    return redirect(url_for("admin_profiles"))
+                rate = request.form.get("rate", type=float)
+                if rate:
+                    profiler.arm(endpoint, user_id=user_id, shard=shard, rate=min(max(rate, 0.0), 1.0))
+                else:
+                    profiler.arm(endpoint, user_id=user_id, shard=shard, count=request.form.get("count", 1, type=int))
+                flash(f"Profiling armed for {endpoint}.", "success")
+                return redirect(url_for("admin_profiles"))
+
+            return render_template(
+                "admin_profiles.html",
+                reports=profiler.reports(),
+                triggers=profiler.triggers(),
+                shards=profiler.shard_names(),
+                endpoints=sorted(e for e in app.view_functions if e != "static"),
+            )
+
+        @app.route("/admin/profiles/<report_id>")
+        @admin_required
+        def admin_profile_report(report_id):
+            report = profiler.load(report_id)
+            if report is None:
+                abort(404)
+            header = [
+                f"{report['method']} {report['path']}  endpoint={report['endpoint']}  "
+                f"user={report.get('shard', DEFAULT_SHARD)}:{report['user_id']}",
+                f"status {report['status']}  total {report['total_ms']} ms  "
+                f"sql {report['sql_ms']} ms ({report['queries']} queries)  templates {report['template_ms']} ms",
+            ]
+            for t in report["templates"]:
+                header.append(f"  template {t['name']}: {t['ms']} ms")
+            for rep in report["n_plus_one"]:
+                header.append(f"  N+1 {rep['count']}x {rep['statement']}")
+            return Response("\n".join(header) + "\n\n" + report["profile"], mimetype="text/plain")
+
@@ -0,0 +1,198 @@
+"""Per-request SQL instrumentation and N+1 detection.
+
+Every statement SQLAlchemy sends to the database is counted and timed against
+whatever trackers are active on the current thread. init_app() opens one
+tracker per request and reports it:
+
+* as X-SQL-* response headers when SQL_STATS_HEADERS is on (defaults to debug)
+* as one JSON log line per request on the "sql_stats" logger otherwise
+
+Statements are reduced to a "shape" (literals and IN-lists collapsed) so the
+same lazy load fired once per row shows up as one shape repeated N times.
+Shapes repeated SQL_N_PLUS_ONE_THRESHOLD times or more are flagged as N+1.
+
+In tests, query_budget() / assert_query_budget() fail when a block or a route
+issues more statements than allowed.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("sql_stats")
+
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+_local = threading.local()
+_installed = False
+
+_IN_LIST = re.compile(r"\(\s*(?:\?|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+))*\s*\)")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """Normalise a SQL statement so repeats of the same query compare equal."""
+    shape = _STRING.sub("?", statement)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("(?)", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+
+class QueryStats:
+    """Counters for one tracked block (usually one request)."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=DEFAULT_N_PLUS_ONE_THRESHOLD):
+        """Statement shapes issued `threshold` times or more, most frequent first."""
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+    def as_dict(self, threshold=DEFAULT_N_PLUS_ONE_THRESHOLD):
+        return {
+            "queries": self.count,
+            "sql_ms": round(self.total_time * 1000, 2),
+            "n_plus_one": [{"count": n, "statement": shape} for shape, n in self.repeated(threshold)],
+        }
+
+
+def _active():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    for stats in _active():
+        stats.record(statement, elapsed)
+
+
+def install():
+    """Attach the cursor listeners to every Engine (idempotent)."""
+    global _installed
+    if not _installed:
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _installed = True
+
+
+@contextmanager
+def track():
+    """Collect statements executed on this thread for the duration of the block."""
+    install()
+    stats = QueryStats()
+    _active().append(stats)
+    try:
+        yield stats
+    finally:
+        _active().remove(stats)
+
+
+def current():
+    """The QueryStats of the current request, or None outside a tracked request."""
+    return g.get("sql_stats")
+
+
+def init_app(app):
+    install()
+    app.config.setdefault("SQL_STATS_HEADERS", None)  # None = follow app.debug
+    app.config.setdefault("SQL_STATS_LOG", True)
+    app.config.setdefault("SQL_N_PLUS_ONE_THRESHOLD", DEFAULT_N_PLUS_ONE_THRESHOLD)
+
+    def headers_enabled():
+        enabled = app.config["SQL_STATS_HEADERS"]
+        return app.debug if enabled is None else enabled
+
+    @app.before_request
+    def _start_sql_stats():
+        g.sql_stats = QueryStats()
+        _active().append(g.sql_stats)
+        if headers_enabled():
+            # The headers go out before a streamed body is rendered; render whole pages
+            g.buffer_templates = True
+
+    @app.after_request
+    def _sql_stats_headers(response):
+        stats = g.get("sql_stats")
+        if stats is not None and headers_enabled():
+            repeated = stats.repeated(app.config["SQL_N_PLUS_ONE_THRESHOLD"])
+            response.headers["X-SQL-Queries"] = str(stats.count)
+            response.headers["X-SQL-Time-ms"] = f"{stats.total_time * 1000:.2f}"
+            response.headers["X-SQL-N-Plus-One"] = str(len(repeated))
+            if repeated:
+                shape, n = repeated[0]
+                worst = f"{n}x {shape}"[:200]
+                response.headers["X-SQL-Worst-Repeat"] = worst.encode("ascii", "replace").decode()
+        return response
+
+    @app.teardown_request
+    def _finish_sql_stats(exc):
+        stats = g.pop("sql_stats", None)
+        if stats is None:
+            return
+        if stats in _active():
+            _active().remove(stats)
+        if headers_enabled() or not app.config["SQL_STATS_LOG"]:
+            return
+        record = stats.as_dict(app.config["SQL_N_PLUS_ONE_THRESHOLD"])
+        record.update(method=request.method, path=request.path, endpoint=request.endpoint)
+        level = logging.WARNING if record["n_plus_one"] else logging.INFO
+        logger.log(level, json.dumps(record))
+
+
+# ---------- TEST HELPERS ----------
+@contextmanager
+def query_budget(max_queries, allow_n_plus_one=True, threshold=DEFAULT_N_PLUS_ONE_THRESHOLD):
+    """Fail if the block issues more than `max_queries` statements.
+
+        with query_budget(10):
+            client.get("/leaderboard")
+    """
+    with track() as stats:
+        yield stats
+    problems = []
+    if stats.count > max_queries:
+        problems.append(f"{stats.count} queries issued, budget is {max_queries}")
+    repeated = stats.repeated(threshold)
+    if repeated and not allow_n_plus_one:
+        problems.append("N+1 pattern detected")
+    if problems:
+        detail = "\n".join(f"  {n}x {shape}" for shape, n in stats.shapes.most_common(10))
+        raise AssertionError("; ".join(problems) + "\nMost frequent statements:\n" + detail)
+
+
+def assert_query_budget(client, url, max_queries, method="GET", allow_n_plus_one=False, **kwargs):
+    """Request `url` through a Flask test client and enforce its query budget.
+
+    The body is read inside the budget, so queries run while a streamed
+    template renders are counted too.
+    """
+    kwargs.setdefault("buffered", True)
+    with query_budget(max_queries, allow_n_plus_one=allow_n_plus_one) as stats:
+        response = client.open(url, method=method, **kwargs)
+    return response, stats
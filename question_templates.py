@@ -0,0 +1,133 @@
+"""Parameterised integral questions with a pre-generated variant pool.
+
+A template kind (e.g. "power_linear" for ∫ (ax+b)^n dx) knows how to draw
+parameters and how to turn them into a question with one correct option and
+three distractors. Variants are generated in bulk ahead of time and packed into
+a pool of fixed 4-byte records (a, b, n, option permutation), so thousands of
+variants cost a few KB instead of thousands of Question rows.
+
+Requests never generate anything: a student's variant is a stable index into
+the pool (derived from the student id, template id and pool seed), and both
+the rendered text and the correct letter are read straight from that record.
+"""
+import math
+import random
+import struct
+import zlib
+from itertools import permutations
+
+RECORD = struct.Struct(">bbbB")
+LETTERS = "ABCD"
+PERMUTATIONS = list(permutations(range(4)))  # 24 orderings; option 0 is the key
+
+
+def _frac(num, den):
+    """Coefficient prefix in lowest terms: "(1/12)", "" for 1, "3" for 6/2."""
+    divisor = math.gcd(num, den)
+    num, den = num // divisor, den // divisor
+    if den == 1:
+        return "" if num == 1 else str(num)
+    return f"({num}/{den})"
+
+
+def _linear(a, b):
+    if b == 0:
+        return f"{a}x"
+    return f"{a}x + {b}" if b > 0 else f"{a}x - {-b}"
+
+
+def power_linear(a, b, n):
+    inner = _linear(a, b)
+    question = f"What is ∫ ({inner})^{n} dx?"
+    options = [
+        f"{_frac(1, a * (n + 1))}({inner})^{n + 1} + C",
+        f"{_frac(1, n + 1)}({inner})^{n + 1} + C",
+        f"{_frac(a, n + 1)}({inner})^{n + 1} + C",
+        f"{a * n}({inner})^{n - 1} + C",
+    ]
+    return question, options
+
+
+def exp_linear(a, b, n):
+    inner = _linear(a, b)
+    question = f"What is ∫ e^({inner}) dx?"
+    options = [
+        f"{_frac(1, a)}e^({inner}) + C",
+        f"e^({inner}) + C",
+        f"{a}e^({inner}) + C",
+        f"({inner})e^({inner}) + C",
+    ]
+    return question, options
+
+
+def reciprocal_linear(a, b, n):
+    inner = _linear(a, b)
+    question = f"What is ∫ 1 / ({inner}) dx?"
+    options = [
+        f"{_frac(1, a)}ln|{inner}| + C",
+        f"ln|{inner}| + C",
+        f"{a}ln|{inner}| + C",
+        f"-{a}/({inner})^2 + C",
+    ]
+    return question, options
+
+
+def cos_linear(a, b, n):
+    inner = _linear(a, b)
+    question = f"What is ∫ cos({inner}) dx?"
+    options = [
+        f"{_frac(1, a)}sin({inner}) + C",
+        f"-{_frac(1, a)}sin({inner}) + C",
+        f"{a}sin({inner}) + C",
+        f"-{_frac(1, a)}cos({inner}) + C",
+    ]
+    return question, options
+
+
+KINDS = {
+    "power_linear": power_linear,
+    "exp_linear": exp_linear,
+    "reciprocal_linear": reciprocal_linear,
+    "cos_linear": cos_linear,
+}
+
+
+def generate_pool(kind, size, seed):
+    """Pack `size` random variants of `kind` into bytes."""
+    if kind not in KINDS:
+        raise ValueError(f"unknown question template kind {kind!r}")
+    rng = random.Random(seed)
+    out = bytearray()
+    for _ in range(size):
+        a = rng.randint(2, 9)
+        b = rng.choice([v for v in range(-9, 10) if v != 0])
+        n = rng.randint(2, 9)
+        out += RECORD.pack(a, b, n, rng.randrange(len(PERMUTATIONS)))
+    return bytes(out)
+
+
+def pool_size(pool):
+    return len(pool) // RECORD.size
+
+
+def variant_index(pool, student_id, template_id, seed):
+    """Stable per-student position in the pool."""
+    return zlib.crc32(f"{seed}:{template_id}:{student_id}".encode()) % pool_size(pool)
+
+
+def render_variant(kind, pool, index):
+    """Question text, options A-D and the correct letter for one pool record."""
+    a, b, n, perm = RECORD.unpack_from(pool, index * RECORD.size)
+    question, options = KINDS[kind](a, b, n)
+    order = PERMUTATIONS[perm]
+    return {
+        "question_text": question,
+        "options": [options[i] for i in order],
+        "correct_answer": LETTERS[order.index(0)],
+    }
+
+
+def correct_letter(pool, index):
+    """Grade without rendering any text."""
+    perm = RECORD.unpack_from(pool, index * RECORD.size)[3]
+    return LETTERS[PERMUTATIONS[perm].index(0)]
@@ -0,0 +1,169 @@
+"""Token-bucket rate limits for write endpoints, shared by every worker.
+
+Buckets live in a small memory-mapped file (RATE_LIMIT_FILE) of fixed-size
+slots, so all worker processes on the machine see the same counts; updates
+take an flock on the file and are a few microseconds. A request is checked
+before the view runs, using only the session cookie and remote address,
+so a rejected write costs no database work and gets 429 with Retry-After.
+
+RATE_LIMITS maps an endpoint to its policies, each (scope, capacity, period):
+up to `capacity` requests, refilled evenly over `period` seconds, per
+
+* "user": the logged-in user id, within their school
+* "classroom": the student's classroom (remembered in the session at login),
+  within their school; ids are only unique per school shard
+* "ip": the client address
+* "global": everyone together, to keep the single database writer responsive
+
+A request must have a token in every bucket that applies; tokens are only
+taken when it passes all of them.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import Response, request, session
+
+SLOT = struct.Struct("<Qdd")  # key hash, tokens, last update
+PROBES = 8
+IDLE_SECONDS = 3600  # a bucket untouched this long is full again and its slot reusable
+
+DEFAULT_LIMITS = {
+    "forum": [("user", 5, 60), ("classroom", 60, 60), ("ip", 30, 60), ("global", 50, 1)],
+    "answer_post": [("user", 10, 60), ("classroom", 120, 60), ("ip", 60, 60), ("global", 50, 1)],
+    "submit_part": [("user", 10, 60), ("classroom", 200, 60), ("ip", 100, 60), ("global", 50, 1)],
+    # Replays of answers queued offline arrive in bursts when a student reconnects
+    "submit_part_sync": [("user", 30, 60), ("classroom", 200, 60), ("ip", 100, 60), ("global", 50, 1)],
+    "chatgpt_chapter": [("user", 10, 60), ("ip", 30, 60), ("global", 20, 1)],
+    "login": [("ip", 20, 60)],
+    "signup": [("ip", 5, 300)],
+}
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+
+class BucketStore:
+    """Open-addressed table of token buckets in a shared memory-mapped file."""
+
+    def __init__(self, path, slots):
+        self.slots = slots
+        self._lock = threading.Lock()
+        size = slots * SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                os.ftruncate(self._fd, size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def _find(self, key_hash, now):
+        """Slot index for key_hash: its own slot, else a free, idle or the stalest probed slot."""
+        start = key_hash % self.slots
+        candidate, candidate_age = None, -1.0
+        for i in range(PROBES):
+            index = (start + i) % self.slots
+            stored, _, updated = SLOT.unpack_from(self._map, index * SLOT.size)
+            if stored == key_hash:
+                return index, True
+            age = math.inf if stored == 0 or now - updated > IDLE_SECONDS else now - updated
+            if age > candidate_age:
+                candidate, candidate_age = index, age
+        return candidate, False
+
+    def take(self, buckets):
+        """Take one token from each (key, capacity, period) bucket, or none at all.
+
+        Returns 0 on success, else the seconds until every bucket has a token.
+        """
+        now = time.time()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                states = []
+                wait = 0.0
+                for key, capacity, period in buckets:
+                    key_hash = self._hash(key)
+                    index, found = self._find(key_hash, now)
+                    rate = capacity / period
+                    if found:
+                        _, tokens, updated = SLOT.unpack_from(self._map, index * SLOT.size)
+                        tokens = min(capacity, tokens + (now - updated) * rate)
+                    else:
+                        tokens = float(capacity)
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) / rate)
+                    states.append((index, key_hash, tokens))
+                if wait:
+                    return wait
+                for index, key_hash, tokens in states:
+                    SLOT.pack_into(self._map, index * SLOT.size, key_hash, tokens - 1, now)
+                return 0
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    def __init__(self, app=None, metrics=None):
+        self.metrics = metrics
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RATE_LIMIT_ENABLED", True)
+        app.config.setdefault("RATE_LIMIT_FILE", os.path.join(app.instance_path, "ratelimit.bin"))
+        app.config.setdefault("RATE_LIMIT_SLOTS", 65536)
+        app.config.setdefault("RATE_LIMITS", DEFAULT_LIMITS)
+        self.app = app
+        os.makedirs(os.path.dirname(app.config["RATE_LIMIT_FILE"]), exist_ok=True)
+        self.store = BucketStore(app.config["RATE_LIMIT_FILE"], app.config["RATE_LIMIT_SLOTS"])
+        app.before_request(self._check)
+
+    @staticmethod
+    def remember_classroom(classroom_id):
+        """Call at login so the classroom policy needs no database lookup."""
+        session["rate_limit_classroom"] = classroom_id
+
+    def _subject(self, scope):
+        if scope in ("user", "classroom"):
+            # set by Flask-Login / remember_classroom(); qualified by the school
+            subject = session.get("_user_id" if scope == "user" else "rate_limit_classroom")
+            return None if subject is None else f"{session.get('shard')}:{subject}"
+        if scope == "ip":
+            return request.remote_addr
+        if scope == "global":
+            return "all"
+        raise ValueError(f"unknown rate limit scope {scope!r}")
+
+    def _check(self):
+        if not self.app.config["RATE_LIMIT_ENABLED"] or request.method not in WRITE_METHODS:
+            return None
+        policies = self.app.config["RATE_LIMITS"].get(request.endpoint)
+        if not policies:
+            return None
+        buckets = []
+        for scope, capacity, period in policies:
+            subject = self._subject(scope)
+            if subject is not None:
+                buckets.append((f"{request.endpoint}:{scope}:{subject}", capacity, period))
+        wait = self.store.take(buckets)
+        if not wait:
+            return None
+        if self.metrics is not None:
+            self.metrics.inc("rate_limited_total", {"endpoint": request.endpoint})
+        return Response(
+            "Too many requests, please wait a moment and try again.\n",
+            status=429,
+            mimetype="text/plain",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
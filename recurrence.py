@@ -0,0 +1,197 @@
+"""RRULE-style recurrence rules, expanded one date range at a time.
+
+A recurring calendar event is stored once, as a start date plus a rule in the
+subset of RFC 5545 a class calendar needs, e.g. "FREQ=WEEKLY;BYDAY=TU,TH":
+
+    FREQ=DAILY|WEEKLY|MONTHLY|YEARLY  required
+    INTERVAL=n                        every n-th day/week/month/year (default 1)
+    BYDAY=MO,WE                       weekdays; with MONTHLY, "1MO" or "-1FR"
+                                      picks the first Monday / last Friday
+    BYMONTHDAY=1,15,-1                days of the month (MONTHLY)
+    COUNT=n or UNTIL=YYYYMMDD         where the series ends (neither: never)
+
+occurrences() yields only the dates that fall in the requested range. Periods
+before the range are skipped arithmetically; only a COUNT rule has to be
+walked from its start, since the count depends on every earlier occurrence.
+Skipped dates (EXDATE) still count towards COUNT, as in RFC 5545.
+"""
+import calendar
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+
+
+class RuleError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Rule:
+    freq: str
+    interval: int = 1
+    byday: tuple = ()  # (n, weekday): n = 0 for every such weekday
+    bymonthday: tuple = ()
+    count: int = None
+    until: date = None
+
+
+def _int(name, value, low=None):
+    try:
+        number = int(value)
+    except ValueError:
+        raise RuleError(f"{name} must be a number") from None
+    if low is not None and number < low:
+        raise RuleError(f"{name} must be at least {low}")
+    return number
+
+
+def _weekday(text):
+    n, day = text[:-2], text[-2:]
+    if day not in WEEKDAYS:
+        raise RuleError(f"unknown weekday {text!r}")
+    n = _int("BYDAY", n) if n not in ("", "+") else 0
+    if not -5 <= n <= 5:
+        raise RuleError(f"BYDAY position out of range in {text!r}")
+    return n, WEEKDAYS.index(day)
+
+
+@lru_cache(maxsize=1024)
+def parse(text):
+    """Rule from RRULE text (an optional "RRULE:" prefix is ignored)."""
+    text = text.strip().upper()
+    if text.startswith("RRULE:"):
+        text = text[6:]
+    parts = {}
+    for item in filter(None, text.split(";")):
+        name, sep, value = item.partition("=")
+        if not sep or not value:
+            raise RuleError(f"malformed rule part {item!r}")
+        parts[name] = value
+
+    freq = parts.pop("FREQ", None)
+    if freq not in FREQUENCIES:
+        raise RuleError("FREQ must be one of " + ", ".join(FREQUENCIES))
+    rule = {"freq": freq}
+    if "INTERVAL" in parts:
+        rule["interval"] = _int("INTERVAL", parts.pop("INTERVAL"), 1)
+    if "BYDAY" in parts:
+        rule["byday"] = tuple(_weekday(d) for d in parts.pop("BYDAY").split(","))
+        if freq != "MONTHLY" and any(n for n, _ in rule["byday"]):
+            raise RuleError("numbered BYDAY is only supported with FREQ=MONTHLY")
+    if "BYMONTHDAY" in parts:
+        if freq != "MONTHLY":
+            raise RuleError("BYMONTHDAY is only supported with FREQ=MONTHLY")
+        days = tuple(_int("BYMONTHDAY", d) for d in parts.pop("BYMONTHDAY").split(","))
+        if any(d == 0 or not -31 <= d <= 31 for d in days):
+            raise RuleError("BYMONTHDAY must be 1..31 or -31..-1")
+        rule["bymonthday"] = days
+    if "COUNT" in parts and "UNTIL" in parts:
+        raise RuleError("use COUNT or UNTIL, not both")
+    if "COUNT" in parts:
+        rule["count"] = _int("COUNT", parts.pop("COUNT"), 1)
+    if "UNTIL" in parts:
+        try:
+            rule["until"] = datetime.strptime(parts.pop("UNTIL")[:8], "%Y%m%d").date()
+        except ValueError:
+            raise RuleError("UNTIL must look like YYYYMMDD") from None
+    if parts:
+        raise RuleError("unsupported rule parts: " + ", ".join(sorted(parts)))
+    return Rule(**rule)
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def _period_start(freq, day):
+    if freq == "DAILY":
+        return day
+    if freq == "WEEKLY":
+        return day - timedelta(days=day.weekday())
+    if freq == "MONTHLY":
+        return day.replace(day=1)
+    return date(day.year, 1, 1)
+
+
+def _periods_between(freq, base, day):
+    """Whole periods from the period starting at `base` to the one holding `day`."""
+    if freq == "DAILY":
+        return (day - base).days
+    if freq == "WEEKLY":
+        return (day - base).days // 7
+    if freq == "MONTHLY":
+        return (day.year - base.year) * 12 + day.month - base.month
+    return day.year - base.year
+
+
+def _nth_period(freq, base, n):
+    if freq == "DAILY":
+        return base + timedelta(days=n)
+    if freq == "WEEKLY":
+        return base + timedelta(weeks=n)
+    if freq == "MONTHLY":
+        return _add_months(base, n)
+    return date(base.year + n, 1, 1)
+
+
+def _dates_in_period(rule, period, start):
+    if rule.freq == "DAILY":
+        if rule.byday and period.weekday() not in {wd for _, wd in rule.byday}:
+            return []
+        return [period]
+    if rule.freq == "WEEKLY":
+        weekdays = sorted({wd for _, wd in rule.byday}) or [start.weekday()]
+        return [period + timedelta(days=wd) for wd in weekdays]
+    if rule.freq == "YEARLY":
+        try:
+            return [period.replace(month=start.month, day=start.day)]
+        except ValueError:  # 29 February
+            return []
+
+    length = calendar.monthrange(period.year, period.month)[1]
+    days = set()
+    for d in rule.bymonthday:
+        d = d if d > 0 else length + 1 + d
+        if 1 <= d <= length:
+            days.add(d)
+    for n, wd in rule.byday:
+        first = (wd - period.weekday()) % 7 + 1
+        matches = list(range(first, length + 1, 7))
+        if n == 0:
+            days.update(matches)
+        elif -len(matches) <= n <= len(matches) and n:
+            days.add(matches[n - 1] if n > 0 else matches[n])
+    if not rule.bymonthday and not rule.byday and start.day <= length:
+        days.add(start.day)  # months without that day are skipped, as in RFC 5545
+    return [period.replace(day=d) for d in sorted(days)]
+
+
+def occurrences(rule, start, first, last, exdates=()):
+    """Dates of the series that starts on `start` within [first, last], in order."""
+    if isinstance(rule, str):
+        rule = parse(rule)
+    if rule.until is not None:
+        last = min(last, rule.until)
+    base = _period_start(rule.freq, start)
+    index = 0
+    if rule.count is None and first > start:
+        skip = _periods_between(rule.freq, base, first)
+        index = skip - skip % rule.interval
+    seen = 0
+    while True:
+        period = _nth_period(rule.freq, base, index)
+        if period > last:
+            return
+        for day in _dates_in_period(rule, period, start):
+            if day < start:
+                continue
+            seen += 1
+            if (rule.count is not None and seen > rule.count) or day > last:
+                return
+            if day >= first and day not in exdates:
+                yield day
+        index += rule.interval
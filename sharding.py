@@ -0,0 +1,177 @@
+"""One SQLite database per school, plus a shared course catalog.
+
+A school's classrooms, users, submissions, progress, points, forum, calendar
+and job queue live in SHARD_DIR/<school>.db, so schools never wait on each
+other's writer lock. Course content (the CATALOG_TABLES) stays in the main
+database, which every shard connection ATTACHes as "catalog". SQLite resolves
+an unqualified table name in the connection's own database first and then in
+attached ones, and shard files contain no catalog tables, so every query in
+the app, including joins between school rows and courses or parts, runs
+unchanged against any shard.
+
+The main database is also the "default" shard: existing data stays there and
+nothing changes for a single-school install. `flask create-school NAME` adds
+a shard.
+
+ShardedSQLAlchemy is a drop-in for SQLAlchemy whose default engine (used by
+db.session and db.engine) is the current shard's:
+
+* requests use the shard saved in the session at login; shard_directory (in
+  the catalog) maps each login to its shard, and logins missing from it are
+  in the default shard
+* shard_context(name) pushes an app context bound to a shard, for work that
+  visits every school (jobs, global leaderboard)
+* CLI commands use the SHARD environment variable, else the default shard
+"""
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import click
+import sqlalchemy as sa
+from flask import g, has_app_context, session
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+DEFAULT_SHARD = "default"
+SHARD_NAME = re.compile(r"^[a-z0-9][a-z0-9_-]{0,49}$")
+
+
+def current_shard():
+    if has_app_context() and "shard" in g:
+        return g.shard
+    return os.environ.get("SHARD") or DEFAULT_SHARD
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    def init_app(self, app):
+        app.config.setdefault("SHARD_DIR", os.path.join(app.instance_path, "shards"))
+        app.config.setdefault("CATALOG_TABLES", ())
+        super().init_app(app)
+        self.app = app
+        self._shard_engines = {}
+        self._shard_lock = threading.Lock()
+        os.makedirs(app.config["SHARD_DIR"], exist_ok=True)
+        self.directory = self.Table(
+            "shard_directory",
+            self.Column("login", self.String(120), primary_key=True),  # "teacher:<email>" / "student:<id>"
+            self.Column("shard", self.String(50), nullable=False),
+        )
+
+        @app.before_request
+        def _route_to_shard():
+            g.shard = session.get("shard", DEFAULT_SHARD)
+
+        self._register_commands(app)
+
+    # ---------- engines ----------
+    @property
+    def engines(self):
+        engines = super().engines
+        name = current_shard()
+        if name == DEFAULT_SHARD:
+            return engines
+        return {**engines, None: self.shard_engine(name)}
+
+    @property
+    def catalog_engine(self):
+        return super().engines[None]
+
+    def shard_path(self, name):
+        if not SHARD_NAME.match(name) or name == DEFAULT_SHARD:
+            raise ValueError(f"invalid shard name {name!r}")
+        return os.path.join(self.app.config["SHARD_DIR"], f"{name}.db")
+
+    def shard_engine(self, name):
+        engine = self._shard_engines.get(name)
+        if engine is not None:
+            return engine
+        with self._shard_lock:
+            if name not in self._shard_engines:
+                path = self.shard_path(name)
+                if not os.path.exists(path):
+                    raise LookupError(f"no such shard: {name}")
+                catalog = self.catalog_engine.url.database
+                engine = sa.create_engine(f"sqlite:///{path}")
+
+                @sa.event.listens_for(engine, "connect")
+                def _attach_catalog(dbapi_connection, connection_record):
+                    dbapi_connection.execute("ATTACH DATABASE ? AS catalog", (catalog,))
+
+                self._shard_engines[name] = engine
+            return self._shard_engines[name]
+
+    def shard_names(self):
+        names = sorted(
+            f[:-3] for f in os.listdir(self.app.config["SHARD_DIR"])
+            if f.endswith(".db") and SHARD_NAME.match(f[:-3])
+        )
+        return [DEFAULT_SHARD] + [n for n in names if n != DEFAULT_SHARD]
+
+    @contextmanager
+    def shard_context(self, name):
+        """An app context (with its own session) bound to one shard."""
+        with self.app.app_context():
+            g.shard = name
+            yield
+
+    def use_shard(self, name):
+        """Switch the current context to another shard, before its session is used."""
+        g.shard = name
+
+    # ---------- schema ----------
+    def school_tables(self):
+        catalog = set(self.app.config["CATALOG_TABLES"]) | {self.directory.name}
+        return [t for t in self.metadata.sorted_tables if t.name not in catalog]
+
+    def create_all(self, bind_key="__all__"):
+        # A shard must not get its own (empty) copies of the catalog tables
+        if current_shard() != DEFAULT_SHARD:
+            self.metadata.create_all(self.engine, tables=self.school_tables())
+            return
+        super().create_all(bind_key)
+
+    def create_shard(self, name):
+        path = self.shard_path(name)
+        if not os.path.exists(path):
+            open(path, "a").close()
+        with self.shard_context(name):
+            self.create_all()
+
+    # ---------- login directory ----------
+    def lookup_login(self, login):
+        with self.catalog_engine.connect() as conn:
+            shard = conn.execute(
+                sa.select(self.directory.c.shard).where(self.directory.c.login == login)
+            ).scalar()
+        return shard or DEFAULT_SHARD
+
+    def register_login(self, login, shard):
+        """Claim `login` for a shard; False if any school already uses it."""
+        with self.catalog_engine.begin() as conn:
+            return bool(conn.execute(
+                sqlite_insert(self.directory)
+                .values(login=login, shard=shard)
+                .on_conflict_do_nothing()
+            ).rowcount)
+
+    def unregister_login(self, login):
+        with self.catalog_engine.begin() as conn:
+            conn.execute(sa.delete(self.directory).where(self.directory.c.login == login))
+
+    # ---------- commands ----------
+    def _register_commands(self, app):
+        @app.cli.command("create-school")
+        @click.argument("name")
+        def create_school(name):
+            """Create (or bring up to date) the database of school NAME."""
+            self.create_shard(name)
+            click.echo(f"School database {self.shard_path(name)} is ready.")
+
+        @app.cli.command("list-schools")
+        def list_schools():
+            """Show every shard and its size."""
+            for name in self.shard_names():
+                path = self.catalog_engine.url.database if name == DEFAULT_SHARD else self.shard_path(name)
+                click.echo(f"{name:<24}{os.path.getsize(path) // 1024:>10} KiB  {path}")
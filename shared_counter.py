@@ -0,0 +1,44 @@
+"""A counter shared by every worker process on the machine, for cache invalidation.
+
+Workers keep caches of data that rarely changes. Whoever changes the data
+calls bump() once the change is committed; a worker compares value() with
+the value its cache entry was filled at, and any difference means the entry
+is stale. The counter is 8 bytes in a memory-mapped file, so reading it is
+a memory load: no system call and no query.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+COUNTER = struct.Struct("<Q")
+
+
+class SharedCounter:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != COUNTER.size:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != COUNTER.size:
+                    os.ftruncate(self._fd, COUNTER.size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, COUNTER.size)
+
+    def value(self):
+        return COUNTER.unpack_from(self._map)[0]
+
+    def bump(self):
+        """Increment the counter; returns the new value."""
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                value = COUNTER.unpack_from(self._map)[0] + 1
+                COUNTER.pack_into(self._map, 0, value)
+                return value
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
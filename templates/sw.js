@@ -0,0 +1,293 @@
+// Service worker for the offline student mode, rendered by service_worker() in app.py.
+//
+// * chapter pages are served from the "pages" cache when they are there, and
+//   refreshed in the background once older than PAGE_MAX_AGE; a write made from
+//   a page drops that page, and a login or logout drops them all
+// * asset bundles, lesson note PDFs and video thumbnails are cache-first
+// * offline.js hands exercise answers to this worker, which posts them to the
+//   idempotent /submit_part/<id>/sync endpoint or, without a connection, keeps
+//   them in IndexedDB and sends them when the connection is back. Answers the
+//   server fails on are retried with exponential backoff and given up (with
+//   an error shown) after MAX_ATTEMPTS failures
+const PAGES = "pages-v1";
+const FILES = "files-v1";
+const PRECACHE = [
+    {{ asset_url("app.css")|tojson }},
+    {{ asset_url("app.js")|tojson }},
+    {{ url_for("static", filename="img/video-placeholder.svg")|tojson }},
+];
+const PAGE_MAX_AGE = 10 * 60 * 1000;
+const MANIFEST_EVERY = 10 * 60 * 1000;
+const CLEARS_ALL_PAGES = [{{ url_for("login")|tojson }}, {{ url_for("logout")|tojson }}, {{ url_for("signup")|tojson }}];
+const CHAPTER_PAGE = /^\/chapter\/\d+$/;
+const CACHE_FIRST = ["/assets/", "/static/", "/video-thumbnail/"];
+const MAX_ATTEMPTS = 6;
+const RETRY_BASE = 30 * 1000;
+const RETRY_MAX = 60 * 60 * 1000;
+const GAVE_UP = "These answers could not be submitted. Please try again from the chapter page.";
+
+let lastManifest = 0;
+let flushing = null;
+
+// ---------- lifecycle ----------
+self.addEventListener("install", (event) => {
+    event.waitUntil(
+        caches.open(FILES).then((cache) => cache.addAll(PRECACHE)).then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener("activate", (event) => {
+    event.waitUntil((async () => {
+        for (const name of await caches.keys()) {
+            if (name !== PAGES && name !== FILES) {
+                await caches.delete(name);
+            }
+        }
+        // Bundles are fingerprinted: drop the ones this version no longer uses
+        const files = await caches.open(FILES);
+        for (const request of await files.keys()) {
+            const path = new URL(request.url).pathname;
+            if (path.startsWith("/assets/") && !PRECACHE.includes(path)) {
+                await files.delete(request);
+            }
+        }
+        await self.clients.claim();
+    })());
+});
+
+// ---------- requests ----------
+self.addEventListener("fetch", (event) => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (url.origin !== location.origin) {
+        return;
+    }
+    if (CLEARS_ALL_PAGES.includes(url.pathname)) {
+        event.respondWith(caches.delete(PAGES).then(() => fetch(request)));
+        return;
+    }
+    if (request.method !== "GET") {
+        // e.g. "Mark Complete": the page the form was on is out of date now
+        event.respondWith(
+            caches.open(PAGES).then((pages) => request.referrer && pages.delete(request.referrer)).then(() => fetch(request))
+        );
+        return;
+    }
+    if (CHAPTER_PAGE.test(url.pathname)) {
+        event.respondWith(chapterPage(event));
+    } else if (CACHE_FIRST.some((prefix) => url.pathname.startsWith(prefix))) {
+        event.respondWith(cacheFirst(request));
+    }
+});
+
+async function storePage(url, response) {
+    // Pages showing flash messages are marked no-store and never replayed
+    if (!response.ok || response.type !== "basic" || /no-store/.test(response.headers.get("Cache-Control") || "")) {
+        return;
+    }
+    const headers = new Headers(response.headers);
+    headers.delete("Content-Encoding");
+    headers.delete("Content-Length");
+    headers.set("SW-Fetched-At", String(Date.now()));
+    const body = await response.blob();
+    const pages = await caches.open(PAGES);
+    await pages.put(url, new Response(body, { status: response.status, headers }));
+}
+
+async function refreshPage(url) {
+    const response = await fetch(url, { credentials: "same-origin", redirect: "manual" });
+    await storePage(url, response);
+}
+
+async function chapterPage(event) {
+    const url = event.request.url;
+    const cached = await caches.match(url, { cacheName: PAGES });
+    if (cached) {
+        if (Date.now() - Number(cached.headers.get("SW-Fetched-At")) > PAGE_MAX_AGE) {
+            event.waitUntil(refreshPage(url).catch(() => {}));
+        }
+        return cached;
+    }
+    try {
+        const response = await fetch(event.request);
+        event.waitUntil(storePage(url, response.clone()).catch(() => {}));
+        return response;
+    } catch (error) {
+        return new Response(
+            "<!DOCTYPE html><meta charset=utf-8><title>Offline</title>" +
+            "<p>You are offline, and this chapter has not been saved on this device yet.</p>",
+            { status: 503, headers: { "Content-Type": "text/html" } }
+        );
+    }
+}
+
+async function cacheFirst(request) {
+    const cached = await caches.match(request, { cacheName: FILES });
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    if (response.status === 200) {
+        const files = await caches.open(FILES);
+        await files.put(request, response.clone());
+    }
+    return response;
+}
+
+async function precache(manifestUrl) {
+    if (Date.now() - lastManifest < MANIFEST_EVERY) {
+        return;
+    }
+    lastManifest = Date.now();
+    const response = await fetch(manifestUrl, { credentials: "same-origin" });
+    if (!response.ok) {
+        return;
+    }
+    const manifest = await response.json();
+    const pages = await caches.open(PAGES);
+    const files = await caches.open(FILES);
+    // Only what is missing: a warm cache costs one manifest request
+    for (const url of manifest.pages) {
+        if (!(await pages.match(url))) {
+            await refreshPage(url).catch(() => {});
+        }
+    }
+    for (const url of manifest.files) {
+        if (!(await files.match(url))) {
+            await files.add(url).catch(() => {});
+        }
+    }
+}
+
+// ---------- submission queue ----------
+function openQueue() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open("offline-submissions", 1);
+        open.onupgradeneeded = () => open.result.createObjectStore("submissions", { keyPath: ["owner", "url"] });
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+async function queue(mode, operation) {
+    const db = await openQueue();
+    return new Promise((resolve, reject) => {
+        const transaction = db.transaction("submissions", mode);
+        const request = operation(transaction.objectStore("submissions"));
+        transaction.oncomplete = () => resolve(request.result);
+        transaction.onerror = () => reject(transaction.error);
+    });
+}
+
+// The server's answer; { retry: "wait" } or { retry: "failed" } to keep the
+// entry queued; throws when offline
+async function send(entry) {
+    const response = await fetch(entry.url, {
+        method: "POST",
+        body: new URLSearchParams(entry.fields),
+        credentials: "same-origin",
+    });
+    // Logged out, or someone else's answers: wait for the student who gave them
+    if ([401, 409].includes(response.status)) {
+        return { retry: "wait" };
+    }
+    // Rate limited or a server error: try later, less and less often
+    if (response.status === 429 || response.status >= 500) {
+        return { retry: "failed" };
+    }
+    if (!response.ok) {
+        const body = await response.json().catch(() => ({}));
+        return { error: body.error || "This part can no longer be submitted." };
+    }
+    const result = await response.json();
+    await refreshPage(new URL(result.chapter_url, location.origin).href).catch(() => {});
+    return result;
+}
+
+// The entry after one more failed attempt, or null once it should be given up
+function backedOff(entry) {
+    const attempts = (entry.attempts || 0) + 1;
+    if (attempts >= MAX_ATTEMPTS) {
+        return null;
+    }
+    return { ...entry, attempts, retryAt: Date.now() + Math.min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX) };
+}
+
+async function submit({ url, fields, owner }) {
+    let entry = { owner, url, fields: fields.concat([["offline_owner", owner]]), queuedAt: Date.now(), attempts: 0 };
+    try {
+        const result = await send(entry);
+        if (!result.retry) {
+            return result;
+        }
+        if (result.retry === "failed") {
+            entry = backedOff(entry);
+        }
+    } catch (error) {
+        // offline: queue it
+    }
+    await queue("readwrite", (store) => store.put(entry));
+    if (self.registration.sync) {
+        self.registration.sync.register("submissions").catch(() => {});
+    }
+    return { queued: true };
+}
+
+function flush() {
+    flushing = flushing || (async () => {
+        try {
+            for (const entry of await queue("readonly", (store) => store.getAll())) {
+                if (entry.retryAt > Date.now()) {
+                    continue;
+                }
+                let result = await send(entry);
+                if (result.retry === "wait") {
+                    continue;
+                }
+                if (result.retry === "failed") {
+                    const next = backedOff(entry);
+                    if (next) {
+                        await queue("readwrite", (store) => store.put(next));
+                        continue;
+                    }
+                    result = { error: GAVE_UP };
+                }
+                await queue("readwrite", (store) => store.delete([entry.owner, entry.url]));
+                for (const client of await self.clients.matchAll()) {
+                    client.postMessage({ type: "synced", url: entry.url, result });
+                }
+            }
+        } catch (error) {
+            // still offline
+        } finally {
+            flushing = null;
+        }
+    })();
+    return flushing;
+}
+
+self.addEventListener("sync", (event) => {
+    if (event.tag === "submissions") {
+        event.waitUntil(flush());
+    }
+});
+
+self.addEventListener("message", (event) => {
+    const message = event.data || {};
+    const reply = (value) => event.ports[0] && event.ports[0].postMessage(value);
+    let work;
+    if (message.type === "submit") {
+        work = submit(message);
+    } else if (message.type === "pending") {
+        work = queue("readonly", (store) => store.getAll()).then(
+            (entries) => entries.filter((entry) => entry.owner === message.owner).map((entry) => entry.url)
+        );
+    } else if (message.type === "flush") {
+        work = flush();
+    } else if (message.type === "precache") {
+        work = precache(message.manifest);
+    }
+    if (work) {
+        event.waitUntil(work.then(reply, () => reply({ error: "Something went wrong, please try again." })));
+    }
+});
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from bench import use_database
+
+
+@pytest.fixture(scope="session")
+def mathwow(tmp_path_factory):
+    """app.py on a throwaway instance/ holding a small synthetic school.
+
+    Every instance path (databases, shards, archives, backups, metrics, rate
+    limit buckets, the membership counter) lives under a temporary directory,
+    so running the tests never touches a checkout's own instance/.
+    """
+    instance = tmp_path_factory.mktemp("instance")
+    os.environ["INSTANCE_PATH"] = str(instance)
+    use_database(instance / "test.db")
+    import app as mathwow
+    from bench.synthetic_school import build_school
+
+    assert mathwow.app.instance_path == str(instance), "app was imported before the fixture ran"
+    mathwow.app.config.update(TESTING=True, RATE_LIMIT_ENABLED=False, SQL_STATS_HEADERS=False)
+    with mathwow.app.app_context():
+        build_school(
+            classrooms=2, students_per_class=5, courses=1, chapters_per_course=2, parts_per_chapter=6,
+            questions_per_part=2, posts_per_class=8, answers_per_post=3, events_per_class=8,
+        )
+    return mathwow
+
+
+def login(client, role, email_or_id, password="bench"):
+    response = client.post("/login", data={"role": role, "email_or_id": email_or_id, "password": password})
+    assert response.status_code == 302 and response.headers["Location"] == "/", "login failed"
+    return client
+
+
+@pytest.fixture
+def student(mathwow):
+    return login(mathwow.app.test_client(), "student", "bench-s1")
+
+
+@pytest.fixture
+def teacher(mathwow):
+    return login(mathwow.app.test_client(), "teacher", "bench-t1@example.com")
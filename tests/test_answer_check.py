@@ -0,0 +1,64 @@
+import pytest
+
+import answer_check
+from answer_check import MAX_DEPTH, MAX_LENGTH, ParseError, equivalent, parse
+
+
+@pytest.mark.parametrize("answer, key", [
+    ("(1/7)(x + 1)^7 + C", "(1/7)(x+1)^7"),
+    ("(x+1)^7/7 + 5", "(1/7)(x + 1)^7 + C"),
+    ("-x cos x + sin x", "sin x - x cos x + C"),
+    ("ln|sec x + tan x|", "ln|sec x + tan x| + C"),
+    ("2√(x-2)*(x²/5 - 2x/15 - 8/15)", "2√(x-2)*(x^2/5 - 2x/15 - 8/15) + C"),
+    ("e^(2x)/2", "(1/2)e^(2x) + C"),
+])
+def test_equivalent_answers_are_accepted(answer, key):
+    assert equivalent(answer, key)
+
+
+@pytest.mark.parametrize("answer, key", [
+    ("x^2", "x^3"),
+    ("2x^2", "x^2"),
+    ("-cos x", "sin x"),
+])
+def test_different_answers_are_rejected(answer, key):
+    assert not equivalent(answer, key)
+
+
+@pytest.mark.parametrize("text, message", [
+    ("", "empty"),
+    ("  + C", "empty"),
+    ("x +", "end of answer"),
+    ("foo(x)", "unknown name"),
+])
+def test_malformed_answers_raise_parse_error(text, message):
+    with pytest.raises(ParseError, match=message):
+        parse(text)
+
+
+def test_answers_over_the_length_limit_are_refused():
+    with pytest.raises(ParseError, match="too long"):
+        parse("x+" * MAX_LENGTH + "x")
+
+
+@pytest.mark.parametrize("text", [
+    "(" * (MAX_DEPTH + 1) + "x" + ")" * (MAX_DEPTH + 1),
+    "-" * (MAX_DEPTH + 1) + "x",
+    "sin(" * (MAX_DEPTH + 1) + "x" + ")" * (MAX_DEPTH + 1),
+])
+def test_deep_nesting_is_refused(text):
+    with pytest.raises(ParseError, match="nested too deeply"):
+        parse(text)
+
+
+def test_nesting_within_the_limit_parses():
+    depth = MAX_DEPTH // 2
+    parse("(" * depth + "x" + ")" * depth)
+
+
+def test_keys_are_cached_but_answers_are_not():
+    answer_check.parse_key.cache_clear()
+    equivalent("x^2/2", "(1/2)x^2 + C")
+    equivalent("x^2/2 + 1", "(1/2)x^2 + C")
+    info = answer_check.parse_key.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
@@ -0,0 +1,14 @@
+def test_metrics_are_closed_to_loopback_without_the_token(mathwow, monkeypatch):
+    # The test client, like a same-host reverse proxy, connects from 127.0.0.1
+    monkeypatch.setitem(mathwow.app.config, "METRICS_TOKEN", "s3cret")
+    client = mathwow.app.test_client()
+    assert client.get("/metrics").status_code == 404
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 404
+    response = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert b"mathwow_requests_total" in response.data
+
+
+def test_metrics_stay_closed_without_a_configured_token(mathwow, monkeypatch):
+    monkeypatch.setitem(mathwow.app.config, "METRICS_TOKEN", None)
+    assert mathwow.app.test_client().get("/metrics", headers={"Authorization": "Bearer None"}).status_code == 404
@@ -0,0 +1,68 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from query_stats import QueryStats, query_budget, statement_shape, track
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE post (id INTEGER PRIMARY KEY, title TEXT)"))
+        conn.execute(text("INSERT INTO post (id, title) VALUES (1, 'a'), (2, 'b'), (3, 'c'), (4, 'd'), (5, 'e')"))
+    return engine
+
+
+def lazy_loads(engine, ids):
+    with engine.connect() as conn:
+        for post_id in ids:
+            conn.execute(text("SELECT title FROM post WHERE id = :id"), {"id": post_id})
+
+
+@pytest.mark.parametrize("statement, shape", [
+    ("SELECT * FROM post WHERE id = 12", "SELECT * FROM post WHERE id = ?"),
+    ("SELECT * FROM post WHERE title = 'it''s'", "SELECT * FROM post WHERE title = ?"),
+    ("SELECT *\n  FROM post WHERE id IN (?, ?, ?)", "SELECT * FROM post WHERE id IN (?)"),
+    ("SELECT * FROM post WHERE id IN (%(id_1)s, %(id_2)s)", "SELECT * FROM post WHERE id IN (?)"),
+])
+def test_statement_shape_collapses_literals(statement, shape):
+    assert statement_shape(statement) == shape
+
+
+def test_repeated_shapes_are_flagged_at_the_threshold():
+    stats = QueryStats()
+    for post_id in range(5):
+        stats.record(f"SELECT * FROM answer WHERE post_id = {post_id}", 0.001)
+    stats.record("SELECT * FROM post", 0.002)
+    assert stats.count == 6
+    assert stats.repeated(threshold=5) == [("SELECT * FROM answer WHERE post_id = ?", 5)]
+    assert stats.repeated(threshold=6) == []
+    assert stats.as_dict()["n_plus_one"] == [{"count": 5, "statement": "SELECT * FROM answer WHERE post_id = ?"}]
+
+
+def test_track_counts_statements_on_this_thread(engine):
+    with track() as outer:
+        lazy_loads(engine, [1, 2])
+        with track() as inner:
+            lazy_loads(engine, [3])
+    assert (outer.count, inner.count) == (3, 1)
+    lazy_loads(engine, [4])
+    assert outer.count == 3
+
+
+def test_query_budget_passes_within_budget(engine):
+    with query_budget(2, allow_n_plus_one=False) as stats:
+        lazy_loads(engine, [1, 2])
+    assert stats.count == 2
+
+
+def test_query_budget_fails_over_budget(engine):
+    with pytest.raises(AssertionError, match="3 queries issued, budget is 2"):
+        with query_budget(2):
+            lazy_loads(engine, [1, 2, 3])
+
+
+def test_query_budget_detects_n_plus_one(engine):
+    with pytest.raises(AssertionError, match="N\\+1 pattern detected"):
+        with query_budget(10, allow_n_plus_one=False):
+            lazy_loads(engine, [1, 2, 3, 4, 5])
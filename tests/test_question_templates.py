@@ -0,0 +1,57 @@
+import pytest
+
+from question_templates import (
+    KINDS, LETTERS, RECORD, _frac, correct_letter, generate_pool, pool_size, render_variant, variant_index,
+)
+
+
+@pytest.mark.parametrize("num, den, prefix", [
+    (1, 1, ""),
+    (3, 3, ""),
+    (6, 2, "3"),
+    (2, 4, "(1/2)"),
+    (1, 12, "(1/12)"),
+    (4, 6, "(2/3)"),
+])
+def test_frac_is_in_lowest_terms(num, den, prefix):
+    assert _frac(num, den) == prefix
+
+
+@pytest.mark.parametrize("kind", sorted(KINDS))
+def test_options_are_distinct_for_every_parameter(kind):
+    for a in range(2, 10):
+        for n in range(2, 10):
+            _, options = KINDS[kind](a, -3, n)
+            assert len(set(options)) == 4, (a, n, options)
+
+
+def test_generate_pool_is_deterministic():
+    pool = generate_pool("power_linear", 50, seed=7)
+    assert pool == generate_pool("power_linear", 50, seed=7)
+    assert pool != generate_pool("power_linear", 50, seed=8)
+    assert pool_size(pool) == 50
+
+
+def test_generate_pool_rejects_unknown_kinds():
+    with pytest.raises(ValueError, match="unknown question template kind"):
+        generate_pool("nope", 1, seed=1)
+
+
+@pytest.mark.parametrize("kind", sorted(KINDS))
+def test_correct_letter_marks_the_key(kind):
+    pool = generate_pool(kind, 30, seed=3)
+    for index in range(pool_size(pool)):
+        variant = render_variant(kind, pool, index)
+        letter = correct_letter(pool, index)
+        assert variant["correct_answer"] == letter
+        a, b, n, _ = RECORD.unpack_from(pool, index * RECORD.size)
+        key = KINDS[kind](a, b, n)[1][0]
+        assert variant["options"][LETTERS.index(letter)] == key
+
+
+def test_variant_index_is_stable_per_student():
+    pool = generate_pool("exp_linear", 100, seed=1)
+    first = variant_index(pool, 42, 3, seed=1)
+    assert first == variant_index(pool, 42, 3, seed=1)
+    assert 0 <= first < 100
+    assert len({variant_index(pool, student, 3, seed=1) for student in range(50)}) > 1
@@ -0,0 +1,81 @@
+import pytest
+from flask import Flask, session
+
+import rate_limit
+from rate_limit import IDLE_SECONDS, BucketStore, RateLimiter
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BucketStore(str(tmp_path / "ratelimit.bin"), 64)
+
+
+def test_bucket_allows_capacity_then_refills_evenly(store, clock):
+    bucket = [("post:user:1", 3, 60)]
+    assert [store.take(bucket) for _ in range(3)] == [0, 0, 0]
+    assert store.take(bucket) == pytest.approx(20)
+    clock.now += 20
+    assert store.take(bucket) == 0
+    assert store.take(bucket) == pytest.approx(20)
+
+
+def test_tokens_are_taken_from_every_bucket_or_none(store, clock):
+    user = ("post:user:1", 5, 60)
+    glob = ("post:global:all", 1, 10)
+    assert store.take([user, glob]) == 0
+    assert store.take([user, glob]) == pytest.approx(10)
+    # The rejected request took nothing from the user's bucket
+    clock.now += 10
+    for _ in range(4):
+        assert store.take([user]) == 0
+    assert store.take([user]) > 0
+
+
+def test_buckets_are_independent(store, clock):
+    assert store.take([("post:user:1", 1, 60)]) == 0
+    assert store.take([("post:user:1", 1, 60)]) > 0
+    assert store.take([("post:user:2", 1, 60)]) == 0
+
+
+def test_buckets_are_shared_through_the_file(tmp_path, clock):
+    path = str(tmp_path / "ratelimit.bin")
+    first, second = BucketStore(path, 64), BucketStore(path, 64)
+    assert first.take([("login:ip:10.0.0.1", 1, 60)]) == 0
+    assert second.take([("login:ip:10.0.0.1", 1, 60)]) > 0
+
+
+def test_full_table_reuses_idle_slots(tmp_path, clock):
+    store = BucketStore(str(tmp_path / "ratelimit.bin"), rate_limit.PROBES)
+    for i in range(rate_limit.PROBES):
+        assert store.take([(f"k{i}", 1, 60)]) == 0
+    clock.now += IDLE_SECONDS + 1
+    assert store.take([("newcomer", 1, 60)]) == 0
+    assert store.take([("newcomer", 1, 60)]) > 0
+
+
+def test_user_and_classroom_buckets_are_qualified_by_school(tmp_path):
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY="test", RATE_LIMIT_FILE=str(tmp_path / "ratelimit.bin"), RATE_LIMIT_SLOTS=64)
+    limiter = RateLimiter(app)
+    with app.test_request_context(environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+        session.update({"shard": "north", "_user_id": "5", "rate_limit_classroom": 2})
+        assert limiter._subject("user") == "north:5"
+        assert limiter._subject("classroom") == "north:2"
+        assert limiter._subject("ip") == "10.0.0.1"
+        session["shard"] = "south"
+        assert limiter._subject("user") == "south:5"
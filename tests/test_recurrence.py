@@ -0,0 +1,100 @@
+from datetime import date, timedelta
+
+import pytest
+
+from recurrence import RuleError, occurrences, parse
+
+
+def test_parse_reads_every_supported_part():
+    rule = parse("RRULE:freq=monthly;interval=2;byday=1MO,-1FR;count=6")
+    assert rule.freq == "MONTHLY"
+    assert rule.interval == 2
+    assert rule.byday == ((1, 0), (-1, 4))
+    assert rule.count == 6
+    assert parse("FREQ=WEEKLY;UNTIL=20240115T000000Z").until == date(2024, 1, 15)
+
+
+@pytest.mark.parametrize("text, message", [
+    ("FREQ=HOURLY", "FREQ must be"),
+    ("FREQ", "malformed"),
+    ("FREQ=DAILY;INTERVAL=0", "at least 1"),
+    ("FREQ=DAILY;INTERVAL=two", "must be a number"),
+    ("FREQ=WEEKLY;BYDAY=XX", "unknown weekday"),
+    ("FREQ=WEEKLY;BYDAY=1MO", "only supported with FREQ=MONTHLY"),
+    ("FREQ=MONTHLY;BYDAY=6MO", "out of range"),
+    ("FREQ=WEEKLY;BYMONTHDAY=1", "only supported with FREQ=MONTHLY"),
+    ("FREQ=MONTHLY;BYMONTHDAY=0", "1..31"),
+    ("FREQ=DAILY;COUNT=2;UNTIL=20240101", "not both"),
+    ("FREQ=DAILY;UNTIL=tomorrow", "YYYYMMDD"),
+    ("FREQ=DAILY;BYSETPOS=1", "unsupported rule parts: BYSETPOS"),
+])
+def test_parse_rejects_bad_rules(text, message):
+    with pytest.raises(RuleError, match=message):
+        parse(text)
+
+
+def dates(rule, start, first, last, exdates=()):
+    return list(occurrences(rule, start, first, last, exdates))
+
+
+def test_weekly_by_day():
+    assert dates("FREQ=WEEKLY;BYDAY=TU,TH", date(2024, 1, 2), date(2024, 1, 1), date(2024, 1, 14)) == [
+        date(2024, 1, 2), date(2024, 1, 4), date(2024, 1, 9), date(2024, 1, 11),
+    ]
+
+
+def test_weekly_defaults_to_the_start_weekday_and_stops_at_until():
+    assert dates("FREQ=WEEKLY;UNTIL=20240115", date(2024, 1, 1), date(2024, 1, 1), date(2024, 2, 28)) == [
+        date(2024, 1, 1), date(2024, 1, 8), date(2024, 1, 15),
+    ]
+
+
+def test_monthly_last_friday_with_count():
+    assert dates("FREQ=MONTHLY;BYDAY=-1FR;COUNT=3", date(2024, 1, 1), date(2024, 1, 1), date(2024, 12, 31)) == [
+        date(2024, 1, 26), date(2024, 2, 23), date(2024, 3, 29),
+    ]
+
+
+def test_monthly_by_negative_month_day():
+    assert dates("FREQ=MONTHLY;BYMONTHDAY=1,-1", date(2024, 2, 1), date(2024, 2, 1), date(2024, 3, 31)) == [
+        date(2024, 2, 1), date(2024, 2, 29), date(2024, 3, 1), date(2024, 3, 31),
+    ]
+
+
+def test_months_without_the_start_day_are_skipped():
+    assert dates("FREQ=MONTHLY", date(2024, 1, 31), date(2024, 1, 1), date(2024, 6, 30)) == [
+        date(2024, 1, 31), date(2024, 3, 31), date(2024, 5, 31),
+    ]
+
+
+def test_yearly_on_29_february_only_in_leap_years():
+    assert dates("FREQ=YEARLY", date(2024, 2, 29), date(2024, 1, 1), date(2029, 1, 1)) == [
+        date(2024, 2, 29), date(2028, 2, 29),
+    ]
+
+
+def test_exdates_are_skipped_but_count_towards_count():
+    assert dates("FREQ=DAILY;COUNT=5", date(2024, 1, 1), date(2024, 1, 1), date(2024, 1, 31),
+                 exdates={date(2024, 1, 2)}) == [
+        date(2024, 1, 1), date(2024, 1, 3), date(2024, 1, 4), date(2024, 1, 5),
+    ]
+
+
+@pytest.mark.parametrize("rule, start", [
+    ("FREQ=DAILY;INTERVAL=3", date(2024, 1, 1)),
+    ("FREQ=DAILY;BYDAY=MO,WE,FR", date(2024, 1, 3)),
+    ("FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,FR", date(2024, 1, 5)),
+    ("FREQ=MONTHLY;INTERVAL=5;BYDAY=2TU", date(2023, 11, 14)),
+    ("FREQ=MONTHLY;BYMONTHDAY=-1,15", date(2024, 1, 15)),
+    ("FREQ=YEARLY;INTERVAL=2", date(2021, 7, 4)),
+])
+def test_skipping_to_a_later_range_matches_walking_from_the_start(rule, start):
+    first, last = date(2031, 3, 1), date(2031, 9, 30)
+    walked = [d for d in dates(rule, start, start, last) if d >= first]
+    assert walked
+    assert dates(rule, start, first, last) == walked
+
+
+def test_ranges_before_the_start_are_empty():
+    start = date(2024, 6, 1)
+    assert dates("FREQ=DAILY", start, start - timedelta(days=30), start - timedelta(days=1)) == []
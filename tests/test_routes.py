@@ -0,0 +1,85 @@
+"""Query budgets for the busiest pages.
+
+The synthetic school has more posts, answers, events and students per
+classroom than the N+1 threshold, so a query issued per row fails the test
+even while the total stays under budget.
+"""
+import pytest
+
+from query_stats import assert_query_budget
+
+
+@pytest.mark.parametrize("url, budget", [
+    ("/student_dashboard", 6),
+    ("/leaderboard", 4),
+    ("/leaderboard?window=week", 4),
+    ("/forum", 7),
+    ("/forum/archive", 4),
+    ("/calendar", 5),
+    ("/practice", 5),
+])
+def test_student_pages_stay_within_budget(student, url, budget):
+    student.get(url).close()  # first visits fill the practice queue and per-process caches
+    response, _ = assert_query_budget(student, url, budget)
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize("url, budget", [
+    ("/teacher_dashboard", 8),
+    ("/leaderboard", 2),
+    ("/forum", 5),
+    ("/calendar", 4),
+    ("/classrooms/search?q=bench", 2),
+])
+def test_teacher_pages_stay_within_budget(teacher, url, budget):
+    teacher.get(url).close()
+    response, _ = assert_query_budget(teacher, url, budget)
+    assert response.status_code == 200
+
+
+def test_forum_renders_posts_and_answers_in_a_fixed_number_of_queries(student):
+    response, stats = assert_query_budget(student, "/forum", 7)
+    assert response.data.count(b"<!-- Answers -->") == 8
+    assert stats.repeated() == []
+
+
+def test_classroom_search_returns_the_schools_classrooms(teacher):
+    response, _ = assert_query_budget(teacher, "/classrooms/search?q=bench", 2)
+    assert [row["name"] for row in response.json] == ["Bench Class 1", "Bench Class 2"]
+
+
+@pytest.fixture
+def bench_chapter(mathwow):
+    with mathwow.app.app_context():
+        course = mathwow.Course.query.filter(mathwow.Course.name.like("Bench Course%")).first()
+        return mathwow.Chapter.query.filter_by(course_id=course.id).first().id
+
+
+def test_chapter_page_loads_questions_per_chapter_not_per_part(student, bench_chapter):
+    url = f"/chapter/{bench_chapter}"
+    student.get(url).close()
+    response, stats = assert_query_budget(student, url, 11)
+    assert response.status_code == 200
+    assert response.data.count(b"card-header bg-dark") == 6
+    assert stats.repeated() == []
+
+
+def test_teacher_dashboard_cost_does_not_grow_with_classrooms(mathwow, teacher):
+    teacher.get("/teacher_dashboard").close()
+    _, one = assert_query_budget(teacher, "/teacher_dashboard", 8)
+    with mathwow.app.app_context():
+        user = mathwow.User.query.filter_by(email="bench-t1@example.com").one()
+        other = mathwow.Classroom.query.filter(mathwow.Classroom.id.not_in([c.id for c in user.classrooms])).first()
+        other_id = other.id
+        user.classrooms.append(other)
+        mathwow.db.session.commit()
+    try:
+        teacher.get("/teacher_dashboard").close()
+        response, two = assert_query_budget(teacher, "/teacher_dashboard", 8)
+        assert response.data.count(b"Bench Class") >= 2
+        assert two.count == one.count
+    finally:
+        with mathwow.app.app_context():
+            user = mathwow.User.query.filter_by(email="bench-t1@example.com").one()
+            user.classrooms.remove(mathwow.db.session.get(mathwow.Classroom, other_id))
+            mathwow.db.session.commit()
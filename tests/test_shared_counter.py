@@ -0,0 +1,11 @@
+from shared_counter import SharedCounter
+
+
+def test_bumps_are_seen_by_every_opener(tmp_path):
+    path = str(tmp_path / "sub" / "counter")
+    first, second = SharedCounter(path), SharedCounter(path)
+    assert first.value() == second.value() == 0
+    assert first.bump() == 1
+    assert second.bump() == 2
+    assert first.value() == 2
+    assert SharedCounter(path).value() == 2
@@ -0,0 +1,284 @@
+"""Chapter tutor: a language model answers students' questions about a chapter.
+
+The model sits behind a backend object with one method, stream(messages),
+that yields the answer in pieces. OpenAIChatBackend speaks the OpenAI chat
+completions protocol with streaming, which OpenAI and most self-hosted
+servers (vLLM, llama.cpp, Ollama) understand; TUTOR_API_URL points it at one.
+The default URL is a local stand-in, `python -m bench.fake_llm`, so
+development and load tests need no API key. Any object with stream() can be
+assigned to Tutor.backend instead.
+
+* streaming: ask() returns an iterator, and the route sends each piece as
+  it arrives, so the first words show while the rest is generated
+* caching: finished answers are stored in tutor_answer (in each school's
+  own database, so storing one never waits on another school's writes)
+  under the chapter and the normalized question, with a per-worker LRU in
+  front, so a repeated question is answered at once and costs no model call;
+  answers cut short are not kept
+* limits: at most TUTOR_MAX_CONCURRENT model calls per worker process and
+  one per student. A call that cannot get a slot within TUTOR_QUEUE_WAIT
+  seconds raises TutorBusy instead of holding a request thread, so slow
+  model responses cannot use up the threads the rest of the app needs
+"""
+import http.client
+import json
+import re
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+UNAVAILABLE = "\n\n[The tutor is unavailable right now. Please try again in a little while.]"
+_SPACE = re.compile(r"\s+")
+
+
+def normalize_question(text):
+    """Cache key of a question: case, spacing and trailing punctuation do not matter."""
+    return _SPACE.sub(" ", text).strip().rstrip("?!. ").casefold()
+
+
+class TutorBusy(Exception):
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class OpenAIChatBackend:
+    def __init__(self, url, api_key=None, model="gpt-4.1-mini", timeout=30, max_tokens=500):
+        self.url = url.rstrip("/") + "/chat/completions"
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+
+    def stream(self, messages):
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps({
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": self.max_tokens,
+                "stream": True,
+            }).encode(),
+            headers=headers,
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            # Server-sent events: "data: {chunk}" lines, ending with "data: [DONE]"
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    return
+                piece = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if piece:
+                    yield piece
+
+
+class Tutor:
+    def __init__(self, app=None, db=None, metrics=None, backend=None):
+        self.metrics = metrics
+        self.backend = backend
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._students = set()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault("TUTOR_API_URL", "http://127.0.0.1:8089/v1")
+        app.config.setdefault("TUTOR_API_KEY", None)
+        app.config.setdefault("TUTOR_MODEL", "gpt-4.1-mini")
+        app.config.setdefault("TUTOR_TIMEOUT", 30)
+        app.config.setdefault("TUTOR_MAX_TOKENS", 500)
+        app.config.setdefault("TUTOR_MAX_QUESTION", 500)  # characters
+        app.config.setdefault("TUTOR_MAX_CONCURRENT", 4)
+        app.config.setdefault("TUTOR_QUEUE_WAIT", 2.0)
+        app.config.setdefault("TUTOR_CACHE_SIZE", 512)
+        app.config.setdefault("TUTOR_CACHE_TTL", 30 * 24 * 3600)
+        self.app = app
+        self.db = db
+        self._slots = threading.BoundedSemaphore(app.config["TUTOR_MAX_CONCURRENT"])
+        if self.backend is None:
+            self.backend = OpenAIChatBackend(
+                app.config["TUTOR_API_URL"],
+                api_key=app.config["TUTOR_API_KEY"],
+                model=app.config["TUTOR_MODEL"],
+                timeout=app.config["TUTOR_TIMEOUT"],
+                max_tokens=app.config["TUTOR_MAX_TOKENS"],
+            )
+        self.table = db.Table(
+            "tutor_answer",
+            db.Column("chapter_id", db.Integer, primary_key=True),
+            db.Column("question_key", db.String(500), primary_key=True),
+            db.Column("question", db.Text, nullable=False),
+            db.Column("answer", db.Text, nullable=False),
+            db.Column("created_at", db.DateTime, nullable=False),
+        )
+        self._register_commands(app)
+
+    def _engine(self):
+        # The current school's database
+        return self.db.engine
+
+    # ---------- cache ----------
+    def cached(self, chapter_id, key):
+        with self._lock:
+            answer = self._cache.get((chapter_id, key))
+            if answer is not None:
+                self._cache.move_to_end((chapter_id, key))
+                return answer
+        fresh = datetime.utcnow() - timedelta(seconds=self.app.config["TUTOR_CACHE_TTL"])
+        with self._engine().connect() as conn:
+            answer = conn.execute(
+                sa.select(self.table.c.answer).where(
+                    self.table.c.chapter_id == chapter_id,
+                    self.table.c.question_key == key,
+                    self.table.c.created_at >= fresh,
+                )
+            ).scalar()
+        if answer is not None:
+            self._remember(chapter_id, key, answer)
+        return answer
+
+    def _remember(self, chapter_id, key, answer):
+        with self._lock:
+            self._cache[chapter_id, key] = answer
+            while len(self._cache) > self.app.config["TUTOR_CACHE_SIZE"]:
+                self._cache.popitem(last=False)
+
+    def store(self, chapter_id, key, question, answer):
+        row = {"question": question, "answer": answer, "created_at": datetime.utcnow()}
+        with self._engine().begin() as conn:
+            conn.execute(
+                sqlite_insert(self.table)
+                .values(chapter_id=chapter_id, question_key=key, **row)
+                .on_conflict_do_update(index_elements=["chapter_id", "question_key"], set_=row)
+            )
+        self._remember(chapter_id, key, answer)
+
+    def forget(self, chapter_id=None):
+        """Drop cached answers (of one chapter, or all) in every school, e.g. after content changed.
+
+        Other workers' LRUs keep theirs until they are evicted or restarted.
+        """
+        query = sa.delete(self.table)
+        if chapter_id is not None:
+            query = query.where(self.table.c.chapter_id == chapter_id)
+        removed = 0
+        for school in getattr(self.db, "shard_names", lambda: [None])():
+            with self.db.shard_context(school) if school is not None else self.app.app_context():
+                with self._engine().begin() as conn:
+                    removed += conn.execute(query).rowcount
+        with self._lock:
+            for key in [k for k in self._cache if chapter_id is None or k[0] == chapter_id]:
+                del self._cache[key]
+        return removed
+
+    # ---------- answering ----------
+    def ask(self, chapter_id, question, system_prompt, student):
+        """Iterator over the answer's pieces; raises TutorBusy when no model slot is free.
+
+        `student` is any hashable id of the asker, for the one-question-at-a-time limit.
+        """
+        question = question.strip()[:self.app.config["TUTOR_MAX_QUESTION"]]
+        key = normalize_question(question)
+        answer = self.cached(chapter_id, key)
+        if answer is not None:
+            self._count("cached")
+            if self.metrics is not None:
+                self.metrics.cache_hit("tutor")
+            return iter([answer])
+        if self.metrics is not None:
+            self.metrics.cache_miss("tutor")
+
+        with self._lock:
+            if student in self._students:
+                self._count("busy")
+                raise TutorBusy("Please wait for the answer to your last question first.")
+            self._students.add(student)
+        if not self._slots.acquire(timeout=self.app.config["TUTOR_QUEUE_WAIT"]):
+            with self._lock:
+                self._students.discard(student)
+            self._count("busy")
+            raise TutorBusy("The tutor is busy right now. Please try again in a few seconds.")
+        if self.metrics is not None:
+            self.metrics.add_gauge("tutor_in_flight", None, 1)
+
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._slots.release()
+                with self._lock:
+                    self._students.discard(student)
+                if self.metrics is not None:
+                    self.metrics.add_gauge("tutor_in_flight", None, -1)
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": question},
+        ]
+        return _Answer(self._generate(chapter_id, key, question, messages, release), release)
+
+    def _generate(self, chapter_id, key, question, messages, release):
+        # Runs while the response is sent
+        started = time.perf_counter()
+        pieces = []
+        try:
+            try:
+                for piece in self.backend.stream(messages):
+                    if not pieces and self.metrics is not None:
+                        self.metrics.observe("tutor_first_token_seconds", None, time.perf_counter() - started)
+                    pieces.append(piece)
+                    yield piece
+            except (OSError, ValueError, LookupError, http.client.HTTPException):
+                self.app.logger.exception("tutor backend failed")
+                self._count("error")
+                yield UNAVAILABLE
+                return
+            if pieces:
+                self.store(chapter_id, key, question, "".join(pieces))
+            self._count("answered")
+        finally:
+            release()
+
+    def _register_commands(self, app):
+        @app.cli.command("clear-tutor-cache")
+        @click.option("--chapter", "chapter_id", type=int, help="only this chapter's answers")
+        def clear_tutor_cache(chapter_id):
+            """Forget cached tutor answers, e.g. after chapter content changed."""
+            click.echo(f"Removed {self.forget(chapter_id)} cached answer(s).")
+
+    def _count(self, outcome):
+        if self.metrics is not None:
+            self.metrics.inc("tutor_requests_total", {"outcome": outcome})
+
+
+class _Answer:
+    """The answer's pieces; closing it frees the model slot even if it never started
+    (a generator closed before its first step skips its finally block)."""
+
+    def __init__(self, pieces, release):
+        self._pieces = pieces
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._pieces)
+
+    def close(self):
+        self._pieces.close()
+        self._release()
@@ -0,0 +1,95 @@
+"""Locally cached YouTube thumbnails for the click-to-play video facade.
+
+Chapter pages show a thumbnail with a play button instead of a YouTube
+<iframe>; the player (and its JavaScript) is only loaded when a student clicks
+(static/js/video-facade.js). Thumbnails are fetched from YouTube once, stored
+in THUMBNAIL_DIR and served from here with a long cache lifetime, so pages
+make no third-party requests until a video is actually played.
+`flask cache-video-thumbnails` fills the cache ahead of time.
+
+Thumbnails are for logged-in users. The route fetches only videos that the
+app's known_video() check accepts, i.e. videos used by some lesson, and
+remembers failed fetches for THUMBNAIL_RETRY_AFTER seconds. Arbitrary ids
+therefore cannot make workers wait on YouTube or fill the disk.
+"""
+import os
+import re
+import threading
+import time
+import urllib.request
+
+from flask import abort, send_file, send_from_directory
+from flask_login import login_required
+
+VIDEO_ID = re.compile(r"^[A-Za-z0-9_-]{11}$")
+SOURCE_URL = "https://i.ytimg.com/vi/{}/hqdefault.jpg"
+PLACEHOLDER = "video-placeholder.svg"
+
+
+class VideoThumbnails:
+    def __init__(self, app=None):
+        self._is_known = None
+        self._failed = {}  # video id -> time of the failed fetch
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("THUMBNAIL_DIR", os.path.join(app.instance_path, "thumbnails"))
+        app.config.setdefault("THUMBNAIL_FETCH_TIMEOUT", 3)
+        app.config.setdefault("THUMBNAIL_MAX_AGE", 30 * 24 * 3600)
+        app.config.setdefault("THUMBNAIL_RETRY_AFTER", 300)
+        self.app = app
+        self.directory = app.config["THUMBNAIL_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+
+        @app.route("/video-thumbnail/<video_id>.jpg")
+        @login_required
+        def video_thumbnail(video_id):
+            if not VIDEO_ID.match(video_id):
+                abort(404)
+            path = self.path(video_id)
+            if not os.path.exists(path):
+                if self._is_known is None or not self._is_known(video_id):
+                    abort(404)
+                path = self.fetch(video_id)
+            if path is None:
+                # Offline or unknown video: generic placeholder, not cached for long
+                return send_from_directory(
+                    os.path.join(app.static_folder, "img"), PLACEHOLDER, max_age=300
+                )
+            return send_file(path, mimetype="image/jpeg", max_age=app.config["THUMBNAIL_MAX_AGE"])
+
+    def known_video(self, check):
+        """Register check(video_id) -> bool: may this video's thumbnail be downloaded?"""
+        self._is_known = check
+        return check
+
+    def path(self, video_id):
+        return os.path.join(self.directory, f"{video_id}.jpg")
+
+    def fetch(self, video_id):
+        """Path of the cached thumbnail, downloading it first if needed; None on failure."""
+        path = self.path(video_id)
+        if os.path.exists(path):
+            return path
+        with self._lock:
+            failed_at = self._failed.get(video_id)
+        if failed_at is not None and time.monotonic() - failed_at < self.app.config["THUMBNAIL_RETRY_AFTER"]:
+            return None
+        try:
+            with urllib.request.urlopen(
+                SOURCE_URL.format(video_id), timeout=self.app.config["THUMBNAIL_FETCH_TIMEOUT"]
+            ) as response:
+                data = response.read()
+        except OSError:
+            with self._lock:
+                self._failed[video_id] = time.monotonic()
+            return None
+        with self._lock:
+            self._failed.pop(video_id, None)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path